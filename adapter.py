@@ -2,194 +2,63 @@
 """
 Script to update sma_products table with discount columns from Excel file
 This script:
-1. Connects to MySQL database using SQLAlchemy
+1. Connects to MySQL database using the shared engine (database.py, DATABASE_URL)
 2. Adds discount columns if they don't exist
 3. Updates products with discount values from Excel file
+
+It runs the same pipeline as the /upload_discounts endpoint (main.py): the
+file is read with layouts.DISCOUNTS, whose header row resolves the
+duplicated Dis1/Dis2/Dis3 columns once, and every batch is applied with one
+staged UPDATE ... JOIN (services.discount_service).
 """
 
-import pandas as pd
-from sqlalchemy import create_engine, text, inspect
 import sys
-from typing import Optional
+import time
 
-# Database configuration
-DB_CONNECTION_STRING = "mysql+pymysql://root@localhost:3306/avnzor"
-TABLE_NAME = "sma_products"
-EXCEL_FILE_PATH = "discount.xls"
+from sqlalchemy import text
 
-# Column definitions
-# Note: cash_discount and credit_discount already exist in the database
-NEW_DISCOUNT_COLUMNS = [
-    "cash_dis2", 
-    "cash_dis3",
-    "credit_dis2",
-    "credit_dis3"
-]
+from database import SessionLocal, get_engine
+from layouts import LAYOUTS
+from normalization import NumericNormalizer
+from services.discount_service import add_discount_columns, discount_rows, update_product_discounts
+from utils import iter_excel_batches
 
-ALL_DISCOUNT_COLUMNS = [
-    "cash_discount",  # existing column (maps to cash_dis)
-    "cash_dis2", 
-    "cash_dis3",
-    "credit_discount",  # existing column (maps to credit_dis)
-    "credit_dis2",
-    "credit_dis3"
-]
+# Database configuration
+EXCEL_FILE_PATH = "discount.xls"
+BATCH_SIZE = 5000
 
 
-def read_excel_file(file_path: str) -> pd.DataFrame:
+def update_products(file_path: str) -> None:
     """
-    Read and process the Excel file with discount data
-    
+    Update products with discount values from the Excel file, one commit
+    per batch.
+
     Args:
         file_path: Path to the Excel file
-        
-    Returns:
-        DataFrame with processed discount data
     """
     print(f"Reading Excel file: {file_path}")
-    
-    # Read Excel file
-    df = pd.read_excel(file_path)
-    
-    # The first row contains the actual headers
-    # Set the first row as column names
-    df.columns = df.iloc[0]
-    
-    # Drop the first row (now it's redundant as headers)
-    df = df.drop(0).reset_index(drop=True)
-    
-    # Rename columns for clarity
-    # Based on the structure: ITEM_NO, then CREDIT section (Dis1, Dis2, Dis3), then Cash section (Dis1, Dis2, Dis3)
-    column_mapping = {
-        'ITEM_NO': 'item_no',
-        'Dis1': 'credit_dis',  # First Dis1 is under CREDIT
-        'Dis2': 'credit_dis2',  # First Dis2 is under CREDIT
-        'Dis3': 'credit_dis3'   # First Dis3 is under CREDIT
-    }
-    
-    # Get Cash discount columns (they appear after CREDIT columns)
-    cash_columns = df.columns.tolist()
-    cash_dis_idx = [i for i, col in enumerate(cash_columns) if col == 'Dis1']
-    
-    if len(cash_dis_idx) >= 2:
-        # Second occurrence of Dis1, Dis2, Dis3 are Cash discounts
-        cash_start_idx = cash_dis_idx[1]
-        df.columns.values[cash_start_idx] = 'cash_dis'
-        df.columns.values[cash_start_idx + 1] = 'cash_dis2'
-        df.columns.values[cash_start_idx + 2] = 'cash_dis3'
-    
-    df = df.rename(columns=column_mapping)
-    
-    # Select only the columns we need
-    required_columns = ['item_no', 'credit_dis', 'credit_dis2', 'credit_dis3', 
-                       'cash_dis', 'cash_dis2', 'cash_dis3']
-    
-    df = df[required_columns]
-    
-    # Rename to match database column names (cash_dis -> cash_discount, credit_dis -> credit_discount)
-    df = df.rename(columns={
-        'cash_dis': 'cash_discount',
-        'credit_dis': 'credit_discount'
-    })
-    
-    # Convert discount columns to numeric, replacing errors with None
-    discount_cols = ['cash_discount', 'cash_dis2', 'cash_dis3', 
-                     'credit_discount', 'credit_dis2', 'credit_dis3']
-    for col in discount_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
-    
-    # Remove rows where item_no is null or not numeric
-    df = df[df['item_no'].notna()]
-    df['item_no'] = pd.to_numeric(df['item_no'], errors='coerce')
-    df = df[df['item_no'].notna()]
-    
-    print(f"Processed {len(df)} products from Excel file")
-    print(f"\nSample data:")
-    print(df.head())
-    
-    return df
 
+    numbers = NumericNormalizer(LAYOUTS["discounts"].numeric_columns)
+    updated_count = 0
+    not_found_count = 0
+    total_rows = 0
+    start = time.perf_counter()
 
-def add_columns_if_not_exist(engine, table_name: str, columns: list):
-    """
-    Add columns to the table if they don't already exist
-    
-    Args:
-        engine: SQLAlchemy engine
-        table_name: Name of the table
-        columns: List of column names to add
-    """
-    inspector = inspect(engine)
-    existing_columns = [col['name'] for col in inspector.get_columns(table_name)]
-    
-    with engine.connect() as conn:
-        for column in columns:
-            if column not in existing_columns:
-                print(f"Adding column: {column}")
-                sql = text(f"ALTER TABLE {table_name} ADD COLUMN {column} DECIMAL(10, 4) DEFAULT NULL")
-                conn.execute(sql)
-                conn.commit()
-                print(f"✓ Column {column} added successfully")
-            else:
-                print(f"Column {column} already exists, skipping")
-
+    for i, batch_df in enumerate(iter_excel_batches(file_path, BATCH_SIZE, LAYOUTS["discounts"])):
+        batch_df, _ = numbers.normalize(batch_df)
+        total_rows += len(batch_df)
+        with SessionLocal() as session:
+            result = update_product_discounts(session, discount_rows(batch_df))
+            session.commit()
+        updated_count += result["updated"]
+        not_found_count += len(result["not_found"])
+        print(f"Progress: batch {i + 1}, {total_rows} rows processed...")
 
-def update_products(engine, table_name: str, df: pd.DataFrame):
-    """
-    Update products with discount values from the DataFrame
-    
-    Args:
-        engine: SQLAlchemy engine
-        table_name: Name of the table
-        df: DataFrame with discount data
-    """
-    print(f"\nUpdating {len(df)} products...")
-    
-    updated_count = 0
-    error_count = 0
-    
-    with engine.connect() as conn:
-        for idx, row in df.iterrows():
-            try:
-                # Prepare the UPDATE query
-                update_sql = text(f"""
-                    UPDATE {table_name}
-                    SET 
-                        cash_discount = :cash_discount,
-                        cash_dis2 = :cash_dis2,
-                        cash_dis3 = :cash_dis3,
-                        credit_discount = :credit_discount,
-                        credit_dis2 = :credit_dis2,
-                        credit_dis3 = :credit_dis3
-                    WHERE id = :item_no
-                """)
-                
-                # Execute the update
-                result = conn.execute(update_sql, {
-                    'item_no': int(row['item_no']),
-                    'cash_discount': float(row['cash_discount']) if pd.notna(row['cash_discount']) else None,
-                    'cash_dis2': float(row['cash_dis2']) if pd.notna(row['cash_dis2']) else None,
-                    'cash_dis3': float(row['cash_dis3']) if pd.notna(row['cash_dis3']) else None,
-                    'credit_discount': float(row['credit_discount']) if pd.notna(row['credit_discount']) else None,
-                    'credit_dis2': float(row['credit_dis2']) if pd.notna(row['credit_dis2']) else None,
-                    'credit_dis3': float(row['credit_dis3']) if pd.notna(row['credit_dis3']) else None,
-                })
-                
-                if result.rowcount > 0:
-                    updated_count += 1
-                    if (idx + 1) % 100 == 0:
-                        print(f"Progress: {idx + 1}/{len(df)} products processed...")
-                        
-            except Exception as e:
-                error_count += 1
-                print(f"Error updating product {row['item_no']}: {str(e)}")
-        
-        # Commit all changes
-        conn.commit()
-    
-    print(f"\n✓ Update completed!")
+    elapsed = time.perf_counter() - start
+    print(f"\n✓ Update completed in {elapsed:.2f}s ({total_rows / max(elapsed, 1e-9):.0f} rows/s)")
     print(f"  - Successfully updated: {updated_count} products")
-    print(f"  - Errors: {error_count}")
+    print(f"  - Not found: {not_found_count}")
+    print(f"  - Non-numeric cells stored as empty: {len(numbers.errors)}")
 
 
 def main():
@@ -199,9 +68,9 @@ def main():
         print("DISCOUNT UPDATE SCRIPT")
         print("=" * 70)
         
-        # Create database engine
-        print(f"\nConnecting to database: {DB_CONNECTION_STRING}")
-        engine = create_engine(DB_CONNECTION_STRING, echo=False)
+        # Shared engine, configured from the environment
+        engine = get_engine()
+        print(f"\nConnecting to database: {engine.url.render_as_string(hide_password=True)}")
         
         # Test connection
         with engine.connect() as conn:
@@ -209,15 +78,12 @@ def main():
         print("✓ Database connection successful")
         
         # Add only the new columns (cash_discount and credit_discount already exist)
-        print(f"\nChecking/adding new discount columns to {TABLE_NAME}...")
-        print("Note: cash_discount and credit_discount already exist in the database")
-        add_columns_if_not_exist(engine, TABLE_NAME, NEW_DISCOUNT_COLUMNS)
-        
-        # Read and process Excel file
-        df = read_excel_file(EXCEL_FILE_PATH)
+        print("\nChecking/adding new discount columns to sma_products...")
+        for column in add_discount_columns(engine):
+            print(f"✓ Column {column} added successfully")
         
-        # Update products
-        update_products(engine, TABLE_NAME, df)
+        # Read the Excel file and update products batch by batch
+        update_products(EXCEL_FILE_PATH)
         
         print("\n" + "=" * 70)
         print("SCRIPT COMPLETED SUCCESSFULLY")
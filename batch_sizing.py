@@ -0,0 +1,181 @@
+"""
+Batch sizes chosen from how the database actually keeps up, instead of one
+fixed row count for every layout.
+
+An AdaptiveBatcher re-cuts the parsed frames of a file into batches of its
+current size. After each batch is written its measurements are recorded:
+the write time, the largest single statement the writer's connection sent
+(multi-row upserts and header inserts grow with the batch) and the InnoDB
+row lock waits meanwhile. The
+next size aims at BATCH_TARGET_SECONDS per commit, moving at most x2 per
+batch, is halved while lock waits take a large share of the write, and never
+lets a statement outgrow max_allowed_packet.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from database import max_allowed_packet, row_lock_time_ms
+
+BATCH_TARGET_SECONDS = float(os.getenv("BATCH_TARGET_SECONDS", 2.0))
+BATCH_MIN_ROWS = int(os.getenv("BATCH_MIN_ROWS", 100))
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", 20000))
+# Frames are read in pieces of this many rows, so batches can be cut at any size
+READ_CHUNK_ROWS = int(os.getenv("BATCH_READ_CHUNK_ROWS", 250))
+# Share of max_allowed_packet a statement may use
+PACKET_HEADROOM = 0.5
+# Lock waits above this share of the write time halve the batch
+LOCK_WAIT_SHARE = 0.2
+# Weight of the latest batch in the smoothed seconds per row
+SMOOTHING = 0.5
+
+
+class AdaptiveBatcher:
+    """
+    Chooses the row count of the next batch from the measured cost of the
+    previous ones. batches() runs on the reader side, measure() (or begin()
+    and end()) around the write of each batch, given the session that writes
+    it; log receives a line whenever the size changes.
+    """
+
+    def __init__(self, initial_rows: int, target_seconds: float = BATCH_TARGET_SECONDS,
+                 min_rows: int = BATCH_MIN_ROWS, max_rows: int = BATCH_MAX_ROWS,
+                 log: Optional[Callable[[str], None]] = None):
+        self.min_rows = min_rows
+        self.max_rows = max(min_rows, max_rows)
+        self.size = self._clamp(initial_rows)
+        self.target_seconds = target_seconds
+        self.log = log
+        self.row_seconds: Optional[float] = None
+        self.sizes: List[int] = []
+        self.batches_written = 0
+        self._lock_time_ms: Optional[float] = None
+        self._started = 0.0
+        self._connection: Optional[Connection] = None
+        self._statement_bytes = 0
+        self._max_packet: Optional[int] = None
+
+    def _clamp(self, rows: float) -> int:
+        return int(min(self.max_rows, max(self.min_rows, rows)))
+
+    def batches(self, frames: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """
+        Re-cut a stream of frames into batches of the current size (read
+        again for every batch). Row order and index are kept; split frames
+        are copied, so the batches can be modified in place.
+        """
+        pending: List[pd.DataFrame] = []
+        rows = 0
+        for frame in frames:
+            pending.append(frame)
+            rows += len(frame)
+            while rows >= self.size:
+                df = pd.concat(pending) if len(pending) > 1 else pending[0]
+                size = self.size
+                rest = df.iloc[size:].copy()
+                yield df.iloc[:size].copy() if len(rest) else df
+                pending, rows = ([rest], len(rest)) if len(rest) else ([], 0)
+        if rows:
+            yield pd.concat(pending) if len(pending) > 1 else pending[0]
+
+    def begin(self, session: Optional[Session] = None) -> None:
+        """
+        Start timing the write of one batch; end() records it. With the
+        writing session, the statements its connection sends meanwhile are
+        sized and the row lock waits are read on it.
+        """
+        self._statement_bytes = 0
+        if session is not None:
+            self._connection = session.connection()
+            event.listen(self._connection, "before_cursor_execute", self._track_statement)
+            self._max_packet = max_allowed_packet(self._connection)
+            if self._lock_time_ms is None:
+                self._lock_time_ms = row_lock_time_ms(self._connection)
+        self._started = time.perf_counter()
+
+    def end(self, rows: int, session: Optional[Session] = None) -> int:
+        """
+        Record the batch of rows written since begin(). Returns the new size.
+        """
+        seconds = time.perf_counter() - self._started
+        if self._connection is not None:
+            event.remove(self._connection, "before_cursor_execute", self._track_statement)
+            self._connection = None
+        lock_wait = 0.0
+        if session is not None and self._lock_time_ms is not None:
+            # The batch may have committed: ask the session for its current connection
+            lock_time_ms = row_lock_time_ms(session.connection())
+            if lock_time_ms is not None:
+                lock_wait = max(0.0, lock_time_ms - self._lock_time_ms) / 1000
+            self._lock_time_ms = lock_time_ms
+        return self.record(rows, seconds, self._statement_bytes, lock_wait)
+
+    def _track_statement(self, conn, cursor, statement, parameters, context, executemany):
+        # executemany is split by PyMySQL at DB_EXECUTEMANY_BYTES; only statements
+        # that grow with the batch (multi-row VALUES, IN lists) are of interest
+        if executemany:
+            return
+        values = parameters.values() if isinstance(parameters, dict) else parameters or ()
+        self._statement_bytes = max(self._statement_bytes, len(statement) + sum(len(str(v)) for v in values))
+
+    @contextmanager
+    def measure(self, rows: int, session: Optional[Session] = None):
+        """
+        begin()/end() around the write of one batch of rows, also recorded
+        when the write raised (without reading lock waits on the session,
+        which the caller has yet to roll back).
+        """
+        self.begin(session)
+        try:
+            yield
+        except BaseException:
+            self.end(rows)
+            raise
+        self.end(rows, session)
+
+    def record(self, rows: int, seconds: float, statement_bytes: int = 0, lock_wait_seconds: float = 0.0) -> int:
+        """
+        Update the size from one written batch. Returns the new size.
+        """
+        if rows <= 0:
+            return self.size
+        self.batches_written += 1
+        self.sizes.append(rows)
+
+        per_row = seconds / rows
+        self.row_seconds = per_row if self.row_seconds is None else (
+            SMOOTHING * per_row + (1 - SMOOTHING) * self.row_seconds)
+        size = min(self.target_seconds / max(self.row_seconds, 1e-9), rows * 2)
+        size = max(size, rows / 2)
+        reason = f"{seconds:.2f}s for {rows} rows, target {self.target_seconds:g}s"
+
+        if lock_wait_seconds > LOCK_WAIT_SHARE * seconds:
+            size = min(size, rows / 2)
+            reason = f"{lock_wait_seconds:.2f}s of row lock waits"
+
+        packet = self._max_packet
+        if packet and statement_bytes:
+            # Statements are assumed to grow linearly with the batch
+            limit = rows * PACKET_HEADROOM * packet / statement_bytes
+            if size > limit:
+                size = limit
+                reason = f"{statement_bytes} byte statement, max_allowed_packet {packet}"
+
+        size = self._clamp(size)
+        if size != self.size and self.log:
+            self.log(f"📏 Batch size {self.size} → {size} rows ({reason})")
+        self.size = size
+        return size
+
+    def summary(self) -> str:
+        if not self.sizes:
+            return f"no batches written, size {self.size} rows"
+        return (f"{self.batches_written} batches of {min(self.sizes)}-{max(self.sizes)} rows "
+                f"(avg {sum(self.sizes) / len(self.sizes):.0f}), next size {self.size}, "
+                f"{(self.row_seconds or 0) * 1000:.2f} ms/row")
@@ -0,0 +1,83 @@
+"""
+Prepared batches spilled to disk, for imports that need a second pass over a
+whole file (grouping, or handing parsed workbooks from a worker process to
+the parent) without keeping the file in memory.
+
+Every batch becomes its own Parquet part file in the spill directory, so
+batches whose columns infer to different Arrow types never clash, and the
+index of each batch is kept. Reading back holds one part at a time plus the
+rows asked for.
+"""
+import os
+import shutil
+from collections import Counter
+from typing import Hashable, Iterable, Iterator, List, Optional, Set
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from upload_cache import arrow_compatible
+
+
+class BatchSpill:
+    """
+    Append-only set of Parquet parts in directory. With key set, the
+    distinct values of that column are remembered per part, so read() only
+    opens the parts holding the keys asked for, and key_rows counts the rows
+    of each value.
+    """
+
+    def __init__(self, directory: str, key: Optional[str] = None):
+        self.directory = directory
+        self.key = key
+        self.parts: List[str] = []
+        self.part_keys: List[Set[Hashable]] = []
+        self.key_rows = Counter()
+        self.rows = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def open(cls, directory: str) -> "BatchSpill":
+        """
+        A spill written by another process, for iter_batches().
+        """
+        spill = cls.__new__(cls)
+        spill.directory, spill.key, spill.part_keys, spill.key_rows = directory, None, [], Counter()
+        spill.parts = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                             if name.endswith(".parquet"))
+        spill.rows = sum(pq.ParquetFile(path).metadata.num_rows for path in spill.parts)
+        return spill
+
+    def append(self, df: pd.DataFrame) -> None:
+        if df.empty:
+            return
+        # Keys are taken after the conversion, as read() will see them
+        df = arrow_compatible(df)
+        path = os.path.join(self.directory, f"{len(self.parts):06d}.parquet")
+        pq.write_table(pa.Table.from_pandas(df), path)
+        self.parts.append(path)
+        if self.key is not None:
+            self.part_keys.append(set(df[self.key].dropna().unique()))
+            self.key_rows.update(df[self.key].value_counts().to_dict())
+        self.rows += len(df)
+
+    def iter_batches(self) -> Iterator[pd.DataFrame]:
+        for path in self.parts:
+            yield pq.read_table(path).to_pandas()
+
+    def read(self, keys: Iterable[Hashable]) -> pd.DataFrame:
+        """
+        The rows whose key column is one of keys, in spill order.
+        """
+        keys = set(keys)
+        frames = []
+        for path, part_keys in zip(self.parts, self.part_keys):
+            if part_keys.isdisjoint(keys):
+                continue
+            df = pq.read_table(path).to_pandas()
+            frames.append(df[df[self.key].isin(keys)])
+        return pd.concat(frames) if frames else pd.DataFrame()
+
+    def remove(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,66 @@
+"""
+Compare the sheet row readers in utils.ROW_READERS on real files.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_readers uploads/pharmacyno_1.xlsx [more files...]
+
+For every file each reader is timed (best of --repeat runs), its rows are
+checked against openpyxl read-only as the reference, and the reader that
+utils.select_reader picks for the file is marked. pd.read_excel, the old
+whole-file path, is included as the baseline.
+"""
+import argparse
+import glob
+import os
+import time
+
+import pandas as pd
+
+from utils import ROW_READERS, select_reader
+
+
+def best_of(repeat, fn):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_file(path, repeat):
+    print(f"\n{path} ({os.path.getsize(path) / 1024:.0f} KB)")
+    reference = list(ROW_READERS["openpyxl"](path)) if not path.lower().endswith((".xls", ".csv")) else None
+    chosen = select_reader(path)
+
+    baseline, _ = best_of(repeat, lambda: pd.read_excel(path, header=None, engine=None))
+    print(f"  {'pd.read_excel':<16}{baseline * 1000:>10.1f} ms{'':>14}  baseline")
+
+    for name, reader in ROW_READERS.items():
+        if name == "csv" or (name in ("openpyxl", "sax") and reference is None):
+            continue
+        if name == "xlrd" and not path.lower().endswith(".xls"):
+            continue
+        elapsed, rows = best_of(repeat, lambda: list(reader(path)))
+        same = "" if reference is None else ("same rows" if rows[:len(reference)] == reference else "ROWS DIFFER")
+        marker = " <- selected" if name == chosen else ""
+        print(f"  {name:<16}{elapsed * 1000:>10.1f} ms{len(rows) / elapsed:>10.0f} r/s  "
+              f"x{baseline / elapsed:<5.1f} {same}{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="Workbooks to read (default: uploads/*.xlsx)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob("uploads/*.xlsx"))
+    print(f"Readers available: {', '.join(ROW_READERS)}")
+    for path in files:
+        bench_file(path, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import threading
+from typing import Dict, List, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SNAPSHOT_DIR = os.path.join("temp", "delta_snapshots")
+KEY_COLUMNS = ["item_code", "item_batch_number"]
+
+
+def snapshot_path(source: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{source}.parquet")
+
+
+class DeltaSnapshot:
+    """
+    Row-hash snapshot of the last successful import of one source, used to
+    skip rows that did not change since then.
+
+    Rows are keyed on item_code and batch number (plus an occurrence counter
+    for keys repeated in the same file) and hashed over the given value
+    columns. filter() returns only new or changed rows; those are recorded
+    with mark() once they were written, so rows whose batch or supplier group
+    failed are retried on the next import. save() replaces the snapshot with
+    the rows of the current file. filter() and mark() may be called from
+    different threads (reader and writer of a pipeline).
+    """
+
+    def __init__(self, source: str, value_columns: List[str], key_columns: List[str] = KEY_COLUMNS,
+                 full: bool = False):
+        self._lock = threading.Lock()
+        self.source = source
+        self.key_columns = list(key_columns)
+        self.value_columns = list(value_columns)
+        # A full import ignores the previous snapshot but still records a new one
+        self.previous: Dict[Tuple[str, str, int], int] = {} if full else self._load()
+        self.current: Dict[Tuple[str, str, int], int] = {}
+        # filter() row number -> (key, row hash) of rows not marked yet
+        self.pending: Dict[int, Tuple[Tuple[str, str, int], int]] = {}
+        self.occurrences: Dict[Tuple[str, str], int] = {}
+        self.total_rows = 0
+        self.changed_rows = 0
+
+    def _load(self) -> Dict[Tuple[str, str, int], int]:
+        path = snapshot_path(self.source)
+        if not os.path.exists(path):
+            return {}
+        df = pq.read_table(path).to_pandas()
+        return dict(zip(zip(df["code"], df["batch"], df["occurrence"]), df["row_hash"]))
+
+    def _keys(self, df: pd.DataFrame) -> List[Tuple[str, str, int]]:
+        codes = df[self.key_columns[0]].astype(str).tolist()
+        batches = df[self.key_columns[1]].astype(str).tolist()
+        keys = []
+        for code, batch in zip(codes, batches):
+            n = self.occurrences.get((code, batch), 0)
+            self.occurrences[(code, batch)] = n + 1
+            keys.append((code, batch, n))
+        return keys
+
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Return the rows of a normalized batch that are new or changed since
+        the last import. The returned frame carries a "_delta_key" column
+        (an integer, so the frame can be spilled to Parquet) used by mark().
+        """
+        keys = self._keys(df)
+        hashes = pd.util.hash_pandas_object(df[self.value_columns].astype(str), index=False).tolist()
+        numbers = range(self.total_rows, self.total_rows + len(df))
+
+        changed = []
+        with self._lock:
+            for number, key, row_hash in zip(numbers, keys, hashes):
+                if self.previous.get(key) == row_hash:
+                    self.current[key] = row_hash
+                    changed.append(False)
+                else:
+                    self.pending[number] = (key, row_hash)
+                    changed.append(True)
+
+        self.total_rows += len(df)
+        df = df.assign(_delta_key=list(numbers))[changed]
+        self.changed_rows += len(df)
+        return df
+
+    def mark(self, df: pd.DataFrame) -> None:
+        """
+        Record the rows of a frame returned by filter() as imported.
+        """
+        with self._lock:
+            for number in df["_delta_key"]:
+                key, row_hash = self.pending.pop(int(number))
+                self.current[key] = row_hash
+
+    def save(self) -> None:
+        """
+        Atomically replace the snapshot of this source.
+        """
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        path = snapshot_path(self.source)
+        keys = list(self.current)
+        table = pa.table({
+            "code": pa.array([k[0] for k in keys], pa.string()),
+            "batch": pa.array([k[1] for k in keys], pa.string()),
+            "occurrence": pa.array([k[2] for k in keys], pa.int64()),
+            "row_hash": pa.array(list(self.current.values()), pa.uint64()),
+        })
+        # A temp file of its own, so concurrent imports of the same source
+        # never write into (or publish) each other's snapshot
+        fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix=os.path.basename(path) + ".", suffix=".tmp")
+        os.close(fd)
+        try:
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @property
+    def skipped_rows(self) -> int:
+        return self.total_rows - self.changed_rows
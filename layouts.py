@@ -0,0 +1,191 @@
+"""
+Declarative descriptions of the vendor spreadsheet layouts.
+
+Each layout lists the columns the importer actually uses, where to find them
+(by position, or by header text for files whose column order varies), the
+dtype they should be parsed into and an optional vectorized converter that
+runs first. The reader only materializes the declared columns.
+"""
+import hashlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from normalization import parse_numeric
+
+# Bump when apply_dtypes changes behaviour so cached parses are not reused.
+PARSER_VERSION = 3
+
+
+def first_code(s: pd.Series) -> pd.Series:
+    """
+    Jarir exports sometimes list several barcodes in one cell; keep the first.
+    """
+    return s.astype(str).str.split(",").str[0].str.strip()
+
+
+@dataclass(frozen=True)
+class Column:
+    name: str
+    position: Optional[int] = None
+    header: Optional[str] = None
+    occurrence: int = 1
+    dtype: Optional[str] = None  # "str", "float", "date" or None to keep values as read
+    converter: Optional[Callable[[pd.Series], pd.Series]] = None
+
+
+@dataclass(frozen=True)
+class Layout:
+    name: str
+    columns: Tuple[Column, ...]
+    header_row: int = 0
+    # Header text expected at each position, checked by pre-flight validation only
+    expected_header: Tuple[str, ...] = ()
+    # Columns that must hold a value on every data row
+    required: Tuple[str, ...] = ()
+
+    @property
+    def column_names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+    @property
+    def numeric_columns(self) -> List[str]:
+        return [c.name for c in self.columns if c.dtype == "float"]
+
+    @property
+    def cache_key(self) -> str:
+        """
+        Layout name plus a fingerprint of its definition, so cached parses
+        are invalidated when a layout changes.
+        """
+        spec = repr([PARSER_VERSION] + [(c.name, c.position, c.header, c.occurrence, c.dtype,
+                      c.converter.__name__ if c.converter else None) for c in self.columns])
+        return f"{self.name}-{hashlib.sha1(spec.encode()).hexdigest()[:8]}"
+
+    def resolve(self, header: list) -> Tuple[List[str], List[int]]:
+        """
+        Map the declared columns to sheet positions, using the header row for
+        columns declared by header text. Raises ValueError when a column
+        cannot be found.
+        """
+        labels = [str(h).strip() if h is not None else None for h in header]
+        names, positions = [], []
+        for col in self.columns:
+            if col.position is not None:
+                position = col.position
+            else:
+                matches = [i for i, label in enumerate(labels) if label == col.header]
+                if len(matches) < col.occurrence:
+                    raise ValueError(f"Column '{col.header}' not found in {self.name} file header")
+                position = matches[col.occurrence - 1]
+            names.append(col.name)
+            positions.append(position)
+        return names, positions
+
+    def apply_dtypes(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Run converters and cast each declared column to its dtype. A column
+        whose values do not all convert is left as read, so downstream
+        validation still sees the original cells; normalization.NumericNormalizer
+        rejects the bad cells later. "date" columns are left as read too; they
+        are normalized per file by normalization.DateNormalizer.
+        """
+        for col in self.columns:
+            s = df[col.name]
+            if col.converter is not None:
+                s = col.converter(s)
+            if col.dtype == "str":
+                s = s.where(s.isna(), s.astype(str))
+            elif col.dtype == "float":
+                converted, bad = parse_numeric(s)
+                if not bad.any():
+                    s = converted
+            df[col.name] = s
+        return df
+
+
+def _positional(name: str, specs: List[Tuple], **kwargs) -> Layout:
+    return Layout(
+        name=name,
+        columns=tuple(Column(n, position=p, **extra) for n, p, extra in specs),
+        **kwargs
+    )
+
+
+STR = {"dtype": "str"}
+FLOAT = {"dtype": "float"}
+DATE = {"dtype": "date"}
+RAW = {}
+
+ABAAD_HEADER = ("Item No.", "Item name", "Patch No.", "Ascon code", "EXPIRY DATE", "Qty", "sp", "TSP",
+                "PP", "TPP", "CP", "TCP", "Vat", "vat value", "total cost")
+ABAAD = _positional("abaad", [
+    ("item_code", 0, RAW),
+    ("item_name", 1, STR),
+    ("item_batch_number", 2, STR),
+    ("item_ascon_code", 3, STR),
+    ("item_expiry_date", 4, DATE),
+    ("item_quantity", 5, FLOAT),
+    ("item_sale_price", 6, FLOAT),
+    ("item_total_sale_price", 7, FLOAT),
+    ("item_purchase_price", 8, FLOAT),
+    ("item_cost_price", 10, FLOAT),
+    ("item_total_cost_price", 11, FLOAT),
+    ("vat_value", 12, FLOAT),
+    ("item_total_vat", 13, FLOAT),
+    ("item_total_after_vat", 14, FLOAT),
+], expected_header=ABAAD_HEADER, required=("item_code", "item_quantity"))
+
+RAWABI = _positional("rawabi", [
+    ("item_code", 0, RAW),
+    ("item_name", 1, STR),
+    ("item_batch_number", 2, STR),
+    ("item_expiry_date", 3, DATE),
+    ("item_quantity", 4, FLOAT),
+    ("item_purchase_price", 5, FLOAT),
+    ("vat_value", 6, FLOAT),
+    ("item_cost_price", 7, FLOAT),
+    ("item_sale_price", 8, FLOAT),
+    ("supplier_id", 9, RAW),
+    ("supplier_name", 10, STR),
+], required=("item_code",))
+
+JARIR_HEADER = ("ProductId", "Product", "StockId", "PackUnits", "Packs", "Units", "SalePrice", "CostPrice",
+                "DealCost", "TotalSale", "TotalCost", "TotalDealCost", "BatchNo", "Expiry", "Branch", "Store",
+                "Supplier", "Category", "Group")
+JARIR = _positional("jarir", [
+    ("item_code", 0, {"dtype": "str", "converter": first_code}),
+    ("item_name", 1, STR),
+    ("item_quantity", 4, FLOAT),
+    ("item_sale_price", 6, FLOAT),
+    ("item_cost_price", 7, FLOAT),
+    ("item_total_sale_price", 9, FLOAT),
+    ("item_total_cost_price", 10, FLOAT),
+    ("item_batch_number", 12, STR),
+    ("item_expiry_date", 13, DATE),
+    ("supplier", 16, STR),
+    ("category", 17, STR),
+    ("group", 18, STR),
+], expected_header=JARIR_HEADER, required=("item_code",))
+
+IMAGES = Layout(name="images", required=("product_code", "image_url"), columns=(
+    Column("product_code", header="product_code", dtype="str"),
+    Column("image_url", header="image_url", dtype="str"),
+))
+
+# Row 1 holds the CREDIT / Cash section titles, row 2 the real headers, where
+# Dis1/Dis2/Dis3 appear twice: first under CREDIT, then under Cash.
+DISCOUNTS = Layout(name="discounts", header_row=1, required=("item_no",), columns=(
+    Column("item_no", header="ITEM_NO", dtype="float"),
+    Column("credit_discount", header="Dis1", occurrence=1, dtype="float"),
+    Column("credit_dis2", header="Dis2", occurrence=1, dtype="float"),
+    Column("credit_dis3", header="Dis3", occurrence=1, dtype="float"),
+    Column("cash_discount", header="Dis1", occurrence=2, dtype="float"),
+    Column("cash_dis2", header="Dis2", occurrence=2, dtype="float"),
+    Column("cash_dis3", header="Dis3", occurrence=2, dtype="float"),
+))
+
+LAYOUTS: Dict[str, Layout] = {
+    layout.name: layout for layout in (ABAAD, RAWABI, JARIR, IMAGES, DISCOUNTS)
+}
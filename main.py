@@ -1,36 +1,98 @@
-from fastapi import FastAPI, File, UploadFile, Request, Form, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, Request, Form, BackgroundTasks, HTTPException
 from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from uuid import uuid4
 import pandas as pd
-import shutil
 import os
-from database import SessionLocal
-from utils import read_excel_file, split_dataframe_in_batches, generate_excel_report
-from services.product_service import get_existing_product_codes, insert_missing_products
-from services.purchase_service import create_purchase
-from services.purchase_rawabi_service import create_rawabi_purchase
+import hashlib
+import shutil
+import zipfile
+import aiofiles
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from database import SessionLocal, get_engine, pool_status, run_transaction
+from utils import read_excel_file, split_dataframe_in_batches, generate_excel_report, extract_workbooks, check_archive, ArchiveTooLarge
+from upload_cache import is_cached, iter_cached_batches
+from layouts import LAYOUTS
+from normalization import DateNormalizer, NumericNormalizer
+from delta_snapshot import DeltaSnapshot
+from batch_spill import BatchSpill
+from parse_workers import prepare_abaad_batch, parse_abaad_workbook
+from preflight import validate_sample
+from pipeline import BatchPipeline
+from commit_policy import GroupCommit
+from batch_sizing import AdaptiveBatcher, READ_CHUNK_ROWS
+from master_data import MASTER_DATA
+from services.product_service import get_existing_product_codes, insert_missing_products, upsert_products
+from services.purchase_service import create_purchase, create_purchase_bulk
+from services.sequence_service import next_reference
+from services.bulk_writer import WriteStats, frame_to_rows
+from services.key_staging import insert_missing
+from services.purchase_rawabi_service import create_rawabi_purchase, create_rawabi_purchases
 from services.report_service import generate_import_report
-from services.image_service import update_product_image, check_product_exists
+from services.image_service import update_product_images
+from services.discount_service import add_discount_columns, discount_rows, update_product_discounts
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from model import Category, Supplier, Product
 from services.supplier_service import get_existing_suppliers, insert_missing_suppliers
 from services.category_service import get_existing_categories, insert_missing_categories
 from services.jarir.purchase_service import create_purchase as jarir_create_purchase
-from sqlalchemy import tuple_
 import sys
+import time
 
 import datetime
-app = FastAPI()
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the master-data index; if the database is not reachable yet it is
+    # loaded on first use instead.
+    session = SessionLocal()
+    try:
+        await run_in_threadpool(MASTER_DATA.load, session)
+        logger.info("Master data loaded: %s", MASTER_DATA.stats())
+    except Exception as e:
+        logger.warning("Master data not loaded at startup: %s", e)
+    finally:
+        session.close()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 EXCEL_FILE = "abaad_files/pharmacyno_1.xlsx"
+# Rows of the first batch; later batches are sized by batch_sizing.AdaptiveBatcher
 BATCH_SIZE = 1000
 
+# Uploads are written in chunks so the event loop keeps serving /status
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 100)) * 1024 * 1024
+# Rough xlsx size of one row, measured on the vendor stock files (~375 bytes)
+UPLOAD_BYTES_PER_ROW = 400
+# Worker processes used to parse the workbooks of a zip upload
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", os.cpu_count() or 1))
+# Product columns overwritten when a product missing by item_code already exists by code.
+# category_id is never overwritten: Abaad files carry no category.
+ABAAD_PRODUCT_UPDATE_COLUMNS = tuple(
+    c for c in os.getenv("ABAAD_PRODUCT_UPDATE_COLUMNS", "name,item_code,cost,price").split(",")
+    if c and c != "category_id"
+)
+RAWABI_PRODUCT_UPDATE_COLUMNS = tuple(c for c in os.getenv("RAWABI_PRODUCT_UPDATE_COLUMNS", "").split(",") if c)
+# Threads writing Rawabi supplier purchases at once, each holding one pooled connection
+RAWABI_PURCHASE_WORKERS = int(os.getenv("RAWABI_PURCHASE_WORKERS", 4))
+# Supplier groups are written in one chunk per worker, split further so no
+# chunk read back from the spill holds more than this many rows
+RAWABI_PURCHASE_CHUNK_ROWS = int(os.getenv("RAWABI_PURCHASE_CHUNK_ROWS", 50000))
+
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs("temp", exist_ok=True)
@@ -39,127 +101,248 @@ os.makedirs("temp", exist_ok=True)
 tasks = {}
 
 
+async def save_upload(file: UploadFile, file_location: str) -> dict:
+    """
+    Stream an upload to disk without blocking the event loop, hashing it and
+    enforcing MAX_UPLOAD_BYTES in the same pass.
+
+    Returns the content hash, the size and an estimated row count.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(file_location, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit"
+                    )
+                digest.update(chunk)
+                await buffer.write(chunk)
+    except BaseException:
+        if os.path.exists(file_location):
+            os.remove(file_location)
+        raise
+
+    return {
+        "content_hash": digest.hexdigest(),
+        "size_bytes": size,
+        "estimated_rows": size // UPLOAD_BYTES_PER_ROW
+    }
+
+
+async def preflight_upload(file_location: str, layout_name: str) -> dict:
+    """
+    Validate a saved upload against its layout before a background task is
+    queued. Bad files are removed and rejected with 422 and the verdict.
+    """
+    verdict = await run_in_threadpool(validate_sample, file_location, LAYOUTS[layout_name])
+    if not verdict["ok"]:
+        os.remove(file_location)
+        raise HTTPException(status_code=422, detail=verdict)
+    return verdict
+
 
 @app.post("/upload")
 async def upload_file(file: UploadFile, background_tasks: BackgroundTasks):
     task_id = str(uuid4())
     file_location = f"temp/{task_id}_{file.filename}"
     
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "abaad")
 
     tasks[task_id] = {
         "status": "processing",
         "logs": ["File received, starting import..."],
-        "report_url": None
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
+    }
+
+    background_tasks.add_task(process_file, task_id, file_location, content_hash)
+    return {"task_id": task_id, "preflight": preflight}
+
+@app.post("/upload_zip")
+async def upload_zip(file: UploadFile, background_tasks: BackgroundTasks):
+    if not file.filename.lower().endswith(".zip"):
+        raise HTTPException(status_code=400, detail="Expected a .zip archive of Abaad workbooks")
+
+    task_id = str(uuid4())
+    file_location = f"temp/{task_id}_{file.filename}"
+
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    try:
+        await run_in_threadpool(check_archive, file_location)
+    except ArchiveTooLarge as e:
+        os.remove(file_location)
+        raise HTTPException(status_code=413, detail=str(e))
+    except zipfile.BadZipFile:
+        os.remove(file_location)
+        raise HTTPException(status_code=400, detail="Not a valid .zip archive")
+
+    tasks[task_id] = {
+        "status": "processing",
+        "logs": ["Archive received, starting import..."],
+        "report_url": None,
+        "upload": upload,
+        "subtasks": [],
+        "progress": {}
     }
 
-    background_tasks.add_task(process_file, task_id, file_location)
+    background_tasks.add_task(process_archive, task_id, file_location, content_hash)
     return {"task_id": task_id}
 
 @app.post("/upload_rawabi_products")
-async def upload_file(file: UploadFile, background_tasks: BackgroundTasks):
+async def upload_file(file: UploadFile, background_tasks: BackgroundTasks, full_import: bool = False):
     task_id = str(uuid4())
     file_location = f"temp/{task_id}_{file.filename}"
     
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "rawabi")
 
     tasks[task_id] = {
         "status": "processing",
         "logs": ["File received, starting import..."],
-        "report_url": None
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
     }
 
-    background_tasks.add_task(rawabi_products_process_file, task_id, file_location)
-    return {"task_id": task_id}
+    background_tasks.add_task(rawabi_products_process_file, task_id, file_location, content_hash, full_import)
+    return {"task_id": task_id, "preflight": preflight}
 
 @app.post("/rawabi_inventory_file")
-async def upload_file(file: UploadFile, background_tasks: BackgroundTasks):
+async def upload_file(file: UploadFile, background_tasks: BackgroundTasks, full_import: bool = False):
     task_id = str(uuid4())
     file_location = f"temp/{task_id}_{file.filename}"
     
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "rawabi")
 
     tasks[task_id] = {
         "status": "processing",
         "logs": ["File received, starting import..."],
-        "report_url": None
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
     }
 
-    background_tasks.add_task(rawabi_inventory_process_file, task_id, file_location)
-    return {"task_id": task_id}
+    background_tasks.add_task(rawabi_inventory_process_file, task_id, file_location, content_hash, full_import)
+    return {"task_id": task_id, "preflight": preflight}
 
 @app.post("/upload_jarir")
 async def upload_file(file: UploadFile, background_tasks: BackgroundTasks):
     task_id = str(uuid4())
     file_location = f"temp/{task_id}_{file.filename}"
     
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "jarir")
 
     tasks[task_id] = {
         "status": "processing",
         "logs": ["File received, starting import..."],
-        "report_url": None
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
     }
 
-    background_tasks.add_task(jarir_process_file, task_id, file_location)
-    return {"task_id": task_id}
+    background_tasks.add_task(jarir_process_file, task_id, file_location, content_hash)
+    return {"task_id": task_id, "preflight": preflight}
 
 @app.post("/upload_jarir_metadata")
 async def upload_file(file: UploadFile, background_tasks: BackgroundTasks):
     task_id = str(uuid4())
     file_location = f"temp/{task_id}_{file.filename}"
     
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "jarir")
 
     tasks[task_id] = {
         "status": "processing",
         "logs": ["File received, starting import..."],
-        "report_url": None
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
     }
 
-    background_tasks.add_task(upload_jarir_metadata, task_id, file_location)
-    return {"task_id": task_id}
+    background_tasks.add_task(upload_jarir_metadata, task_id, file_location, content_hash)
+    return {"task_id": task_id, "preflight": preflight}
 
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
     return tasks.get(task_id, {"status": "not_found", "logs": []})
 
+@app.get("/master_data/stats")
+async def master_data_stats():
+    return MASTER_DATA.stats()
+
+@app.get("/db/pool")
+async def db_pool_stats():
+    return pool_status()
+
 def log_step(task_id, message):
     tasks[task_id]["logs"].append(message)
 
-def log_product_comparison(task_id, session, item_code, excel_row):
+def stream_batches(task_id, file_path, layout_name, content_hash=None, batcher=None):
+    """
+    Stream parsed batches for a file using the named vendor layout, reusing
+    the parse cache when the same content was already imported with it.
+    With a batcher the file is read in small chunks and re-cut to the
+    batcher's current size.
+    """
+    layout = LAYOUTS[layout_name]
+    if is_cached(layout, content_hash):
+        log_step(task_id, "⚡ Same file was parsed before, loading batches from cache...")
+    if batcher is None:
+        return iter_cached_batches(file_path, layout, BATCH_SIZE, content_hash)
+    return batcher.batches(iter_cached_batches(file_path, layout, READ_CHUNK_ROWS, content_hash))
+
+def batch_sizer(task_id):
+    return AdaptiveBatcher(BATCH_SIZE, log=lambda message: log_step(task_id, message))
+
+def log_rejected_rows(task_id, errors, description, action, limit=20):
+    """
+    Report rows rejected by a normalization stage, once per file.
+    Each error is (row index, *details).
+    """
+    if not errors:
+        return
+    log_step(task_id, f"⚠️ {len(errors)} {description} were {action}:")
+    for idx, *details in errors[:limit]:
+        log_step(task_id, f"   Row {idx + 2}: " + " = ".join(f"{d}" for d in details))
+    if len(errors) > limit:
+        log_step(task_id, f"   ... and {len(errors) - limit} more")
+
+def log_product_comparison(task_id, db_product, item_code, excel_row):
     """
     Compare and log differences between Excel data and database for existing products.
     
     Args:
         task_id: Task ID for logging
-        session: Database session
+        db_product: The product's master-data index entry (id, cost, price, tax_rate)
         item_code: Product code to check
         excel_row: Row from Excel file containing product data
     """
-    db_product = session.query(Product).filter(Product.code == item_code).first()
-    
-    if db_product:
-        log_step(task_id, f"📋 Product {item_code} already exists - Comparison:")
-        log_step(task_id, f"   Excel: name='{excel_row['item_name']}', cost_price={excel_row['item_cost_price']}")
-        log_step(task_id, f"   DB: name='{db_product.name}', cost={db_product.cost}")
+    log_step(task_id, f"📋 Product {item_code} already exists - Comparison:")
+    log_step(task_id, f"   Excel: name='{excel_row['item_name']}', cost_price={excel_row['item_cost_price']}")
+    log_step(task_id, f"   DB: id={db_product.id}, cost={db_product.cost}, price={db_product.price}")
 
 ## RAWABI MASTER DATA
-def rawabi_products_process_file(task_id: str, file_path: str):
+def rawabi_products_process_file(task_id: str, file_path: str, content_hash: str = None, full_import: bool = False):
     try:
         start_time = datetime.datetime.now()
         log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         
         # Step 1: Read Excel
-        log_step(task_id, "Step 1: Reading Excel file...")
-        df = pd.read_excel(file_path, header=None)
-        df = df.iloc[1:].reset_index(drop=True)  # skip header row manually
-        df = df.dropna(how='all')
+        log_step(task_id, "Step 1: Streaming Excel file in batches...")
 
         # Assign expected column names (position-based)
         # df.columns = [
@@ -177,55 +360,61 @@ def rawabi_products_process_file(task_id: str, file_path: str):
         # })
 
 
-        df.columns = [
-            "item_code", "item_name", "item_batch_number",  "item_expiry_date",
-            "item_quantity",  "item_purchase_price", "vat_value",  "item_cost_price","item_sale_price", 
-            "supplier_id", "supplier_name"
-        ]
-
-        # Replace NaN values with 0 for numeric columns to avoid MySQL errors
-        df["item_cost_price"] = df["item_cost_price"].fillna(0)
-        df["item_sale_price"] = df["item_sale_price"].fillna(0)
-
-        df = df.drop_duplicates(subset=['item_code'], keep='first').reset_index(drop=True)
 
-        log_step(task_id, f"✅ Removed duplicates. {len(df)} unique items remaining.")
-
-        log_step(task_id, f"📄 Loaded {len(df)} rows from file.")
-
-        # Step 2: Split into batches
-        log_step(task_id, "Step 2: Splitting file into batches...")
-        batches = split_dataframe_in_batches(df, BATCH_SIZE)
-
-        # Step 3: Process each batch
-        for i, batch_df in enumerate(batches):
-            session = SessionLocal()
+        # Codes already handled in earlier batches; replaces the whole-file drop_duplicates
+        seen_codes = set()
+        total_rows = 0
+        numbers = NumericNormalizer(["item_cost_price", "item_sale_price"])
+        delta = DeltaSnapshot("rawabi_products", ["item_name", "item_cost_price", "item_sale_price"], full=full_import)
+
+        def prepare(batch_df):
+            nonlocal total_rows
+            batch_df = batch_df.dropna(how='all')
+            batch_df, invalid_numbers = numbers.normalize(batch_df)
+            batch_df = batch_df[~invalid_numbers]
+
+            # Replace NaN values with 0 for numeric columns to avoid MySQL errors
+            batch_df["item_cost_price"] = batch_df["item_cost_price"].fillna(0)
+            batch_df["item_sale_price"] = batch_df["item_sale_price"].fillna(0)
+            total_rows += len(batch_df)
+
+            # Delta import: rows identical to the last import of this source are skipped
+            batch_df = delta.filter(batch_df)
+            return None if batch_df.empty else batch_df
+
+        # Step 2: Process each batch as it is streamed; the next one is
+        # prepared while this one is written
+        log_step(task_id, "Step 2: Processing batches...")
+        batcher = batch_sizer(task_id)
+        pipeline = BatchPipeline(stream_batches(task_id, file_path, "rawabi", content_hash, batcher), prepare)
+        commits = GroupCommit()
+        for i, batch_df in enumerate(commits.batches(pipeline)):
+            batcher.begin(commits.session)
+            session = commits.begin_batch()
             try:
-                log_step(task_id, f"➡️ Processing batch {i + 1}/{len(batches)}...")
+                log_step(task_id, f"➡️ Processing batch {i + 1}...")
 
                 # 1. Get unique codes from this batch (clean up NaNs)
-                batch_codes = batch_df['item_code'].dropna().unique().tolist()
+                batch_codes = [str(int(code)) for code in batch_df['item_code'].dropna().unique()]
                 
-                # 2. Query DB once to find which of these codes ALREADY exist
-                existing_codes = session.query(Product.code).filter(Product.code.in_(batch_codes)).all()
-                existing_codes_set = {c[0] for c in existing_codes}
+                # 2. Find which of these codes ALREADY exist (master-data index, DB only on misses)
+                existing_products = MASTER_DATA.products(session, batch_codes, key="code")
 
                 records = []
-                seen_in_this_batch = set() # To prevent duplicates if the same code repeats in this batch
 
                 for _, row in batch_df.iterrows():
                     item_code = str(int(row['item_code'])) if pd.notna(row['item_code']) else None
                     
-                    # Skip if NaN, already in DB, or already processed in this specific batch loop
-                    if item_code is None or item_code in seen_in_this_batch:
+                    # Skip if NaN or already processed in this or an earlier batch
+                    if item_code is None or item_code in seen_codes:
                         continue
+                    seen_codes.add(item_code)
                     
                     # Check if already exists in DB and log comparison
-                    if item_code in existing_codes_set:
-                        log_product_comparison(task_id, session, item_code, row)
-                        continue
+                    if item_code in existing_products:
+                        log_product_comparison(task_id, existing_products[item_code], item_code, row)
 
-                    # Add to the insert list
+                    # Add to the upsert list
                     records.append({
                         "name_ar": row["item_name"],
                         "name": row["item_name"], 
@@ -234,28 +423,36 @@ def rawabi_products_process_file(task_id: str, file_path: str):
                         "price" : row["item_sale_price"],
                         "tax_rate": 5
                     })
-                    
-                    # Mark as seen so if it appears again in the same batch, it's skipped
-                    seen_in_this_batch.add(item_code)
-
-                # 3. Bulk insert only the truly new records
-                if records:
-                    session.bulk_insert_mappings(Product, records)
-                    session.commit()
-                    log_step(task_id, f"✅ Batch {i + 1} done: {len(records)} new items added.")
+
+                # 3. One upsert for the batch: new codes are inserted, existing ones only
+                #    get RAWABI_PRODUCT_UPDATE_COLUMNS overwritten
+                counts = upsert_products(session, records, RAWABI_PRODUCT_UPDATE_COLUMNS)
+                commits.on_commit(lambda batch_df=batch_df: delta.mark(batch_df))
+                commits.end_batch()
+                if counts["inserted"] or counts["updated"]:
+                    log_step(task_id, f"✅ Batch {i + 1} done: {counts['inserted']} new items added, "
+                                      f"{counts['updated']} updated, {counts['unchanged']} unchanged.")
                 else:
                     log_step(task_id, f"ℹ️ Batch {i + 1}: No new records to insert.")
 
             except Exception as e:
-                session.rollback()
+                commits.rollback_batch()
                 log_step(task_id, f"❌ Error in batch {i + 1}: {str(e)}")
             finally:
-                session.close()
+                batcher.end(len(batch_df), commits.session)
 
         # Step 4: Final summary
         end_time = datetime.datetime.now()
         total_duration = end_time - start_time
 
+        log_step(task_id, f"📄 Loaded {total_rows} rows from file, {len(seen_codes)} unique items.")
+        log_step(task_id, f"🔁 Delta import: {delta.changed_rows} new or changed rows, {delta.skipped_rows} unchanged rows skipped.")
+        log_rejected_rows(task_id, numbers.errors, "non-numeric prices", "skipped")
+        for line in pipeline.summary():
+            log_step(task_id, f"📊 Pipeline {line}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
+        delta.save()
         log_step(task_id, "Step 3: All batches processed successfully.")
         log_step(task_id, f"📅 End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
         log_step(task_id, f"⏱️ Total Duration: {total_duration}")
@@ -357,59 +554,117 @@ def rawabi_inventory_process_file_old(task_id: str, file_path: str):
 
 
 
-def rawabi_inventory_process_file(task_id: str, file_path: str):
+def rawabi_inventory_process_file(task_id: str, file_path: str, content_hash: str = None, full_import: bool = False):
+    spill = None
     try:
         created_purchase_ids = []
         start_time = datetime.datetime.now()
         log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         
         # --- Step 1: Data Preparation ---
-        df = pd.read_excel(file_path, header=None)
-        df = df.iloc[1:].reset_index(drop=True)
-        
-        df.columns = [
-            "item_code", "item_name", "item_batch_number", "item_expiry_date",
-            "item_quantity", "item_purchase_price", "vat_value", 
-            "item_cost_price", "item_sale_price", "supplier_id", "supplier_name"
-        ]
-
-        # Critical Validation: Remove rows with null item_code
-        initial_count = len(df)
-        df = df.dropna(subset=['item_code'])
-        if len(df) < initial_count:
-            log_step(task_id, f"⚠️ Dropped {initial_count - len(df)} rows due to missing item_code.")
-
-        # Vectorized Calculations (Faster than loops)
-        df["item_total_sale_price"] = df["item_sale_price"] * df["item_quantity"]
-        df["total_sale_vat"] = df["item_total_sale_price"] * df["vat_value"]
-        df["total_sale"] = df["item_total_sale_price"] + df["total_sale_vat"]
-        
-        df["item_total_cost_price"] = df["item_cost_price"] * df["item_quantity"]
-        df["item_total_vat"] = (df["item_total_cost_price"] * df["vat_value"]) / 100
-        df["item_total_after_vat"] = df["item_total_cost_price"] + df["item_total_vat"]
-        df["item_batch_number"] = df["item_batch_number"].fillna('AAA')
-        df["item_name"] = df["item_name"].fillna('empty product')
 
-        # --- Step 2: Ensure Products Exist (The Runtime Check) ---
-        sync_products_in_db(task_id, df)
+        # Purchases are grouped per supplier across the whole file: products
+        # are synced batch by batch and the prepared batches are spilled to
+        # Parquet, so only the supplier groups being written are in memory.
+        spill = BatchSpill(os.path.join("temp", f"{task_id}_rawabi_inventory"), key="supplier_id")
+        dropped_count = 0
+        expiry_dates = DateNormalizer()
+        numbers = NumericNormalizer(LAYOUTS["rawabi"].numeric_columns)
+        value_columns = [c for c in LAYOUTS["rawabi"].column_names if c not in ("item_code", "item_batch_number")]
+        delta = DeltaSnapshot("rawabi_inventory", value_columns, full=full_import)
+
+        def prepare(batch_df):
+            nonlocal dropped_count
+            # Critical Validation: Remove rows with null item_code
+            initial_count = len(batch_df)
+            batch_df = batch_df.dropna(subset=['item_code'])
+            dropped_count += initial_count - len(batch_df)
+
+            batch_df["item_expiry_date"], _ = expiry_dates.normalize(batch_df["item_expiry_date"])
+            batch_df, invalid_numbers = numbers.normalize(batch_df)
+            batch_df = batch_df[~invalid_numbers]
+
+            # Delta import: rows identical to the last import of this source are skipped
+            batch_df = delta.filter(batch_df)
+            if batch_df.empty:
+                return None
+
+            # Vectorized Calculations (Faster than loops)
+            batch_df["item_total_sale_price"] = batch_df["item_sale_price"] * batch_df["item_quantity"]
+            batch_df["total_sale_vat"] = batch_df["item_total_sale_price"] * batch_df["vat_value"]
+            batch_df["total_sale"] = batch_df["item_total_sale_price"] + batch_df["total_sale_vat"]
+
+            batch_df["item_total_cost_price"] = batch_df["item_cost_price"] * batch_df["item_quantity"]
+            batch_df["item_total_vat"] = (batch_df["item_total_cost_price"] * batch_df["vat_value"]) / 100
+            batch_df["item_total_after_vat"] = batch_df["item_total_cost_price"] + batch_df["item_total_vat"]
+            batch_df["item_batch_number"] = batch_df["item_batch_number"].fillna('AAA')
+            batch_df["item_name"] = batch_df["item_name"].fillna('empty product')
+            return batch_df
+
+        # The next batch is prepared while the products of this one are synced
+        batcher = batch_sizer(task_id)
+        pipeline = BatchPipeline(stream_batches(task_id, file_path, "rawabi", content_hash, batcher), prepare)
+        # The supplier purchases below run in their own sessions, so every
+        # product must be committed when this loop ends
+        commits = GroupCommit()
+        for batch_df in commits.batches(pipeline):
+            # --- Step 2: Ensure Products Exist (The Runtime Check) ---
+            with batcher.measure(len(batch_df), commits.session):
+                sync_products_in_db(task_id, batch_df, commits.begin_batch())
+                commits.end_batch()
+            spill.append(batch_df)
+        for line in pipeline.summary():
+            log_step(task_id, f"📊 Pipeline {line}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
+
+        if dropped_count:
+            log_step(task_id, f"⚠️ Dropped {dropped_count} rows due to missing item_code.")
+        log_rejected_rows(task_id, expiry_dates.errors, "unparseable expiry dates", "imported without an expiry date")
+        log_rejected_rows(task_id, numbers.errors, "non-numeric cells", "skipped")
+        log_step(task_id, f"🔁 Delta import: {delta.changed_rows} new or changed rows, {delta.skipped_rows} unchanged rows skipped.")
 
         # --- Step 3: Group by Supplier & Create Orders ---
-        grouped = df.groupby("supplier_id")
-        for supplier_id, supplier_df in grouped:
-            session = SessionLocal()
-            try:
-                # Pass the cleaned dataframe to your purchase creation logic
-                result = create_rawabi_purchase(session, supplier_df)
-                if result.get("purchase_id"):
-                    created_purchase_ids.append(result["purchase_id"])
-                
-                session.commit()
-                log_step(task_id, f"✅ Purchase created for supplier {supplier_id}")
-            except Exception as e:
-                session.rollback()
-                log_step(task_id, f"❌ Error for supplier {supplier_id}: {str(e)}")
-            finally:
-                session.close()
+        # The supplier groups are split into chunks, each read back from the
+        # spill and written by create_rawabi_purchases (headers of the chunk in
+        # one multi-row INSERT) and committed in its own session on a bounded
+        # thread pool. A failing chunk rolls back all of its suppliers.
+        chunks = supplier_chunks(spill.key_rows, RAWABI_PURCHASE_WORKERS, RAWABI_PURCHASE_CHUNK_ROWS)
+        suppliers = len(spill.key_rows)
+        workers = max(1, min(RAWABI_PURCHASE_WORKERS, len(chunks)))
+        log_step(task_id, f"Step 3: Creating purchases for {suppliers} suppliers in {len(chunks)} chunks "
+                          f"with {workers} workers...")
+        write_stats = WriteStats()
+        step_start = time.perf_counter()
+        group_seconds = 0.0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(create_supplier_purchases, spill, chunk, write_stats): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    purchase_ids, delta_keys, attempts, seconds = future.result()
+                except Exception as e:
+                    log_step(task_id, f"❌ Error for suppliers {', '.join(map(str, chunk))}: {str(e)}")
+                    continue
+                group_seconds += seconds
+                created_purchase_ids.extend(purchase_ids.values())
+                delta.mark(delta_keys)
+                retried = f" after {attempts} attempts" if attempts > 1 else ""
+                log_step(task_id, f"✅ {len(purchase_ids)} purchases created for suppliers "
+                                  f"{', '.join(map(str, purchase_ids))}: {len(delta_keys)} items "
+                                  f"in {seconds:.2f}s{retried}")
+        elapsed = time.perf_counter() - step_start
+        log_step(task_id, f"⏱️ {len(created_purchase_ids)}/{suppliers} purchases in {elapsed:.2f}s "
+                          f"({group_seconds:.2f}s of group work)")
+        for line in write_stats.summary():
+            log_step(task_id, f"⚡ Item writes, {line}")
+        created_purchase_ids.sort()
+
+        # Rows of failed supplier groups are not marked, so they are retried next time
+        delta.save()
 
         # Finalize
         generate_excel_report(task_id, created_purchase_ids) # Pass IDs, let function open own session
@@ -420,169 +675,329 @@ def rawabi_inventory_process_file(task_id: str, file_path: str):
     except Exception as e:
         tasks[task_id]["status"] = "failed"
         log_step(task_id, f"❌ Critical Error: {str(e)}")
+    finally:
+        if spill is not None:
+            spill.remove()
 
-def sync_products_in_db(task_id, df):
-    """Checks all codes in DF, inserts missing ones into the products table."""
-    session = SessionLocal()
+def supplier_chunks(supplier_rows, workers, max_rows):
+    """
+    Split supplier ids (with their row counts) into consecutive chunks of
+    about equal rows: one per worker, or more when a chunk would exceed
+    max_rows. A single supplier larger than that is a chunk of its own.
+    """
+    total = sum(supplier_rows.values())
+    count = max(workers, -(-total // max(max_rows, 1)))
+    target = total / max(count, 1)
+    chunks, chunk, rows = [], [], 0
+    for supplier_id in sorted(supplier_rows):
+        if chunk and rows + supplier_rows[supplier_id] > target:
+            chunks.append(chunk)
+            chunk, rows = [], 0
+        chunk.append(supplier_id)
+        rows += supplier_rows[supplier_id]
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def create_supplier_purchases(spill, supplier_ids, write_stats=None):
+    """
+    Read a chunk of supplier groups back from the spill, then create and
+    commit their purchases in one session, rerunning on deadlocks. Only the
+    write stats of the attempt that committed are added to write_stats.
+    Returns (supplier_id -> purchase_id, the chunk's _delta_key rows,
+    attempts, seconds).
+    """
+    start = time.perf_counter()
+    chunk_df = spill.read(supplier_ids)
+
+    def attempt(session):
+        stats = WriteStats()
+        return create_rawabi_purchases(session, chunk_df, stats), stats
+
+    (purchase_ids, stats), attempts = run_transaction(attempt)
+    if write_stats is not None:
+        write_stats.merge(stats)
+    return purchase_ids, chunk_df[["_delta_key"]], attempts, time.perf_counter() - start
+
+def sync_products_in_db(task_id, df, session):
+    """Checks all codes in DF, inserts missing ones into the products table (does not commit)."""
+    codes = df['item_code'].astype(str)
+
+    # Codes the master-data index already knows need no round trip at all
+    known = MASTER_DATA.products(session, codes.unique().tolist(), key="code")
+    new_rows = df[~codes.isin(known)]
+    if new_rows.empty:
+        return
+
+    # The rest are staged server-side and inserted with INSERT ... SELECT ... WHERE NOT EXISTS
+    new_products = pd.DataFrame({
+        "code": new_rows['item_code'].astype(str),
+        "name": new_rows["item_name"],
+        "name_ar": new_rows["item_name"],
+        "tax_rate": new_rows["vat_value"]
+    }).drop_duplicates(subset=["code"])
+    inserted = insert_missing(session, Product.__table__, ["code"], frame_to_rows(new_products))
+    if inserted:
+        log_step(task_id, f"🆕 Registered {inserted} new products in database.")
+
+
+
+def import_abaad_batch(task_id, i, batch_df, product_ids, commits, write_stats=None):
+    """
+    Insert or update the missing products of one prepared Abaad batch and
+    create its purchase, as one savepoint of commits (a GroupCommit).
+    Errors are logged and rolled back per batch. product_ids is the task's
+    item_code -> id map, completed here so the purchase writer does not
+    query products; write_stats collects the item and movement write times.
+    Returns the created purchase id, or None.
+    """
+    session = commits.begin_batch()
     try:
-        unique_codes = df['item_code'].unique().tolist()
-        
-        # Find which codes already exist
-        existing_codes = session.query(Product.code).filter(Product.code.in_(unique_codes)).all()
-        existing_codes_set = {c[0] for c in existing_codes}
-
-        new_products = []
-        seen_in_df = set()
-
-        for _, row in df.iterrows():
-            code = str(row['item_code'])
-            if code not in existing_codes_set and code not in seen_in_df:
-                new_products.append({
-                    "code": code,
-                    "name": row["item_name"],
-                    "name_ar": row["item_name"],
-                    "tax_rate": row["vat_value"]
-                })
-                seen_in_df.add(code)
-
-        if new_products:
-            session.bulk_insert_mappings(Product, new_products)
-            session.commit()
-            log_step(task_id, f"🆕 Registered {len(new_products)} new products in database.")
-    finally:
-        session.close()
+        log_step(task_id, f"➡️ Processing batch {i + 1}...")
+
+        # Reserved before the batch writes anything (see services.sequence_service)
+        ref_no = next_reference(session)
+
+        product_codes = batch_df["item_code"].unique().tolist()
+        existing_codes = get_existing_product_codes(session, product_codes, product_ids)
+
+        log_step(task_id, f"➡️ Upserting missing products ...")
+
+        # products_to_insert = missing_products.apply(lambda row: {
+        #     "name": row["item_name"],
+        #     "item_code": row["item_code"],
+        #     "category_id": row.get("item_code", 3),
+        #     "cost_price": row["item_cost_price"],
+        #     "sale_price": row["item_sale_price"],
+        #     "tax_rate" : 1
+        # }, axis=1).tolist()
+
+        # log_step(task_id, f"➡️ Insert missing products...")
+
+        # insert_missing_products(session, products_to_insert)
+
+        # One upsert for the products missing by item_code: new codes are inserted,
+        # a product that exists by code only gets ABAAD_PRODUCT_UPDATE_COLUMNS overwritten
+        products = batch_df[~batch_df["item_code"].astype(str).isin(existing_codes)]
+        products = products.drop_duplicates(subset=["item_code"], keep="last")
+        codes = products["item_code"].astype(str)
+        counts = upsert_products(session, frame_to_rows(pd.DataFrame({
+            "name": products["item_name"],
+            "item_code": codes,
+            "code": codes,
+            "category_id": products["item_code"],
+            "cost": products["item_cost_price"],
+            "price": products["item_sale_price"],
+            "tax_rate": 1,
+        })), ABAAD_PRODUCT_UPDATE_COLUMNS)
+        # New products reach the index (and the task's map) through its id watermark
+        get_existing_product_codes(session, codes.tolist(), product_ids)
+        log_step(task_id, f"✅ Batch {i + 1} products: {counts['inserted']} inserted, {counts['updated']} updated, "
+                          f"{counts['unchanged']} unchanged.")
+
+        log_step(task_id, f"➡️ Fetching product VAT info and create batch")
+
+        # Step 2: products with their VAT rate (tax_rate) are in the master-data index
+
+          # Convert to dict: {item_code: vat_rate}
+        #vat_map = {p.item_code: p.tax_rate for p in products}
+        # def calc_vat(row):
+        #     tax_rate = vat_map.get(row["item_code"], 0) or 0
+        #     # business rule: if tax_rate == 5 → VAT = 15%, else 0
+        #     vat_rate = 0.15 if tax_rate == 5 else 1
+        #     vat_value = row["item_total_cost_price"] * vat_rate
+        #     total_after_vat = row["item_total_cost_price"] + vat_value
+
+        #      # df["total_sale_vat"] = df["item_total_sale_price"] * df["vat_value"]
+        #      # df["total_sale"] = df["item_total_sale_price"] + df["total_sale_vat"]
+        #     total_sale_vat = row["item_total_sale_price"] * vat_rate
+        #     total_sale = row["item_total_sale_price"] + total_sale_vat
+
+        #     return pd.Series({
+        #         "vat_value": 15 if tax_rate == 5 else 0,
+        #         "item_total_vat": vat_value,  # same as vat_value per row
+        #         "item_total_after_vat": total_after_vat,
+        #         "total_sale_vat" : total_sale_vat,
+        #         "total_sale" : total_sale
+        #     })
+
+        # batch_df[["vat_value", "item_total_vat", "item_total_after_vat", "total_sale_vat","total_sale"]] = batch_df.apply(calc_vat, axis=1)
+
+
+        log_step(task_id, f"➡️ Create Purchase and Make transfer {i + 1}...")
+
+        result = create_purchase_bulk(session, batch_df, product_ids, write_stats, ref_no)
+        commits.end_batch()
+
+        # if result.get("transfer_id"):
+        #     created_transfer_ids.append(result["transfer_id"])
+
+
+        log_step(task_id, f"✅ Batch {i + 1} inserted successfully.")
+        return result.get("purchase_id")
+    except Exception as e:
+        commits.rollback_batch()
+        log_step(task_id, f"❌ Error in batch {i + 1}: {str(e)}")
 
 
+def process_archive(task_id: str, file_path: str, content_hash: str = None):
+    """
+    Import every Abaad workbook of a zip archive.
 
-def process_file(task_id: str, file_path: str):
+    Workbooks are parsed and normalized in a process pool that spills the
+    prepared batches to Parquet; each one becomes a sub-task ("<task_id>-<n>",
+    visible through /status) that is streamed from its spill and written to
+    the database as soon as its parse finishes, while the others keep parsing.
+    Progress and the purchase report are aggregated on the parent task.
+    """
     try:
         created_purchase_ids = []
-        created_transfer_ids = []
         start_time = datetime.datetime.now()
         log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        
-        log_step(task_id, "Step 1: Reading Excel file...")
-        df = pd.read_excel(file_path, header=None)
-        df = df.iloc[1:].reset_index(drop=True)
-
-        df.columns = [
-            "item_code", "item_name", "item_batch_number", "item_ascon_code", "item_expiry_date",
-            "item_quantity", "item_sale_price", "item_total_sale_price",
-            "item_purchase_price", "item_total_purchase_price",
-            "item_cost_price", "item_total_cost_price",
-            "vat_value", "item_total_vat", "item_total_after_vat"
-        ]
 
-        df["total_sale_vat"] = df["item_total_sale_price"] * df["vat_value"]
-        df["total_sale"] = df["item_total_sale_price"] + df["total_sale_vat"]
-
-        log_step(task_id, "Step 2: Splitting file into batches...")
-        batches = split_dataframe_in_batches(df, BATCH_SIZE)
-
-        for i, batch_df in enumerate(batches):
-            session = SessionLocal()
-            try:
-                log_step(task_id, f"➡️ Processing batch {i + 1}...")
-
-                product_codes = batch_df["item_code"].unique().tolist()
-                print(product_codes)
-                existing_codes = get_existing_product_codes(session, product_codes)
+        log_step(task_id, "Step 1: Extracting workbooks...")
+        files = extract_workbooks(file_path, os.path.join("temp", task_id))
+        if not files:
+            raise ValueError("No workbooks found in the archive")
+
+        subtasks = {}
+        for n, path in enumerate(files, start=1):
+            sub_id = f"{task_id}-{n}"
+            tasks[sub_id] = {
+                "status": "parsing",
+                "logs": [f"Queued from archive as {os.path.basename(path)}"],
+                "report_url": None,
+                "parent": task_id,
+                "purchase_ids": []
+            }
+            subtasks[path] = sub_id
+        tasks[task_id]["subtasks"] = list(subtasks.values())
+        progress = tasks[task_id]["progress"]
+        progress.update({"files": len(files), "parsed": 0, "imported": 0, "failed": 0, "rows": 0})
+
+        # Pre-flight every workbook so bad ones never take a worker slot
+        accepted = []
+        for path in files:
+            sub_id = subtasks[path]
+            verdict = validate_sample(path, LAYOUTS["abaad"])
+            tasks[sub_id]["preflight"] = verdict
+            if verdict["ok"]:
+                accepted.append(path)
+                continue
+            tasks[sub_id]["status"] = "failed"
+            for error in verdict["errors"]:
+                log_step(sub_id, f"❌ Pre-flight: {error}")
+            progress["failed"] += 1
+            log_step(task_id, f"❌ {os.path.basename(path)} rejected: {'; '.join(verdict['errors'])}")
+
+        product_ids = {}  # item_code -> id, shared by all workbooks of the archive
+        write_stats = WriteStats()
+        batcher = batch_sizer(task_id)
+        workers = max(1, min(IMPORT_WORKERS, len(accepted)))
+        log_step(task_id, f"Step 2: Parsing {len(accepted)} workbooks with {workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(parse_abaad_workbook, path, BATCH_SIZE, f"{path}.parts"): path for path in accepted}
+            for future in as_completed(futures):
+                path = futures[future]
+                sub_id = subtasks[path]
+                name = os.path.basename(path)
+                try:
+                    parsed = future.result()
+                except Exception as e:
+                    shutil.rmtree(f"{path}.parts", ignore_errors=True)
+                    tasks[sub_id]["status"] = "failed"
+                    log_step(sub_id, f"❌ Parse error: {str(e)}")
+                    progress["failed"] += 1
+                    log_step(task_id, f"❌ {name}: {str(e)}")
+                    continue
+
+                progress["parsed"] += 1
+                progress["rows"] += parsed["rows"]
+                tasks[sub_id]["status"] = "processing"
+                log_step(sub_id, f"✅ Parsed {parsed['rows']} rows in {parsed['seconds']:.2f}s.")
+
+                # Each workbook is its own commit group
+                commits = GroupCommit()
+                commits.track(product_ids)
+                spill = BatchSpill.open(parsed["spill_dir"])
+                try:
+                    for i, batch_df in enumerate(commits.batches(batcher.batches(spill.iter_batches()))):
+                        with batcher.measure(len(batch_df), commits.session):
+                            purchase_id = import_abaad_batch(sub_id, i, batch_df, product_ids, commits, write_stats)
+                        if purchase_id:
+                            commits.on_commit(lambda purchase_id=purchase_id: tasks[sub_id]["purchase_ids"].append(purchase_id))
+                finally:
+                    spill.remove()
+                log_step(sub_id, f"💾 Commits: {commits.summary()}")
+                log_rejected_rows(sub_id, parsed["date_errors"], "unparseable expiry dates", "skipped")
+                log_rejected_rows(sub_id, parsed["numeric_errors"], "non-numeric cells", "skipped")
+
+                created_purchase_ids.extend(tasks[sub_id]["purchase_ids"])
+                tasks[sub_id]["status"] = "completed"
+                log_step(sub_id, "✅ Import completed successfully.")
+                progress["imported"] += 1
+                log_step(task_id, f"📦 [{progress['imported'] + progress['failed']}/{len(files)}] {name}: "
+                                  f"{parsed['rows']} rows, {len(tasks[sub_id]['purchase_ids'])} purchases.")
+
+        for line in write_stats.summary():
+            log_step(task_id, f"⚡ Item/movement writes, {line}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+
+        log_step(task_id, "Step 3: Generating combined report...")
+        session = SessionLocal()
+        try:
+            generate_excel_report(task_id, session, purchase_ids=created_purchase_ids, transfer_ids=[])
+        finally:
+            session.close()
 
-                log_step(task_id, f"➡️ Checking missing product ...")
+        end_time = datetime.datetime.now()
+        log_step(task_id, f"📅 End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        log_step(task_id, f"⏱️ Total Duration: {end_time - start_time}")
 
-                missing_products = batch_df[~batch_df["item_code"].isin(existing_codes)]
-                print(missing_products)
-
-                # products_to_insert = missing_products.apply(lambda row: {
-                #     "name": row["item_name"],
-                #     "item_code": row["item_code"],
-                #     "category_id": row.get("item_code", 3),
-                #     "cost_price": row["item_cost_price"],
-                #     "sale_price": row["item_sale_price"],
-                #     "tax_rate" : 1
-                # }, axis=1).tolist()
-
-                # log_step(task_id, f"➡️ Insert missing products...")
-
-                # insert_missing_products(session, products_to_insert)
-
-                # Process missing products row by row
-                for _, row in missing_products.iterrows():
-                    existing_product = session.query(Product).filter_by(code=row["item_code"]).first()
-                    if existing_product:
-                        # Update existing product
-                        existing_product.name = row["item_name"]
-                        existing_product.item_code = row["item_code"]
-                        existing_product.category_id = row.get("item_code", 3)
-                        existing_product.cost = row["item_cost_price"]
-                        existing_product.price = row["item_sale_price"]
-                        log_step(task_id, f"🔄 Updated product {row['item_code']}") 
-                    else:
-                        # Insert new product
-                        new_product = Product(
-                            name=row["item_name"],
-                            item_code=row["item_code"],
-                            code=row["item_code"],
-                            category_id=row.get("item_code", 3),
-                            cost=row["item_cost_price"],
-                            price=row["item_sale_price"],
-                            tax_rate=1
-                        )
-                        session.add(new_product)
-                        log_step(task_id, f"➕ Inserted product {row['item_code']}")
-
-                session.commit()
-                log_step(task_id, f"✅ Batch {i + 1} products inserted/updated successfully.")
-
-                log_step(task_id, f"➡️ Fetching product VAT info and create batch")
-
-                # Step 2: query products with their VAT rate from DB
-                products = session.query(Product.item_code, Product.tax_rate).filter(
-                    Product.item_code.in_(product_codes)
-                ).all()
-
-                  # Convert to dict: {item_code: vat_rate}
-                #vat_map = {p.item_code: p.tax_rate for p in products}
-                # def calc_vat(row):
-                #     tax_rate = vat_map.get(row["item_code"], 0) or 0
-                #     # business rule: if tax_rate == 5 → VAT = 15%, else 0
-                #     vat_rate = 0.15 if tax_rate == 5 else 1
-                #     vat_value = row["item_total_cost_price"] * vat_rate
-                #     total_after_vat = row["item_total_cost_price"] + vat_value
-
-                #      # df["total_sale_vat"] = df["item_total_sale_price"] * df["vat_value"]
-                #      # df["total_sale"] = df["item_total_sale_price"] + df["total_sale_vat"]
-                #     total_sale_vat = row["item_total_sale_price"] * vat_rate
-                #     total_sale = row["item_total_sale_price"] + total_sale_vat
-
-                #     return pd.Series({
-                #         "vat_value": 15 if tax_rate == 5 else 0,
-                #         "item_total_vat": vat_value,  # same as vat_value per row
-                #         "item_total_after_vat": total_after_vat,
-                #         "total_sale_vat" : total_sale_vat,
-                #         "total_sale" : total_sale
-                #     })
-
-                # batch_df[["vat_value", "item_total_vat", "item_total_after_vat", "total_sale_vat","total_sale"]] = batch_df.apply(calc_vat, axis=1)
-
-
-                log_step(task_id, f"➡️ Create Purchase and Make transfer {i + 1}...")
-
-                result = create_purchase(session, batch_df)
-                if result.get("purchase_id"):
-                    created_purchase_ids.append(result["purchase_id"])
-    
-                # if result.get("transfer_id"):
-                #     created_transfer_ids.append(result["transfer_id"])
+        tasks[task_id]["status"] = "completed"
+        tasks[task_id]["report_url"] = f"/download/{task_id}"
+        log_step(task_id, f"✅ Archive imported: {progress['imported']} files, {progress['failed']} failed, "
+                          f"{progress['rows']} rows.")
 
+    except Exception as e:
+        tasks[task_id]["status"] = "failed"
+        log_step(task_id, f"❌ Error: {str(e)}")
 
-                log_step(task_id, f"✅ Batch {i + 1} inserted successfully.")
-            except Exception as e:
-                session.rollback()
-                log_step(task_id, f"❌ Error in batch {i + 1}: {str(e)}")
-            finally:
-                session.close()
 
+def process_file(task_id: str, file_path: str, content_hash: str = None):
+    try:
+        created_purchase_ids = []
+        created_transfer_ids = []
+        start_time = datetime.datetime.now()
+        log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        
+        log_step(task_id, "Step 1: Streaming Excel file in batches...")
+
+        log_step(task_id, "Step 2: Processing batches...")
+        expiry_dates = DateNormalizer()
+        numbers = NumericNormalizer(LAYOUTS["abaad"].numeric_columns)
+        product_ids = {}  # item_code -> id for this task
+        write_stats = WriteStats()
+        batcher = batch_sizer(task_id)
+        # The next batch is parsed and prepared while this one is written
+        pipeline = BatchPipeline(stream_batches(task_id, file_path, "abaad", content_hash, batcher),
+                                 lambda batch_df: prepare_abaad_batch(batch_df, expiry_dates, numbers))
+        commits = GroupCommit()
+        commits.track(product_ids)
+        for i, batch_df in enumerate(commits.batches(pipeline)):
+            with batcher.measure(len(batch_df), commits.session):
+                purchase_id = import_abaad_batch(task_id, i, batch_df, product_ids, commits, write_stats)
+            if purchase_id:
+                commits.on_commit(lambda purchase_id=purchase_id: created_purchase_ids.append(purchase_id))
+
+        log_rejected_rows(task_id, expiry_dates.errors, "unparseable expiry dates", "skipped")
+        log_rejected_rows(task_id, numbers.errors, "non-numeric cells", "skipped")
+        for line in write_stats.summary():
+            log_step(task_id, f"⚡ Item/movement writes, {line}")
+        for line in pipeline.summary():
+            log_step(task_id, f"📊 Pipeline {line}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
         log_step(task_id, "Step 3: All batches processed successfully.")
         log_step(task_id, "Step 4: Generating report...")
 
@@ -591,7 +1006,11 @@ def process_file(task_id: str, file_path: str):
         # os.makedirs("reports", exist_ok=True)
         # with open(report_path, "w") as f:
         #     f.write("Dummy Excel content")
-        generate_excel_report(task_id, session, purchase_ids=created_purchase_ids, transfer_ids=created_transfer_ids)
+        session = SessionLocal()
+        try:
+            generate_excel_report(task_id, session, purchase_ids=created_purchase_ids, transfer_ids=created_transfer_ids)
+        finally:
+            session.close()
 
         end_time = datetime.datetime.now()
         log_step(task_id, f"📅 End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")    
@@ -610,15 +1029,13 @@ def process_file(task_id: str, file_path: str):
 
 
 
-def upload_jarir_metadata(task_id: str, file_path: str):
+def upload_jarir_metadata(task_id: str, file_path: str, content_hash: str = None):
     try:
         
         start_time = datetime.datetime.now()
         log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         
-        log_step(task_id, "Step 1: Reading Excel file...")
-        df = pd.read_excel(file_path, header=None)
-        df = df.iloc[1:].reset_index(drop=True)
+        log_step(task_id, "Step 1: Streaming Excel file in batches...")
 
         # df.columns = [
         #     "item_code", "item_name", "item_batch_number", "item_ascon_code", "item_expiry_date",
@@ -630,36 +1047,12 @@ def upload_jarir_metadata(task_id: str, file_path: str):
         # ProductId	Product	StockId	PackUnits	Packs	Units	SalePrice	CostPrice	DealCost	TotalSale	TotalCost	TotalDealCost	BatchNo	Expiry	Branch	Store	Supplier	Category	Group	VAT
         # ProductId	ProductEn	ProductAr	Barcode	StockId	PackUnits	Packs	Units	SalePrice	CostPrice	TotalSale	TotalCost	BatchNo	Expiry	Branch	Store	Supplier	Category
 
-        df.columns = [
-            "item_code", 
-            "item_name",
-            "stock_id", 
-            "item_packs_units", 
-            "item_quantity", 
-            "item_units",
-            "item_sale_price", 
-            "item_cost_price",
-            "item_purchase_price",
-            "item_total_sale_price", 
-            "item_total_cost_price",
-            "item_total_purchase_price",
-            "item_batch_number",
-            "item_expiry_date", 
-            "branch", 
-            "store", 
-            "supplier",
-            "category",
-            "group"
-        ]
 
-       
-
-        log_step(task_id, "Step 2: Splitting file into batches...")
-        batches = split_dataframe_in_batches(df, BATCH_SIZE)
-
-        for i, batch_df in enumerate(batches):
+        log_step(task_id, "Step 2: Processing batches...")
+        commits = GroupCommit()
+        for i, batch_df in enumerate(commits.batches(stream_batches(task_id, file_path, "jarir", content_hash))):
            
-            session = SessionLocal()
+            session = commits.begin_batch()
             try:
                 
                 log_step(task_id, f"➡️ Processing batch {i + 1}...")
@@ -694,9 +1087,8 @@ def upload_jarir_metadata(task_id: str, file_path: str):
                 else:
                     log_step(task_id, "✅ No new categories to add.")    
 
-               # 2. Refresh all parent categories from DB (name -> id map)
-                all_parent_categories = session.query(Category).filter(Category.name.in_(categories_in_batch)).all()
-                parent_category_map = {cat.name: cat.id for cat in all_parent_categories}
+               # 2. Refresh all parent categories from the master-data index (name -> id map)
+                parent_category_map = MASTER_DATA.categories(session, categories_in_batch)
 
                 subcategories_set = set()
                 for _, row in batch_df.iterrows():
@@ -707,10 +1099,7 @@ def upload_jarir_metadata(task_id: str, file_path: str):
                         if parent_id:
                             subcategories_set.add((sub_name.strip(), parent_id))     
                
-                existing_subcategories = session.query(Category).filter(
-                    tuple_(Category.name, Category.parent_id).in_(subcategories_set)
-                     ).all()
-                existing_sub_map = {(c.name, c.parent_id) for c in existing_subcategories}    
+                existing_sub_map = set(MASTER_DATA.subcategories(session, subcategories_set))
 
                 missing_subcategories = [
                     {"name": name, "parent_id": pid} 
@@ -724,14 +1113,13 @@ def upload_jarir_metadata(task_id: str, file_path: str):
                 else:
                     log_step(task_id, "✅ No new subcategories to add.")
 
-
+                commits.end_batch()
                 log_step(task_id, f"✅ Batch {i + 1} inserted successfully.")
             except Exception as e:
-                session.rollback()
+                commits.rollback_batch()
                 log_step(task_id, f"❌ Error in batch {i + 1}: {str(e)}")
-            finally:
-                session.close()
 
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
         log_step(task_id, "Step 3: All batches processed successfully.")
 
         end_time = datetime.datetime.now()
@@ -747,77 +1135,71 @@ def upload_jarir_metadata(task_id: str, file_path: str):
         tasks[task_id]["status"] = "failed"
         log_step(task_id, f"❌ Error: {str(e)}")
 
-def process_images_file(task_id: str, file_path: str):
+def process_images_file(task_id: str, file_path: str, content_hash: str = None):
     """
     Process Excel file containing product_code and image_url columns.
-    Updates image_url_new column in sma_products table for matching products.
+    Updates image_url_new column in sma_products table for matching products,
+    one staged UPDATE ... JOIN per batch.
     """
     try:
         start_time = datetime.datetime.now()
         log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         
-        # Step 1: Read Excel file
-        log_step(task_id, "Step 1: Reading Excel file...")
-        
-        # Try to read as CSV first, then fall back to Excel
-        try:
-            if file_path.endswith('.csv'):
-                df = pd.read_csv(file_path)
-            else:
-                df = pd.read_excel(file_path, engine='openpyxl')
-        except Exception as e:
-            # If extension doesn't match content, try the other format
-            try:
-                df = pd.read_csv(file_path)
-            except:
-                df = pd.read_excel(file_path, engine='openpyxl')
+        # Step 1: Stream the file (header row holds the column names)
+        log_step(task_id, "Step 1: Streaming file in batches...")
         
-        # Check if required columns exist
-        if 'product_code' not in df.columns or 'image_url' not in df.columns:
-            log_step(task_id, "❌ Error: Excel file must contain 'product_code' and 'image_url' columns")
-            tasks[task_id]["status"] = "failed"
-            return
-        
-        # Remove rows with missing values
-        df = df.dropna(subset=['product_code', 'image_url'])
-        log_step(task_id, f"📄 Loaded {len(df)} rows from file.")
-        
-        # Step 2: Process each row
+        # Step 2: Apply each batch with one set-based update
         log_step(task_id, "Step 2: Processing image updates...")
         
-        session = SessionLocal()
         updated_count = 0
-        not_found_count = 0
+        not_found_codes = []
         error_count = 0
-        
-        try:
-            for idx, row in df.iterrows():
-                product_code = str(row['product_code']).strip()
-                image_url = str(row['image_url']).strip()
-                
-                try:
-                    # Update product image
-                    if update_product_image(session, product_code, image_url):
-                        updated_count += 1
-                        if (idx + 1) % 100 == 0:  # Log progress every 100 rows
-                            log_step(task_id, f"   Processed {idx + 1}/{len(df)} rows...")
-                    else:
-                        not_found_count += 1
-                        log_step(task_id, f"⚠️ Product code '{product_code}' not found in database")
-                        
-                except Exception as e:
-                    error_count += 1
-                    log_step(task_id, f"❌ Error updating product '{product_code}': {str(e)}")
-            
-            # Final summary
-            log_step(task_id, f"")
-            log_step(task_id, f"📊 Summary:")
-            log_step(task_id, f"   ✅ Successfully updated: {updated_count}")
-            log_step(task_id, f"   ⚠️ Products not found: {not_found_count}")
-            log_step(task_id, f"   ❌ Errors: {error_count}")
-            
-        finally:
-            session.close()
+        total_rows = 0
+        update_start = time.perf_counter()
+
+        batcher = batch_sizer(task_id)
+        commits = GroupCommit()
+        for i, batch_df in enumerate(commits.batches(stream_batches(task_id, file_path, "images", content_hash, batcher))):
+            # Check if required columns exist
+            if 'product_code' not in batch_df.columns or 'image_url' not in batch_df.columns:
+                log_step(task_id, "❌ Error: Excel file must contain 'product_code' and 'image_url' columns")
+                tasks[task_id]["status"] = "failed"
+                return
+
+            # Remove rows with missing values; a code repeated in the batch keeps its last URL
+            batch_df = batch_df.dropna(subset=['product_code', 'image_url'])
+            total_rows += len(batch_df)
+            images = dict(zip(batch_df['product_code'].astype(str).str.strip(),
+                              batch_df['image_url'].astype(str).str.strip()))
+
+            session = commits.begin_batch()
+            try:
+                with batcher.measure(len(batch_df), commits.session):
+                    result = update_product_images(session, images)
+                commits.end_batch()
+                updated_count += result["updated"]
+                not_found_codes.extend(result["not_found"])
+                log_step(task_id, f"   Batch {i + 1}: {result['updated']} updated, "
+                                  f"{len(result['not_found'])} not found ({total_rows} rows so far)")
+            except Exception as e:
+                commits.rollback_batch()
+                error_count += len(images)
+                log_step(task_id, f"❌ Error in batch {i + 1}: {str(e)}")
+
+        update_seconds = time.perf_counter() - update_start
+        log_step(task_id, f"📄 Loaded {total_rows} rows from file.")
+
+        # Final summary
+        log_step(task_id, f"")
+        log_step(task_id, f"📊 Summary ({update_seconds:.2f}s):")
+        log_step(task_id, f"   ✅ Successfully updated: {updated_count}")
+        log_step(task_id, f"   ⚠️ Products not found: {len(not_found_codes)}")
+        log_step(task_id, f"   ❌ Errors: {error_count}")
+        if not_found_codes:
+            more = f" ... and {len(not_found_codes) - 20} more" if len(not_found_codes) > 20 else ""
+            log_step(task_id, f"   Not found: {', '.join(not_found_codes[:20])}{more}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
         
         end_time = datetime.datetime.now()
         log_step(task_id, f"📅 End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -836,16 +1218,133 @@ def process_images_file(task_id: str, file_path: str):
         if os.path.exists(file_path):
             os.remove(file_path)
 
-def jarir_process_file(task_id: str, file_path: str):
+def process_discounts_file(task_id: str, file_path: str, content_hash: str = None):
+    """
+    Apply a discount sheet (ITEM_NO plus the CREDIT and Cash Dis1-Dis3
+    columns, see layouts.DISCOUNTS) to sma_products: the duplicated headers
+    are resolved once by the layout, and each batch sets all six discount
+    columns with one staged UPDATE ... JOIN.
+    """
+    try:
+        start_time = datetime.datetime.now()
+        log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        added = add_discount_columns(get_engine())
+        if added:
+            log_step(task_id, f"🆕 Added discount columns: {', '.join(added)}")
+
+        log_step(task_id, "Step 1: Streaming file in batches...")
+        log_step(task_id, "Step 2: Processing discount updates...")
+
+        updated_count = 0
+        not_found_ids = []
+        error_count = 0
+        total_rows = 0
+        numbers = NumericNormalizer(LAYOUTS["discounts"].numeric_columns)
+        update_start = time.perf_counter()
+
+        batcher = batch_sizer(task_id)
+        commits = GroupCommit()
+        for i, batch_df in enumerate(commits.batches(stream_batches(task_id, file_path, "discounts", content_hash, batcher))):
+            # Non-numeric discounts are stored as empty, rows without a numeric ITEM_NO are skipped
+            batch_df, _ = numbers.normalize(batch_df)
+            rows = discount_rows(batch_df)
+            total_rows += len(batch_df)
+
+            session = commits.begin_batch()
+            try:
+                with batcher.measure(len(rows), commits.session):
+                    result = update_product_discounts(session, rows)
+                commits.end_batch()
+                updated_count += result["updated"]
+                not_found_ids.extend(result["not_found"])
+                log_step(task_id, f"   Batch {i + 1}: {result['updated']} updated, "
+                                  f"{len(result['not_found'])} not found ({total_rows} rows so far)")
+            except Exception as e:
+                commits.rollback_batch()
+                error_count += len(rows)
+                log_step(task_id, f"❌ Error in batch {i + 1}: {str(e)}")
+
+        update_seconds = time.perf_counter() - update_start
+        log_step(task_id, f"📄 Loaded {total_rows} rows from file.")
+        # discount_rows() drops rows whose ITEM_NO is not a number; other bad cells are stored as empty
+        item_no_errors = [e for e in numbers.errors if e[1] == "item_no"]
+        log_rejected_rows(task_id, item_no_errors, "rows with a non-numeric ITEM_NO", "skipped")
+        log_rejected_rows(task_id, [e for e in numbers.errors if e[1] != "item_no"],
+                          "non-numeric discount cells", "imported as empty")
+
+        # Final summary
+        log_step(task_id, f"")
+        log_step(task_id, f"📊 Summary ({update_seconds:.2f}s, {total_rows / max(update_seconds, 1e-9):.0f} rows/s):")
+        log_step(task_id, f"   ✅ Successfully updated: {updated_count}")
+        log_step(task_id, f"   ⚠️ Products not found: {len(not_found_ids)}")
+        log_step(task_id, f"   ⏭️ Skipped (non-numeric ITEM_NO): {len(item_no_errors)}")
+        log_step(task_id, f"   ❌ Errors: {error_count}")
+        if not_found_ids:
+            more = f" ... and {len(not_found_ids) - 20} more" if len(not_found_ids) > 20 else ""
+            log_step(task_id, f"   Not found: {', '.join(map(str, not_found_ids[:20]))}{more}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
+
+        end_time = datetime.datetime.now()
+        log_step(task_id, f"📅 End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        log_step(task_id, f"⏱️ Total Duration: {end_time - start_time}")
+
+        tasks[task_id]["status"] = "completed"
+        log_step(task_id, "✅ Discount update completed successfully.")
+
+    except Exception as e:
+        tasks[task_id]["status"] = "failed"
+        log_step(task_id, f"❌ Error: {str(e)}")
+    finally:
+        # Clean up the uploaded file
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def prepare_jarir_batch(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Derive the VAT totals for one Jarir batch. Prices arrive already parsed
+    to floats by the Jarir layout.
+    """
+    vat_categories = [
+        "BABY TOOLS VAT",
+        "COSMETICS BEAUTY CARE VAT",
+        "COSMOTHERAPEUTICS VAT",
+        "DEVICES WITH VAT",
+        "MECICAL USE ITEMS VAT",
+        "SUPPLEMENTS AND HERBALS VAT",
+        "TOOLS WITH VAT",
+    ]
+
+    df['item_total_vat'] = 0.0
+    df['item_total_after_vat'] = 0.0
+    df['total_sale_vat'] = 0.0
+    df['total_sale'] = 0.0
+
+    vat_mask = df["category"].isin(vat_categories)
+    # Calculate VAT on item cost price (15%)
+    df.loc[vat_mask, 'item_total_vat'] = df.loc[vat_mask, 'item_total_cost_price'] * 0.15
+    # Total cost price after VAT
+    df.loc[vat_mask, 'item_total_after_vat'] = df.loc[vat_mask, 'item_total_cost_price'] + df.loc[vat_mask, 'item_total_vat']
+    # Calculate VAT on sale price (15%)
+    df.loc[vat_mask, 'total_sale_vat'] = df.loc[vat_mask, 'item_total_sale_price'] * 0.15
+    # Total sale price after VAT
+    df.loc[vat_mask, 'total_sale'] = df.loc[vat_mask, 'item_total_sale_price'] + df.loc[vat_mask, 'total_sale_vat']
+
+    # For rows NOT in vat categories, keep totals same as original prices (no VAT)
+    df.loc[~vat_mask, 'item_total_after_vat'] = df.loc[~vat_mask, 'item_total_cost_price']
+    df.loc[~vat_mask, 'total_sale'] = df.loc[~vat_mask, 'item_total_sale_price']
+
+    return df
+
+def jarir_process_file(task_id: str, file_path: str, content_hash: str = None):
     try:
         created_purchase_ids = []
         created_transfer_ids = []
         start_time = datetime.datetime.now()
         log_step(task_id, f"📅 Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         
-        log_step(task_id, "Step 1: Reading Excel file...")
-        df = pd.read_excel(file_path, header=None)
-        df = df.iloc[1:].reset_index(drop=True)
+        log_step(task_id, "Step 1: Streaming Excel file in batches...")
 
         # df.columns = [
         #     "item_code", "item_name", "item_batch_number", "item_ascon_code", "item_expiry_date",
@@ -857,120 +1356,41 @@ def jarir_process_file(task_id: str, file_path: str):
         # ProductId	Product	StockId	PackUnits	Packs	Units	SalePrice	CostPrice	DealCost	TotalSale	TotalCost	TotalDealCost	BatchNo	Expiry	Branch	Store	Supplier	Category	Group	VAT
         # ProductId	ProductEn	ProductAr	Barcode	StockId	PackUnits	Packs	Units	SalePrice	CostPrice	TotalSale	TotalCost	BatchNo	Expiry	Branch	Store	Supplier	Category
 
-        df.columns = [
-            "item_code", 
-            "item_name",
-            "stock_id", 
-            "item_packs_units", 
-            "item_quantity", 
-            "item_units",
-            "item_sale_price", 
-            "item_cost_price",
-            "item_purchase_price",
-            "item_total_sale_price", 
-            "item_total_cost_price",
-            "item_total_purchase_price",
-            "item_batch_number",
-            "item_expiry_date", 
-            "branch", 
-            "store", 
-            "supplier",
-            "category",
-            "group"
-        ]
-
-        df['item_total_vat'] = 0 
-        df['item_total_after_vat'] = 0
-        df['total_sale_vat'] = 0
-        df['total_sale'] = 0
-
-        df["item_sale_price"] = (
-            df["item_sale_price"]
-            .astype(str)
-            .str.replace(",", "")
-            .astype(float)
-        )
-        df["item_cost_price"] = (
-            df["item_cost_price"]
-            .astype(str)
-            .str.replace(",", "")
-            .astype(float)
-        )
-
-        df["item_total_sale_price"] = (
-            df["item_total_sale_price"]
-            .astype(str)
-            .str.replace(",", "")
-            .astype(float)
-        )
-
-        df["item_total_cost_price"] = (
-            df["item_total_cost_price"]
-            .astype(str)
-            .str.replace(",", "")
-            .astype(float)
-        )
-
-        vat_categories = [
-            "BABY TOOLS VAT",
-            "COSMETICS BEAUTY CARE VAT",
-            "COSMOTHERAPEUTICS VAT",
-            "DEVICES WITH VAT",
-            "MECICAL USE ITEMS VAT",
-            "SUPPLEMENTS AND HERBALS VAT",
-            "TOOLS WITH VAT",
-        ]
-
-        df['item_total_vat'] = 0.0
-        df['item_total_after_vat'] = 0.0
-        df['total_sale_vat'] = 0.0
-        df['total_sale'] = 0.0
-
-        vat_mask = df["category"].isin(vat_categories)
-        # Calculate VAT on item cost price (15%)
-        df.loc[vat_mask, 'item_total_vat'] = df.loc[vat_mask, 'item_total_cost_price'] * 0.15
-        # Total cost price after VAT
-        df.loc[vat_mask, 'item_total_after_vat'] = df.loc[vat_mask, 'item_total_cost_price'] + df.loc[vat_mask, 'item_total_vat']
-        # Calculate VAT on sale price (15%)
-        df.loc[vat_mask, 'total_sale_vat'] = df.loc[vat_mask, 'item_total_sale_price'] * 0.15
-        # Total sale price after VAT
-        df.loc[vat_mask, 'total_sale'] = df.loc[vat_mask, 'item_total_sale_price'] + df.loc[vat_mask, 'total_sale_vat']
-
-        # For rows NOT in vat categories, keep totals same as original prices (no VAT)
-        df.loc[~vat_mask, 'item_total_after_vat'] = df.loc[~vat_mask, 'item_total_cost_price']
-        df.loc[~vat_mask, 'total_sale'] = df.loc[~vat_mask, 'item_total_sale_price']
-
-
 
         #df["total_sale_vat"] = df["item_total_sale_price"] * df["vat_value"]
         #df["total_sale"] = df["item_total_sale_price"] + df["total_sale_vat"]
 
-        log_step(task_id, "Step 2: Splitting file into batches...")
-        batches = split_dataframe_in_batches(df, BATCH_SIZE)
+        log_step(task_id, "Step 2: Processing batches...")
         # batches = [(supplier, group) for supplier, group in df.groupby("supplier")]
 
-        for i, batch_df in enumerate(batches):
-           
-            session = SessionLocal()
+        expiry_dates = DateNormalizer()
+        numbers = NumericNormalizer(LAYOUTS["jarir"].numeric_columns)
+        product_ids = {}  # item_code -> id for this task
+
+        def prepare(batch_df):
+            batch_df["item_expiry_date"], invalid_dates = expiry_dates.normalize(batch_df["item_expiry_date"])
+            batch_df, invalid_numbers = numbers.normalize(batch_df)
+            batch_df = batch_df[~(invalid_dates | invalid_numbers)]
+            return None if batch_df.empty else prepare_jarir_batch(batch_df)
+
+        # The next batch is prepared while this one is written
+        batcher = batch_sizer(task_id)
+        pipeline = BatchPipeline(stream_batches(task_id, file_path, "jarir", content_hash, batcher), prepare)
+        commits = GroupCommit()
+        commits.track(product_ids)
+        for i, batch_df in enumerate(commits.batches(pipeline)):
+            batcher.begin(commits.session)
+            session = commits.begin_batch()
             try:
                 
-                print("Before cleaning:")
-                print(batch_df["item_code"].head(5)) 
-                batch_df["item_code"] = batch_df["item_code"].astype(str).apply(lambda x: x.split(",")[0].strip())
-                print("\nAfter cleaning:")
-                print(batch_df["item_code"].head(5))
                 log_step(task_id, f"➡️ Processing batch {i+1}...")
 
                 categories_in_batch = batch_df["group"].dropna().unique().tolist()
                  
-                category_map = dict(
-                    session.query(Category.name, Category.id)
-                    .filter(Category.name.in_(categories_in_batch))
-                    .all()
-                )    
+                category_map = MASTER_DATA.categories(session, categories_in_batch)
 
                 product_codes = batch_df["item_code"].unique().tolist()
-                existing_codes = get_existing_product_codes(session, product_codes)
+                existing_codes = get_existing_product_codes(session, product_codes, product_ids)
 
                 log_step(task_id, f"➡️ Checking missing product ...")
 
@@ -988,25 +1408,23 @@ def jarir_process_file(task_id: str, file_path: str):
 
                 log_step(task_id, f"➡️ Insert missing products...")
 
-                insert_missing_products(session, products_to_insert)
+                insert_missing_products(session, products_to_insert, product_ids)
 
                 log_step(task_id, f"➡️ Create Purchase {i+1}...")
 
-                supplier_record = (
-                        session.query(Supplier.name, Supplier.id)
-                        .filter(Supplier.name == batch_df['supplier'])
-                        .first()
-                    )
-                if supplier_record:
-                    batch_df["supplier_name"] = supplier_record.name
-                    batch_df["supplier_id"] = supplier_record.id
+                supplier_name = batch_df['supplier'].iloc[0]
+                supplier_id = MASTER_DATA.suppliers(session, [supplier_name]).get(supplier_name)
+                if supplier_id:
+                    batch_df["supplier_name"] = supplier_name
+                    batch_df["supplier_id"] = supplier_id
                 else:
                     batch_df["supplier_name"] = 'Internal supplier'
                     batch_df["supplier_id"] = '786'
 
-                result = jarir_create_purchase(session, batch_df)
+                result = jarir_create_purchase(session, batch_df, product_ids)
                 if result.get("purchase_id"):
-                    created_purchase_ids.append(result["purchase_id"])
+                    commits.on_commit(lambda purchase_id=result["purchase_id"]: created_purchase_ids.append(purchase_id))
+                commits.end_batch()
     
                 # if result.get("transfer_id"):
                 #     created_transfer_ids.append(result["transfer_id"])
@@ -1014,11 +1432,17 @@ def jarir_process_file(task_id: str, file_path: str):
 
                 log_step(task_id, f"✅ Batch {i+1} inserted successfully.")
             except Exception as e:
-                session.rollback()
+                commits.rollback_batch()
                 log_step(task_id, f"❌ Error in batch {i+1}: {str(e)}")
             finally:
-                session.close()
-
+                batcher.end(len(batch_df), commits.session)
+
+        log_rejected_rows(task_id, expiry_dates.errors, "unparseable expiry dates", "skipped")
+        log_rejected_rows(task_id, numbers.errors, "non-numeric cells", "skipped")
+        for line in pipeline.summary():
+            log_step(task_id, f"📊 Pipeline {line}")
+        log_step(task_id, f"📏 Batches: {batcher.summary()}")
+        log_step(task_id, f"💾 Commits: {commits.summary()}")
         log_step(task_id, "Step 3: All batches processed successfully.")
         log_step(task_id, "Step 4: Generating report...")
 
@@ -1080,24 +1504,51 @@ async def upload_images(file: UploadFile, background_tasks: BackgroundTasks):
     task_id = str(uuid4())
     file_location = f"temp/{task_id}_{file.filename}"
     
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "images")
 
     tasks[task_id] = {
         "status": "processing",
         "logs": ["File received, starting image update..."],
-        "report_url": None
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
     }
 
-    background_tasks.add_task(process_images_file, task_id, file_location)
-    return {"task_id": task_id}
+    background_tasks.add_task(process_images_file, task_id, file_location, content_hash)
+    return {"task_id": task_id, "preflight": preflight}
+
+
+@app.get("/upload_discounts", response_class=HTMLResponse)
+async def upload_discounts_form(request: Request):
+    return templates.TemplateResponse("upload_discounts.html", {"request": request})
+
+@app.post("/upload_discounts")
+async def upload_discounts(file: UploadFile, background_tasks: BackgroundTasks):
+    task_id = str(uuid4())
+    file_location = f"temp/{task_id}_{file.filename}"
+
+    upload = await save_upload(file, file_location)
+    content_hash = upload["content_hash"]
+    preflight = await preflight_upload(file_location, "discounts")
+
+    tasks[task_id] = {
+        "status": "processing",
+        "logs": ["File received, starting discount update..."],
+        "report_url": None,
+        "upload": upload,
+        "preflight": preflight
+    }
+
+    background_tasks.add_task(process_discounts_file, task_id, file_location, content_hash)
+    return {"task_id": task_id, "preflight": preflight}
 
 
 @app.post("/upload_old", response_class=HTMLResponse)
 async def upload_file(request: Request, file: UploadFile = File(...)):
     file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    await save_upload(file, file_path)
 
     logs = []
     try:
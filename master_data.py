@@ -0,0 +1,331 @@
+"""
+Process-wide in-memory index of the master data every import resolves:
+products, suppliers and categories.
+
+The index is loaded once at startup and then grows incrementally: a lookup
+that misses first pulls the rows added since the last load (id above the
+table's max(id) watermark) and only the codes still unknown after that are
+queried by key (through a staging table when there are many, see
+services.key_staging).
+
+Rows a lookup reads inside a session's transaction may be that
+transaction's own uncommitted rows, so they are kept in a view local to the
+session (in session.info) and only published to the shared index once the
+transaction commits; a rollback discards them, and rollback_to() drops
+those of a rolled back savepoint (see commit_policy).
+"""
+import datetime
+import threading
+from collections import Counter, namedtuple
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from model import Category, Product, Supplier
+from services.key_staging import select_by_keys
+
+ProductEntry = namedtuple("ProductEntry", ["id", "cost", "price", "tax_rate"])
+ProductRow = namedtuple("ProductRow", ["id", "code", "item_code", "cost", "price", "tax_rate"])
+
+# Rows fetched per round trip when loading a table
+LOAD_CHUNK_ROWS = 10000
+# session.info key of a session's uncommitted view
+SESSION_KEY = "master_data"
+
+
+class _Maps:
+    """
+    Lookup maps, keyed by the values the vendor files carry:
+
+    - products: code and item_code -> ProductEntry(id, cost, price, tax_rate)
+    - suppliers: name and external_id -> id
+    - categories: (name, parent_id) -> id, and name -> id
+
+    and per table the highest id loaded (its watermark).
+    """
+
+    def __init__(self, watermarks: Optional[Dict[str, int]] = None):
+        self._reset()
+        if watermarks:
+            self.watermarks.update(watermarks)
+
+    def _reset(self):
+        self.products_by_code: Dict[str, ProductEntry] = {}
+        self.products_by_item_code: Dict[str, ProductEntry] = {}
+        self.suppliers_by_name: Dict[str, int] = {}
+        self.suppliers_by_external_id: Dict[int, int] = {}
+        self.categories_by_key: Dict[Tuple[str, int], int] = {}
+        self.categories_by_name: Dict[str, int] = {}
+        self.watermarks = {"products": 0, "suppliers": 0, "categories": 0}
+
+    def _add_product(self, row) -> None:
+        entry = ProductEntry(row.id, row.cost, row.price, row.tax_rate)
+        if row.code is not None:
+            self.products_by_code[str(row.code)] = entry
+        if row.item_code is not None:
+            self.products_by_item_code[str(row.item_code)] = entry
+
+    def _add_supplier(self, row) -> None:
+        if row.name is not None:
+            self.suppliers_by_name.setdefault(row.name, row.id)
+        if row.external_id is not None:
+            self.suppliers_by_external_id.setdefault(row.external_id, row.id)
+
+    def _add_category(self, row) -> None:
+        self.categories_by_key.setdefault((row.name, row.parent_id), row.id)
+        self.categories_by_name.setdefault(row.name, row.id)
+
+    def _indexes(self, table: str):
+        return {
+            "products": (self.products_by_code, self.products_by_item_code),
+            "suppliers": (self.suppliers_by_name, self.suppliers_by_external_id),
+            "categories": (self.categories_by_key, self.categories_by_name),
+        }[table]
+
+
+class MasterDataIndex(_Maps):
+    """
+    The shared maps (see _Maps), holding committed rows only, plus one
+    uncommitted view per session.
+
+    hits counts keys answered from memory, misses keys that needed the
+    database (whether or not they were found there).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.loaded_at: Optional[datetime.datetime] = None
+        super().__init__()
+
+    # --- loading ---------------------------------------------------------
+
+    def load(self, session: Session) -> None:
+        """
+        (Re)build the whole index from the database. The session must not
+        have uncommitted writes.
+        """
+        with self._lock:
+            self._reset()
+            for table in self.watermarks:
+                self.refresh(session, table, self)
+            self.loaded_at = datetime.datetime.now()
+
+    def ensure_loaded(self, session: Session) -> None:
+        if self.loaded_at is None:
+            # In a session of its own, which sees committed rows only
+            with Session(bind=session.get_bind()) as fresh:
+                self.load(fresh)
+
+    def refresh(self, session: Session, table: str, maps: Optional[_Maps] = None) -> int:
+        """
+        Add the rows of one table whose id is above its watermark, by default
+        to the session's uncommitted view. Returns the number of rows added.
+        """
+        with self._lock:
+            maps = maps if maps is not None else self._session_maps(session)
+            model, columns = self._tables()[table]
+            add = getattr(maps, self._adders[table])
+            mark = max(self.watermarks[table], maps.watermarks[table])
+            added = 0
+            while True:
+                rows = (session.query(model.id, *columns)
+                        .filter(model.id > mark)
+                        .order_by(model.id)
+                        .limit(LOAD_CHUNK_ROWS)
+                        .all())
+                for row in rows:
+                    add(row)
+                if rows:
+                    mark = maps.watermarks[table] = rows[-1].id
+                added += len(rows)
+                if len(rows) < LOAD_CHUNK_ROWS:
+                    return added
+
+    _adders = {"products": "_add_product", "suppliers": "_add_supplier", "categories": "_add_category"}
+
+    @staticmethod
+    def _tables():
+        return {
+            "products": (Product, (Product.code, Product.item_code, Product.cost, Product.price, Product.tax_rate)),
+            "suppliers": (Supplier, (Supplier.name, Supplier.external_id)),
+            "categories": (Category, (Category.name, Category.parent_id)),
+        }
+
+    # --- per-session views -----------------------------------------------
+
+    def _session_maps(self, session: Session) -> _Maps:
+        """
+        The session's uncommitted view, created (and its commit/rollback
+        hooks registered) on first use.
+        """
+        maps = session.info.get(SESSION_KEY)
+        if maps is None:
+            if "master_data_hooks" not in session.info:
+                event.listen(session, "after_commit", self._after_commit)
+                event.listen(session, "after_transaction_end", self._after_transaction_end)
+                session.info["master_data_hooks"] = True
+            maps = session.info[SESSION_KEY] = _Maps(self.watermarks)
+        return maps
+
+    def _after_commit(self, session: Session) -> None:
+        # Also fired when a savepoint is released; only publish on the real commit
+        if session.in_nested_transaction():
+            return
+        maps = session.info.pop(SESSION_KEY, None)
+        if maps is not None:
+            self._publish(maps)
+
+    @staticmethod
+    def _after_transaction_end(session: Session, transaction) -> None:
+        # A rolled back (or closed) transaction's rows are never published
+        if transaction.parent is None:
+            session.info.pop(SESSION_KEY, None)
+
+    def _publish(self, maps: _Maps) -> None:
+        with self._lock:
+            self.products_by_code.update(maps.products_by_code)
+            self.products_by_item_code.update(maps.products_by_item_code)
+            for table in ("suppliers", "categories"):
+                for index, rows in zip(self._indexes(table), maps._indexes(table)):
+                    for key, value in rows.items():
+                        index.setdefault(key, value)
+            for table, mark in maps.watermarks.items():
+                self.watermarks[table] = max(self.watermarks[table], mark)
+
+    def watermarks_for(self, session: Session) -> Dict[str, int]:
+        """
+        The watermarks as the session sees them, to pass to rollback_to().
+        """
+        maps = session.info.get(SESSION_KEY)
+        if maps is None:
+            return dict(self.watermarks)
+        return {table: max(mark, maps.watermarks[table]) for table, mark in self.watermarks.items()}
+
+    def update_products(self, rows: Iterable[ProductRow]) -> None:
+        """
+        Record committed changes to existing products, which the id watermark
+        cannot see.
+        """
+        with self._lock:
+            for row in rows:
+                self._add_product(row)
+
+    def rollback_to(self, session: Session, watermarks: Dict[str, int]) -> None:
+        """
+        Forget the rows above the given watermarks (from watermarks_for())
+        that the session's view picked up since, after a savepoint rollback.
+        Rows other sessions committed meanwhile are dropped too, but come
+        back with the next refresh, which restarts from there.
+        """
+        maps = session.info.get(SESSION_KEY)
+        if maps is None:
+            return
+        for table, mark in watermarks.items():
+            if maps.watermarks[table] <= mark:
+                continue
+            for index in maps._indexes(table):
+                for key in [k for k, v in index.items() if getattr(v, "id", v) > mark]:
+                    del index[key]
+            maps.watermarks[table] = mark
+
+    # --- lookups ---------------------------------------------------------
+
+    def _lookup(self, session: Session, table: str, index_name: str, keys: Iterable[Hashable], fetch) -> dict:
+        """
+        Resolve keys from the named index; misses trigger a watermark refresh
+        of the table and then one query (fetch) for the keys still unknown,
+        whose rows are added to the index.
+        """
+        self.ensure_loaded(session)
+        index = getattr(self, index_name)
+        maps = self._session_maps(session)
+        local = getattr(maps, index_name)
+        keys = list(dict.fromkeys(keys))
+        found = {key: index[key] if key in index else local[key] for key in keys if key in index or key in local}
+        missing = [key for key in keys if key not in found]
+        self.hits[table] += len(found)
+        if not missing:
+            return found
+
+        self.misses[table] += len(missing)
+        with self._lock:
+            self.refresh(session, table, maps)
+            still_missing = [key for key in missing if key not in index and key not in local]
+            if still_missing:
+                add = getattr(maps, self._adders[table])
+                for row in fetch(still_missing):
+                    add(row)
+        found.update((key, index[key] if key in index else local[key])
+                     for key in missing if key in index or key in local)
+        return found
+
+    def products(self, session: Session, codes: Iterable, key: str = "item_code") -> Dict[str, ProductEntry]:
+        """
+        Resolve product codes (by Product.code or Product.item_code) to their
+        entries. Codes are compared as strings; unknown codes are left out.
+        """
+        index_name = "products_by_item_code" if key == "item_code" else "products_by_code"
+        return self._lookup(
+            session, "products", index_name, (str(code) for code in codes),
+            lambda missing: select_by_keys(
+                session, (Product.id, Product.code, Product.item_code, Product.cost, Product.price, Product.tax_rate),
+                [Product.__table__.c[key]], missing)
+        )
+
+    def product_ids(self, session: Session, codes: Iterable, key: str = "item_code") -> Dict[str, int]:
+        return {code: entry.id for code, entry in self.products(session, codes, key).items()}
+
+    def suppliers(self, session: Session, keys: Iterable, key: str = "name") -> Dict[Hashable, int]:
+        """
+        Resolve supplier names (or external ids with key="external_id") to ids.
+        """
+        index_name = "suppliers_by_name" if key == "name" else "suppliers_by_external_id"
+        return self._lookup(
+            session, "suppliers", index_name, keys,
+            lambda missing: select_by_keys(session, (Supplier.id, Supplier.name, Supplier.external_id),
+                                           [Supplier.__table__.c[key]], missing)
+        )
+
+    def categories(self, session: Session, names: Iterable[str]) -> Dict[str, int]:
+        """
+        Resolve category names, regardless of parent, to ids.
+        """
+        return self._lookup(
+            session, "categories", "categories_by_name", names,
+            lambda missing: sorted(select_by_keys(session, (Category.id, Category.name, Category.parent_id),
+                                                  [Category.__table__.c.name], missing), key=lambda row: row.id)
+        )
+
+    def subcategories(self, session: Session, keys: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], int]:
+        """
+        Resolve (name, parent_id) pairs to category ids.
+        """
+        return self._lookup(
+            session, "categories", "categories_by_key", keys,
+            lambda missing: sorted(select_by_keys(session, (Category.id, Category.name, Category.parent_id),
+                                                  [Category.__table__.c.name, Category.__table__.c.parent_id],
+                                                  missing), key=lambda row: row.id)
+        )
+
+    def stats(self) -> dict:
+        tables = set(self.hits) | set(self.misses)
+        return {
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "products": len(self.products_by_item_code),
+            "product_codes": len(self.products_by_code),
+            "suppliers": len(self.suppliers_by_name),
+            "categories": len(self.categories_by_key),
+            "watermarks": dict(self.watermarks),
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "hit_rate": {
+                table: round(self.hits[table] / max(self.hits[table] + self.misses[table], 1), 3)
+                for table in sorted(tables)
+            },
+        }
+
+
+MASTER_DATA = MasterDataIndex()
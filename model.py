@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, func, Numeric,TIMESTAMP, Text, Enum
+from sqlalchemy import BigInteger, Column, Integer, String, Float, ForeignKey, Date, DateTime, func, Numeric,TIMESTAMP, Text, Enum
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -180,3 +180,13 @@ class Category(Base):
     parent_id = Column(Integer,  nullable=False)
     description = Column(String(255),  nullable=False)  
     category_code = Column(Integer,  nullable=False)  
+
+
+class ImportSequence(Base):
+    """
+    Counters shared by all import workers (see services.sequence_service).
+    next_value is the first value not reserved yet.
+    """
+    __tablename__ = "sma_import_sequences"
+    name = Column(String(50), primary_key=True)
+    next_value = Column(BigInteger, nullable=False)
@@ -0,0 +1,179 @@
+"""
+Column-level normalization stages that run once per imported file.
+
+Each stage keeps its state (inferred format, memoized values, rejected rows)
+across the batches of one file, so work done for the first batch is reused
+for the rest and problems are reported once at the end of the import.
+"""
+from datetime import date, datetime
+from typing import List, Optional, Tuple
+
+import pandas as pd
+from dateutil import parser as dateutil_parser
+
+# Candidate formats, day-first before month-first since the vendors write dd/mm.
+DATE_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y",
+    "%d/%m/%y",
+    "%d-%m-%Y",
+    "%d-%m-%y",
+    "%d.%m.%Y",
+    "%Y/%m/%d",
+    "%m/%d/%Y",
+    "%m-%d-%Y",
+]
+FORMAT_SAMPLE_SIZE = 500
+# Largest year pandas can represent; later expiries are clamped to it.
+MAX_EXPIRY_YEAR = 2262
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+# Arabic-Indic and Extended Arabic-Indic digits plus the Arabic decimal and
+# thousands separators, mapped to their ASCII equivalents.
+ARABIC_NUMERALS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹٫٬", "01234567890123456789.,")
+NUMBER_NOISE = "[,\\s\u00a0]"
+
+
+def parse_numeric(s: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """
+    Vectorized conversion of a money or quantity column to float64.
+
+    Handles thousands separators, stray spaces and Arabic-Indic digits.
+    Returns the converted column and a mask of cells that held something but
+    were not a number; those become NaN.
+    """
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return s.astype("float64"), pd.Series(False, index=s.index)
+
+    text = s.astype(str).str.translate(ARABIC_NUMERALS).str.replace(NUMBER_NOISE, "", regex=True)
+    missing = s.isna() | (text == "")
+    converted = pd.to_numeric(text.where(~missing), errors="coerce").astype("float64")
+    return converted, converted.isna() & ~missing
+
+
+class DateNormalizer:
+    """
+    Normalizes one date column of a file to datetime.date values.
+
+    The text format is inferred once from the first distinct values seen and
+    every distinct raw string is parsed only once. Values the inferred format
+    cannot read fall back to ISO and then dateutil. Years above max_year are
+    clamped. Cells that still cannot be parsed become None and are recorded in
+    errors as (row index, raw value).
+    """
+
+    def __init__(self, max_year: int = MAX_EXPIRY_YEAR):
+        self.max_year = max_year
+        self.date_format: Optional[str] = None
+        self.memo = {}
+        self.errors: List[Tuple[int, object]] = []
+
+    def infer_format(self, values: List[str]) -> Optional[str]:
+        sample = pd.Series(values[:FORMAT_SAMPLE_SIZE], dtype=object)
+        best, best_count = None, 0
+        for fmt in DATE_FORMATS:
+            count = pd.to_datetime(sample, format=fmt, errors="coerce").notna().sum()
+            if count > best_count:
+                best, best_count = fmt, count
+        return best
+
+    def _clamp(self, value: date) -> date:
+        if value.year > self.max_year:
+            try:
+                value = value.replace(year=self.max_year)
+            except ValueError:  # 29 February
+                value = value.replace(year=self.max_year, day=28)
+        return value.date() if isinstance(value, datetime) else value
+
+    def _parse_fallback(self, raw: str) -> Optional[date]:
+        dayfirst = bool(self.date_format) and self.date_format.startswith("%d")
+        try:
+            return self._clamp(dateutil_parser.parse(raw, dayfirst=dayfirst))
+        except (ValueError, OverflowError):
+            return None
+
+    def _parse_distinct(self, values: List[str]) -> None:
+        if self.date_format is None:
+            self.date_format = self.infer_format(values)
+
+        s = pd.Series(values, dtype=object)
+        if self.date_format:
+            parsed = pd.to_datetime(s, format=self.date_format, errors="coerce")
+        else:
+            parsed = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+        missing = parsed.isna()
+        if missing.any():
+            parsed[missing] = pd.to_datetime(s[missing], format="ISO8601", errors="coerce")
+
+        for raw, ts in zip(values, parsed):
+            self.memo[raw] = self._clamp(ts.to_pydatetime()) if pd.notna(ts) else self._parse_fallback(raw)
+
+    def _convert_value(self, value) -> Optional[date]:
+        if isinstance(value, datetime):
+            return self._clamp(value)
+        if isinstance(value, date):
+            return self._clamp(value)
+        if isinstance(value, (int, float)):
+            # Excel serial day number stored in a cell without a date format
+            try:
+                return self._clamp(EXCEL_EPOCH + pd.Timedelta(days=float(value)).to_pytimedelta())
+            except (ValueError, OverflowError):
+                return None
+        return self.memo.get(str(value).strip())
+
+    def normalize(self, s: pd.Series) -> Tuple[pd.Series, pd.Series]:
+        """
+        Return the normalized column (object dtype, date or None) and a mask
+        of rows whose value was present but could not be parsed.
+        """
+        if pd.api.types.is_datetime64_any_dtype(s):
+            out = s.map(lambda ts: self._clamp(ts.to_pydatetime()) if pd.notna(ts) else None).astype(object)
+            return out, pd.Series(False, index=s.index)
+
+        values = s[s.notna()]
+        is_text = values.map(lambda v: isinstance(v, str))
+        texts = values[is_text].astype(str).str.strip()
+        texts = texts[texts != ""]
+
+        new_values = [v for v in texts.unique() if v not in self.memo]
+        if new_values:
+            self._parse_distinct(new_values)
+
+        out = pd.Series(None, index=s.index, dtype=object)
+        out[texts.index] = texts.map(self.memo)
+        others = values[~is_text]
+        out[others.index] = others.map(self._convert_value)
+
+        present = texts.index.union(others.index)
+        invalid = pd.Series(False, index=s.index)
+        invalid[present] = out[present].isna()
+        self.errors.extend((idx, s[idx]) for idx in invalid[invalid].index)
+        return out.where(out.notna(), None), invalid
+
+
+class NumericNormalizer:
+    """
+    Converts the declared numeric columns of a file to float64, batch by
+    batch. Non-numeric cells are collected in errors as (row index, column,
+    raw value) and their rows flagged, instead of failing the whole batch
+    later on a float() call.
+    """
+
+    def __init__(self, columns: List[str]):
+        self.columns = list(columns)
+        self.errors: List[Tuple[int, str, object]] = []
+
+    def normalize(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Series]:
+        """
+        Return the batch with numeric columns converted and a mask of rows
+        holding at least one rejected cell.
+        """
+        invalid = pd.Series(False, index=df.index)
+        for col in self.columns:
+            converted, bad = parse_numeric(df[col])
+            if bad.any():
+                self.errors.extend((idx, col, df.at[idx, col]) for idx in bad[bad].index)
+                invalid |= bad
+            df[col] = converted
+        return df, invalid
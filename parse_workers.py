@@ -0,0 +1,57 @@
+"""
+Parsing stages that can run in worker processes.
+
+Everything here is CPU-bound pandas work with no database or task-log access,
+so it can be shipped to a ProcessPoolExecutor. Parsed rows go back to the
+process that owns the sessions and the task registry through a spill on disk
+(see batch_spill), only counts and errors are pickled.
+"""
+import os
+import time
+
+import pandas as pd
+
+from batch_spill import BatchSpill
+from layouts import LAYOUTS
+from normalization import DateNormalizer, NumericNormalizer
+from upload_cache import file_sha256, iter_cached_batches
+
+
+def prepare_abaad_batch(batch_df: pd.DataFrame, expiry_dates: DateNormalizer,
+                        numbers: NumericNormalizer) -> pd.DataFrame:
+    """
+    Normalize one Abaad batch and add the computed sale columns. Rows with an
+    unparseable expiry date or a non-numeric cell are dropped and recorded in
+    the normalizers' errors.
+    """
+    batch_df["item_expiry_date"], invalid_dates = expiry_dates.normalize(batch_df["item_expiry_date"])
+    batch_df, invalid_numbers = numbers.normalize(batch_df)
+    batch_df = batch_df[~(invalid_dates | invalid_numbers)]
+    batch_df["total_sale_vat"] = batch_df["item_total_sale_price"] * batch_df["vat_value"]
+    batch_df["total_sale"] = batch_df["item_total_sale_price"] + batch_df["total_sale_vat"]
+    return batch_df
+
+
+def parse_abaad_workbook(file_path: str, batch_size: int, spill_dir: str) -> dict:
+    """
+    Parse and normalize a whole Abaad workbook in a worker process, writing
+    the prepared batches to a spill in spill_dir as they are produced.
+
+    Returns the spill directory together with the rejected rows, the row
+    count and the parse time so the parent can log them under the file's
+    sub-task and stream the batches back with BatchSpill.open().
+    """
+    start = time.perf_counter()
+    expiry_dates = DateNormalizer()
+    numbers = NumericNormalizer(LAYOUTS["abaad"].numeric_columns)
+    spill = BatchSpill(spill_dir)
+    for batch_df in iter_cached_batches(file_path, LAYOUTS["abaad"], batch_size, file_sha256(file_path)):
+        spill.append(prepare_abaad_batch(batch_df, expiry_dates, numbers))
+    return {
+        "file_name": os.path.basename(file_path),
+        "spill_dir": spill_dir,
+        "rows": spill.rows,
+        "date_errors": expiry_dates.errors,
+        "numeric_errors": numbers.errors,
+        "seconds": time.perf_counter() - start,
+    }
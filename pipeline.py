@@ -0,0 +1,120 @@
+"""
+Overlap reading/transforming the next batch with writing the current one.
+
+A reader thread pulls batches from the source (parse cache or workbook),
+runs the transform on them and hands them over through a bounded queue; the
+import loop consumes them and does the database work. When the writer falls
+behind, the full queue blocks the reader (backpressure), so at most
+PIPELINE_QUEUE_SIZE prepared batches are held in memory.
+
+The time each side spent working and waiting is recorded: a reader that
+mostly waits on a full queue means the database is the bottleneck, a writer
+that mostly waits on an empty one means parsing is.
+"""
+import os
+import queue
+import threading
+import time
+from typing import Callable, Generic, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Prepared batches waiting for the writer
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2))
+# How often a reader blocked on a full queue checks whether the writer stopped
+_PUT_POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class BatchPipeline(Generic[T]):
+    """
+    Iterate over transform(batch) for every batch of source, prepared on a
+    reader thread while the caller writes the previous one. transform runs
+    in source order on the reader thread only; batches it returns None for
+    are dropped. An exception in the reader is raised in the caller at the
+    position it happened; leaving the loop early stops the reader.
+    """
+
+    def __init__(self, source: Iterable, transform: Optional[Callable[..., Optional[T]]] = None,
+                 maxsize: int = PIPELINE_QUEUE_SIZE):
+        self.source = source
+        self.transform = transform
+        self.maxsize = max(1, maxsize)
+        self.reader_busy = 0.0
+        self.reader_idle = 0.0
+        self.writer_busy = 0.0
+        self.writer_idle = 0.0
+        self.batches = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=self.maxsize)
+        self._stop = threading.Event()
+
+    def __iter__(self) -> Iterator[T]:
+        reader = threading.Thread(target=self._read, name="pipeline-reader", daemon=True)
+        reader.start()
+        try:
+            while True:
+                waiting = time.perf_counter()
+                item = self._queue.get()
+                received = time.perf_counter()
+                self.writer_idle += received - waiting
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+                self.writer_busy += time.perf_counter() - received
+        finally:
+            self._stop.set()
+            reader.join()
+
+    def _read(self) -> None:
+        try:
+            batches = iter(self.source)
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    break
+                if self.transform is not None:
+                    batch = self.transform(batch)
+                self.reader_busy += time.perf_counter() - start
+                if batch is None:
+                    continue
+                self.batches += 1
+                if not self._put(batch):
+                    return
+        except BaseException as e:
+            self._put(_Failure(e))
+            return
+        self._put(_DONE)
+
+    def _put(self, item) -> bool:
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=_PUT_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self.reader_idle += time.perf_counter() - start
+
+    def summary(self) -> List[str]:
+        if self.writer_busy >= self.reader_busy:
+            bottleneck = "writer (database)"
+        else:
+            bottleneck = "reader (parse/transform)"
+        return [
+            f"reader: {self.reader_busy:.2f}s busy, {self.reader_idle:.2f}s waiting on the writer",
+            f"writer: {self.writer_busy:.2f}s busy, {self.writer_idle:.2f}s waiting on the reader",
+            f"{self.batches} batches, queue size {self.maxsize}, bottleneck: {bottleneck}",
+        ]
@@ -0,0 +1,107 @@
+"""
+Pre-flight validation of an uploaded file against its vendor layout.
+
+Only the header and the first rows are read (read-only, no full parse), so a
+wrong or broken file is rejected right after upload instead of failing
+batch by batch in a background worker.
+"""
+import os
+import re
+import time
+from typing import List
+
+import pandas as pd
+
+from layouts import Layout
+from normalization import DateNormalizer, parse_numeric
+from utils import read_sample_rows
+
+PREFLIGHT_ROWS = int(os.getenv("PREFLIGHT_ROWS", 50))
+# Share of filled sample cells that may fail to parse before a column is
+# considered to be the wrong column rather than a few dirty cells.
+MAX_BAD_SHARE = 0.5
+
+
+def _label(value) -> str:
+    """
+    Header text reduced to lowercase letters and digits, so spacing,
+    punctuation and case differences between exports do not matter.
+    """
+    return re.sub(r"[^0-9a-z]", "", str(value).lower()) if value is not None else ""
+
+
+def _verdict(layout: Layout, errors: List[str], warnings: List[str], rows: int, start: float) -> dict:
+    return {
+        "ok": not errors,
+        "layout": layout.name,
+        "errors": errors,
+        "warnings": warnings,
+        "rows_checked": rows,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+
+def validate_sample(file_path: str, layout: Layout, sample_rows: int = PREFLIGHT_ROWS) -> dict:
+    """
+    Check column count, header names, dtypes and required fields of the first
+    sample_rows rows against the layout.
+
+    Returns a verdict dict; "ok" is False when the file should be rejected.
+    Problems that only affect some rows are returned as warnings, since the
+    pipelines already skip and report those rows.
+    """
+    start = time.perf_counter()
+    errors, warnings = [], []
+
+    try:
+        header, rows = read_sample_rows(file_path, sample_rows, layout.header_row)
+    except Exception as e:
+        return _verdict(layout, [f"File could not be read: {str(e)}"], warnings, 0, start)
+    if header is None:
+        return _verdict(layout, ["File is empty, no header row found"], warnings, 0, start)
+
+    try:
+        names, positions = layout.resolve(header)
+    except ValueError as e:
+        return _verdict(layout, [str(e)], warnings, 0, start)
+
+    width = max([len(header)] + [len(row) for row in rows])
+    needed = max(positions) + 1
+    if width < needed:
+        errors.append(f"Expected at least {needed} columns for {layout.name}, found {width}")
+        return _verdict(layout, errors, warnings, 0, start)
+
+    for name, position in zip(names, positions):
+        if position < len(layout.expected_header) and _label(header[position]) != _label(layout.expected_header[position]):
+            errors.append(f"Column {position + 1} ({name}) should be '{layout.expected_header[position]}', "
+                          f"found '{header[position]}'")
+
+    data = [tuple(row[p] if p < len(row) else None for p in positions) for row in rows]
+    df = pd.DataFrame.from_records(data, columns=names).dropna(how="all")
+    if df.empty:
+        errors.append("No data rows found under the header")
+        return _verdict(layout, errors, warnings, 0, start)
+
+    for col in layout.columns:
+        s = df[col.name]
+        filled = s.notna() & (s.astype(str).str.strip() != "")
+        if col.name in layout.required and not filled.all():
+            missing = int((~filled).sum())
+            if not filled.any():
+                errors.append(f"Required column '{col.name}' is empty")
+            else:
+                warnings.append(f"Required column '{col.name}' is empty on {missing} of {len(df)} sampled rows")
+
+        if col.dtype == "float":
+            _, bad = parse_numeric(s)
+        elif col.dtype == "date":
+            _, bad = DateNormalizer().normalize(s)
+        else:
+            continue
+        if bad.any():
+            share = bad.sum() / max(int(filled.sum()), 1)
+            sample = s[bad].iloc[0]
+            message = f"Column '{col.name}' has {int(bad.sum())} invalid {col.dtype} values (e.g. '{sample}')"
+            (errors if share > MAX_BAD_SHARE else warnings).append(message)
+
+    return _verdict(layout, errors, warnings, len(df), start)
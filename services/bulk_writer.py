@@ -0,0 +1,208 @@
+import csv
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+import pandas as pd
+from sqlalchemy import Table, insert, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+# Opt-in: LOAD DATA LOCAL INFILE also needs local_infile enabled on the server
+# and on the PyMySQL connection (connect_args={"local_infile": True}).
+LOAD_DATA_LOCAL_INFILE = os.getenv("LOAD_DATA_LOCAL_INFILE", "0") == "1"
+TSV_DIR = os.path.join("temp", "load_data")
+# MySQL errors meaning LOCAL INFILE is disabled by the server or the client
+LOCAL_INFILE_ERRORS = {1148, 2068, 3948}
+# Written for NULL cells and replaced by \N afterwards, since the csv writer
+# would escape the backslash of a literal \N
+_NULL_TOKEN = "\x01"
+
+# Why the server refused LOAD DATA LOCAL INFILE, once it has
+_local_infile_refused: Optional[str] = None
+# @@auto_increment_increment and @@innodb_autoinc_lock_mode of the server,
+# read once per process
+_auto_increment_step: Optional[int] = None
+_autoinc_lock_mode: Optional[int] = None
+# In this lock mode the ids of a multi-row INSERT may interleave with those
+# of concurrent inserts
+INTERLEAVED_LOCK_MODE = 2
+
+
+def frame_to_rows(df: pd.DataFrame) -> List[dict]:
+    """
+    Convert a frame of column arrays to insert parameters: native Python
+    values, with NaN/NaT as None.
+    """
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+def insert_rows(db: Session, table: Table, rows: List[dict]) -> int:
+    """
+    Insert rows through the session's connection without creating ORM
+    objects. The statement is compiled once and the rows are passed to the
+    driver's executemany, which PyMySQL sends as multi-row INSERT ... VALUES
+    statements (split only at its max_stmt_length). All rows must share the
+    same keys. Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    db.execute(insert(table), rows)
+    return len(rows)
+
+
+def insert_returning_ids(db: Session, table: Table, rows: List[dict], key: Optional[str] = None) -> List[int]:
+    """
+    Insert rows with one multi-row INSERT ... VALUES and return their
+    auto-increment ids in row order, without flushing ORM objects or a
+    SELECT LAST_INSERT_ID() per row. The rows must not carry an explicit id.
+
+    MySQL reports the id of the first row. InnoDB only hands such a "simple
+    insert" one consecutive block of ids (spaced by auto_increment_increment)
+    in innodb_autoinc_lock_mode 0 and 1. In mode 2 (interleaved, the MySQL 8
+    default) concurrent inserts can take ids in between, so the ids are read
+    back by key, a column unique among the rows, or without a key the rows
+    are inserted one at a time. SQLite reports the last row's id.
+    """
+    global _auto_increment_step, _autoinc_lock_mode
+    if not rows:
+        return []
+    mysql = db.get_bind().dialect.name == "mysql"
+    if mysql and _auto_increment_step is None:
+        step, mode = db.execute(text("SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode")).one()
+        _auto_increment_step, _autoinc_lock_mode = int(step), int(mode)
+    interleaved = mysql and _autoinc_lock_mode == INTERLEAVED_LOCK_MODE
+
+    if interleaved and key is None:
+        return [db.execute(insert(table).values(row)).lastrowid for row in rows]
+
+    result = db.execute(insert(table).values(rows))
+    if result.rowcount != len(rows):
+        raise RuntimeError(f"{table.name}: inserted {result.rowcount} of {len(rows)} rows")
+
+    if interleaved:
+        # The statement's ids still increase from the first one
+        keys = [row[key] for row in rows]
+        found = dict(db.execute(
+            select(table.c[key], table.c.id)
+            .where(table.c[key].in_(keys), table.c.id >= result.lastrowid)
+        ).all())
+        if len(found) != len(set(keys)) or len(keys) != len(set(keys)):
+            raise RuntimeError(f"{table.name}: {key} does not identify the {len(rows)} inserted rows")
+        return [found[k] for k in keys]
+    if mysql:
+        first, step = result.lastrowid, _auto_increment_step
+    else:
+        first, step = result.lastrowid - len(rows) + 1, 1
+    return [first + i * step for i in range(len(rows))]
+
+
+def write_tsv(df: pd.DataFrame, path: str) -> None:
+    """
+    Write a frame in the default LOAD DATA format: tab separated, newline
+    terminated, backslash escaped, \\N for NULL.
+    """
+    text = df.to_csv(sep="\t", header=False, index=False, na_rep=_NULL_TOKEN,
+                     quoting=csv.QUOTE_NONE, escapechar="\\", lineterminator="\n",
+                     date_format="%Y-%m-%d %H:%M:%S")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text.replace(_NULL_TOKEN, "\\N"))
+
+
+def load_data_infile(db: Session, table: Table, df: pd.DataFrame) -> int:
+    """
+    Load a frame into table with LOAD DATA LOCAL INFILE through the session's
+    connection, so it is part of the session's transaction. The frame is
+    written to a temporary TSV that is removed afterwards.
+    Returns the number of rows loaded.
+    """
+    os.makedirs(TSV_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".tsv", prefix=f"{table.name}_", dir=TSV_DIR)
+    os.close(fd)
+    try:
+        write_tsv(df, path)
+        columns = ", ".join(f"`{c}`" for c in df.columns)
+        file_name = os.path.abspath(path).replace("\\", "\\\\").replace("'", "\\'")
+        result = db.connection().exec_driver_sql(
+            f"LOAD DATA LOCAL INFILE '{file_name}' INTO TABLE `{table.name}` CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({columns})"
+        )
+        return result.rowcount
+    finally:
+        os.remove(path)
+
+
+class WriteStats:
+    """
+    Rows and seconds spent per write mode ("load_data" or "executemany"),
+    accumulated over an import (possibly from several writer threads), and
+    notes such as why a faster mode was not used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = Counter()
+        self.seconds = Counter()
+        self.notes: List[str] = []
+
+    def add(self, mode: str, rows: int, seconds: float) -> None:
+        with self._lock:
+            self.rows[mode] += rows
+            self.seconds[mode] += seconds
+
+    def merge(self, other: "WriteStats") -> None:
+        """
+        Add the rows, seconds and notes of another WriteStats.
+        """
+        with self._lock:
+            self.rows.update(other.rows)
+            self.seconds.update(other.seconds)
+            self.notes.extend(n for n in other.notes if n not in self.notes)
+
+    def note(self, message: str) -> None:
+        with self._lock:
+            if message not in self.notes:
+                self.notes.append(message)
+
+    def summary(self) -> List[str]:
+        return self.notes + [
+            f"{mode}: {self.rows[mode]} rows in {self.seconds[mode]:.2f}s "
+            f"({self.rows[mode] / max(self.seconds[mode], 1e-9):.0f} rows/s)"
+            for mode in self.rows
+        ]
+
+
+def write_frame(db: Session, table: Table, df: pd.DataFrame, stats: Optional[WriteStats] = None) -> int:
+    """
+    Write a frame of column arrays to table: with LOAD DATA LOCAL INFILE when
+    LOAD_DATA_LOCAL_INFILE is set and the database is MySQL, otherwise (or
+    once the server has refused local infile, which is noted in stats) with
+    insert_rows. Returns the number of rows written.
+    """
+    global _local_infile_refused
+    if df.empty:
+        return 0
+
+    start = time.perf_counter()
+    if LOAD_DATA_LOCAL_INFILE and db.get_bind().dialect.name == "mysql":
+        if _local_infile_refused is None:
+            try:
+                count = load_data_infile(db, table, df)
+                if stats is not None:
+                    stats.add("load_data", count, time.perf_counter() - start)
+                return count
+            except DBAPIError as e:
+                if not e.orig.args or e.orig.args[0] not in LOCAL_INFILE_ERRORS:
+                    raise
+                _local_infile_refused = str(e.orig)
+                start = time.perf_counter()
+        if stats is not None:
+            stats.note(f"LOAD DATA LOCAL INFILE refused ({_local_infile_refused}), fell back to executemany")
+
+    count = insert_rows(db, table, frame_to_rows(df))
+    if stats is not None:
+        stats.add("executemany", count, time.perf_counter() - start)
+    return count
@@ -1,17 +1,18 @@
 from sqlalchemy.orm import Session
 from model import Category
+from master_data import MASTER_DATA
 
 def get_existing_categories(session: Session, categories: list[str]) -> set[str]:
     """
     Get a set of product codes that already exist in the database.
     """
-    existing = session.query(Category.name).filter(Category.name.in_(categories)).all()
-    return {name for (name,) in existing}
+    return set(MASTER_DATA.categories(session, categories))
 
 def insert_missing_categories(session: Session, categories: list[dict]) -> None:
     """
     Insert missing products into the database.
     Each product dict should contain: name, code
+    Does not commit; the caller's commit policy decides when.
     """
     if not categories:
         return
@@ -24,5 +25,4 @@ def insert_missing_categories(session: Session, categories: list[dict]) -> None:
                                parent_id = p['parent_id']
                                ) for p in categories]
     session.bulk_save_objects(new_categories)
-    session.commit()
 
@@ -0,0 +1,75 @@
+"""
+Product discounts from the discount sheet (layouts.DISCOUNTS: ITEM_NO and the
+CREDIT / Cash Dis1-Dis3 columns), applied to sma_products by product id.
+"""
+from typing import List
+
+import pandas as pd
+from sqlalchemy import Integer, Numeric, column, exists, inspect, select, table, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from services.bulk_writer import frame_to_rows
+from services.key_staging import stage_rows
+
+DISCOUNT_COLUMNS = [
+    "cash_discount",
+    "cash_dis2",
+    "cash_dis3",
+    "credit_discount",
+    "credit_dis2",
+    "credit_dis3",
+]
+# cash_discount and credit_discount already exist in the live schema
+NEW_DISCOUNT_COLUMNS = ["cash_dis2", "cash_dis3", "credit_dis2", "credit_dis3"]
+
+# The live products table (the discount columns are not part of the Product model)
+PRODUCT_DISCOUNTS = table("sma_products", column("id", Integer),
+                          *(column(c, Numeric(10, 4)) for c in DISCOUNT_COLUMNS))
+
+
+def add_discount_columns(engine: Engine) -> List[str]:
+    """
+    Add the discount columns sma_products does not have yet. Returns the
+    columns added.
+    """
+    existing = {c["name"] for c in inspect(engine).get_columns(PRODUCT_DISCOUNTS.name)}
+    missing = [c for c in NEW_DISCOUNT_COLUMNS if c not in existing]
+    with engine.begin() as conn:
+        for name in missing:
+            conn.execute(text(f"ALTER TABLE {PRODUCT_DISCOUNTS.name} ADD COLUMN {name} DECIMAL(10, 4) DEFAULT NULL"))
+    return missing
+
+
+def discount_rows(batch_df: pd.DataFrame) -> List[dict]:
+    """
+    Update parameters for a parsed discount batch: the product id from
+    ITEM_NO (rows without one are dropped) and the six discounts, None for
+    empty cells. A product listed twice keeps its last row.
+    """
+    df = batch_df[batch_df["item_no"].notna()]
+    df = pd.DataFrame({"id": df["item_no"].astype("int64"), **{c: df[c] for c in DISCOUNT_COLUMNS}})
+    return frame_to_rows(df.drop_duplicates(subset=["id"], keep="last"))
+
+
+def update_product_discounts(session: Session, rows: List[dict]) -> dict:
+    """
+    Set all six discount columns of many products at once: the rows from
+    discount_rows() are loaded into a temporary table and applied with one
+    UPDATE ... JOIN (UPDATE ... FROM on SQLite). Does not commit.
+
+    Returns {"updated": rows matched by the update, "not_found": ids without
+    a product, found with one anti-join}.
+    """
+    if not rows:
+        return {"updated": 0, "not_found": []}
+    staging = stage_rows(session, PRODUCT_DISCOUNTS, ["id"] + DISCOUNT_COLUMNS, ["id"], rows)
+    not_found = session.execute(
+        select(staging.c.id).where(~exists().where(PRODUCT_DISCOUNTS.c.id == staging.c.id))
+    ).scalars().all()
+    result = session.execute(
+        update(PRODUCT_DISCOUNTS)
+        .values({c: staging.c[c] for c in DISCOUNT_COLUMNS})
+        .where(PRODUCT_DISCOUNTS.c.id == staging.c.id)
+    )
+    return {"updated": result.rowcount, "not_found": list(not_found)}
@@ -1,6 +1,13 @@
-from sqlalchemy import text
+from typing import Dict
+
+from sqlalchemy import String, column, exists, select, table, text, update
 from sqlalchemy.orm import Session
 
+from services.key_staging import stage_rows
+
+# The live products table (image_url_new is not part of the Product model)
+PRODUCT_IMAGES = table("sma_products", column("code", String(100)), column("image_url_new", String(255)))
+
 def update_product_image(session: Session, product_code: str, image_url: str) -> bool:
     """
     Update the image_url_new column for a product if it exists in sma_products table.
@@ -56,3 +63,32 @@ def check_product_exists(session: Session, product_code: str) -> bool:
     count = result.fetchone()[0]
     
     return count > 0
+
+
+def update_product_images(session: Session, images: Dict[str, str]) -> dict:
+    """
+    Set image_url_new for many products at once: the (code, url) pairs are
+    loaded into a temporary table and applied with one UPDATE ... JOIN
+    (UPDATE ... FROM on SQLite). Does not commit.
+
+    Args:
+        session: Database session
+        images: Product code -> image URL
+
+    Returns:
+        {"updated": rows matched by the update, "not_found": codes without a
+        product, found with one anti-join}
+    """
+    if not images:
+        return {"updated": 0, "not_found": []}
+    staging = stage_rows(session, PRODUCT_IMAGES, ["code", "image_url_new"], ["code"],
+                         [{"code": code, "image_url_new": url} for code, url in images.items()])
+    not_found = session.execute(
+        select(staging.c.code).where(~exists().where(PRODUCT_IMAGES.c.code == staging.c.code))
+    ).scalars().all()
+    result = session.execute(
+        update(PRODUCT_IMAGES)
+        .values(image_url_new=staging.c.image_url_new)
+        .where(PRODUCT_IMAGES.c.code == staging.c.code)
+    )
+    return {"updated": result.rowcount, "not_found": list(not_found)}
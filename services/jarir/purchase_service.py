@@ -2,11 +2,14 @@ import pandas as pd
 from sqlalchemy.orm import Session
 from model import Product, Purchase, PurchaseItem, Inventory, Transfer
 from datetime import datetime
+from typing import Dict, Optional
+from master_data import MASTER_DATA
+from services.sequence_service import next_reference
 import time
 import random
 
 
-def create_purchase(db: Session, batch_df) -> Purchase:
+def create_purchase(db: Session, batch_df, product_ids: Optional[Dict[str, int]] = None) -> Purchase:
     
     grand_total_purchase = 0.0
     grand_total_net_purchase = 0.0
@@ -50,16 +53,8 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         # df["total_sale_vat"] = df["item_total_sale_price"] * df["vat_value"]
         # df["total_sale"] = df["item_total_sale_price"] + df["total_sale_vat"]
 
-        expiry_date = None
-        if pd.notnull(item_data['item_expiry_date']):
-            try:
-                expiry_date = datetime.strptime(str(item_data['item_expiry_date']), "%Y-%m-%d").date()
-            except ValueError:
-                try:
-                    expiry_date = pd.to_datetime(item_data['item_expiry_date']).date()
-                except Exception:
-                    print(f"Invalid expiry date format for item_code {item_data['item_code']}: {item_data['item_expiry_date']}")
-                    continue
+        # Normalized once per file by the pipeline's DateNormalizer
+        expiry_date = item_data['item_expiry_date'] if pd.notnull(item_data['item_expiry_date']) else None
         item_before_vat = item_data['item_total_cost_price']
         
         # timestamp = int(time.time() * 10000)  # equivalent to microtime(true) * 10000
@@ -104,8 +99,9 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         "item_total_sale_price": item_data["item_total_sale_price"],
         })
 
+    ref_no = next_reference(db)
     new_purchase = Purchase(
-        reference_no='123456',
+        reference_no=str(ref_no),
         date=datetime.now(),
         supplier_id=supplier_id,
         supplier=supplier_name,
@@ -128,8 +124,8 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         paid='',
         status='received',
         created_by=9,
-        invoice_number='PR-123456',
-        sequence_code='INV-123456',
+        invoice_number=f'PR-{ref_no}',
+        sequence_code=f'INV-{ref_no}',
     )
     db.add(new_purchase)
     db.flush()  # so we get new_purchase.id
@@ -153,20 +149,23 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         grand_total=grand_transfer_total,
         type='purchase',
         status='completed',
-        sequence_code='TR-123456',
+        sequence_code=f'TR-{ref_no}',
         created_by=9,
-        invoice_number='TR-INV-123456'
+        invoice_number=f'TR-INV-{ref_no}'
     )
     db.add(new_transfer)
     db.flush()  # so we get new_transfer.id
     # After creating a transfer
 
     
+    if product_ids is None:
+        # Without a task-scoped map, resolve the batch through the master-data index
+        product_ids = MASTER_DATA.product_ids(db, [item['product_code'] for item in purchase_items], key="code")
+
     for item_data in purchase_items:
 
-        # Fetch product_id from database
-        product = db.query(Product).filter_by(code=item_data['product_code']).first()
-        product_id = product.id if product else None
+        # Resolved once per task by get_existing_product_codes / insert_missing_products
+        product_id = product_ids.get(str(item_data['product_code']))
        
         item = PurchaseItem(
             purchase_id=new_purchase.id,
@@ -304,7 +303,8 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         
 
 
-    db.commit()
+    # The caller commits (see commit_policy)
+    db.flush()
     return {
     "purchase_id": new_purchase.id,
     #"transfer_id": new_transfer.id
@@ -0,0 +1,85 @@
+"""
+Server-side resolution of natural keys (product codes, supplier names,
+category name/parent pairs) through a temporary staging table.
+
+Instead of sending the keys as one IN (...) list, they are bulk-loaded into a
+per-connection TEMPORARY table and resolved with one JOIN, and missing rows
+are created with one INSERT ... SELECT ... WHERE NOT EXISTS. The number of
+round trips does not grow with the number of keys, and no statement has to
+fit them all into max_allowed_packet.
+"""
+import os
+import zlib
+from typing import Hashable, List, Sequence
+
+from sqlalchemy import Column, MetaData, Table, and_, delete, exists, insert, select, tuple_
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+
+from services.bulk_writer import insert_rows
+
+# Below this many keys a plain IN list is cheaper than staging them
+STAGING_MIN_KEYS = int(os.getenv("STAGING_MIN_KEYS", 500))
+
+
+def stage_rows(session: Session, source: Table, columns: Sequence[str], key: Sequence[str], rows: List[dict]) -> Table:
+    """
+    Load rows into a temporary table shaped like the given columns of
+    source, with key as its primary key. The table is created once per
+    connection (its name depends on the columns) and emptied before use.
+    """
+    name = f"tmp_stage_{source.name}_{zlib.crc32(','.join(columns).encode()):08x}"
+    staging = Table(
+        name, MetaData(),
+        *[Column(c, source.c[c].type, primary_key=c in key, autoincrement=False) for c in columns],
+        prefixes=["TEMPORARY"],
+    )
+    session.execute(CreateTable(staging, if_not_exists=True))
+    session.execute(delete(staging))
+    insert_rows(session, staging, rows)
+    return staging
+
+
+def _key_rows(key_columns: Sequence[Column], keys: Sequence[Hashable]) -> List[dict]:
+    if len(key_columns) == 1:
+        return [{key_columns[0].name: k} for k in keys]
+    return [dict(zip((c.name for c in key_columns), k)) for k in keys]
+
+
+def select_by_keys(session: Session, columns: Sequence[Column], key_columns: Sequence[Column],
+                   keys: Sequence[Hashable]) -> list:
+    """
+    Select columns of the rows whose key_columns match keys (single values,
+    or tuples for a composite key): an IN list for a few keys, a JOIN with
+    the staged keys otherwise.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return []
+    target = key_columns[0].table
+    if len(keys) < STAGING_MIN_KEYS:
+        column = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
+        return session.execute(select(*columns).where(column.in_(keys))).all()
+
+    names = [c.name for c in key_columns]
+    staging = stage_rows(session, target, names, names, _key_rows(key_columns, keys))
+    on = and_(*(c == staging.c[c.name] for c in key_columns))
+    return session.execute(select(*columns).select_from(target).join(staging, on)).all()
+
+
+def insert_missing(session: Session, target: Table, key: Sequence[str], rows: List[dict]) -> int:
+    """
+    Insert the rows whose key is not in target yet with one
+    INSERT ... SELECT ... WHERE NOT EXISTS over the staged rows. All rows
+    share the same keys (target column names); repeated keys keep the last
+    row. Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    rows = list({tuple(r[k] for k in key): r for r in rows}.values())
+    columns = list(rows[0])
+    staging = stage_rows(session, target, columns, key, rows)
+    missing = select(*(staging.c[c] for c in columns)).where(
+        ~exists().where(and_(*(target.c[k] == staging.c[k] for k in key)))
+    )
+    return session.execute(insert(target).from_select(columns, missing)).rowcount
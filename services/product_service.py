@@ -1,17 +1,39 @@
+from typing import Dict, Optional, Sequence
+
+from sqlalchemy import event, or_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from model import Product
+from master_data import MASTER_DATA, ProductRow
+
+# MySQL CLIENT_FOUND_ROWS: unchanged duplicates count 1 affected row instead of 0
+CLIENT_FOUND_ROWS = 2
 
-def get_existing_product_codes(session: Session, product_codes: list[str]) -> set[str]:
+def get_existing_product_codes(session: Session, product_codes: list[str],
+                               product_ids: Optional[Dict[str, int]] = None) -> set[str]:
     """
     Get a set of product codes that already exist in the database.
+
+    Codes are resolved through the master-data index, so only codes it does
+    not know yet reach the database. With a task-scoped product_ids map
+    (item_code -> id), the ids found are added to it.
     """
-    existing = session.query(Product.item_code).filter(Product.item_code.in_(product_codes)).all()
-    return {item_code for (item_code,) in existing}
+    found = MASTER_DATA.product_ids(session, product_codes)
+    if product_ids is not None:
+        product_ids.update(found)
+    return set(found)
 
-def insert_missing_products(session: Session, products: list[dict]) -> None:
+def insert_missing_products(session: Session, products: list[dict],
+                            product_ids: Optional[Dict[str, int]] = None) -> None:
     """
     Insert missing products into the database.
     Each product dict should contain: name, code
+
+    With a task-scoped product_ids map, the ids of the new rows are added to
+    it, so purchase creation can resolve them without querying.
+
+    Does not commit; the caller's commit policy decides when (see commit_policy).
     """
     if not products:
         return
@@ -24,4 +46,68 @@ def insert_missing_products(session: Session, products: list[dict]) -> None:
                                item_code=p['item_code']
                                ) for p in products]
     session.bulk_save_objects(new_products)
-    session.commit()
+    if product_ids is not None:
+        # The new rows are above the index watermark, so this is one refresh query
+        product_ids.update(MASTER_DATA.product_ids(session, [p['item_code'] for p in products]))
+
+def upsert_products(session: Session, products: list[dict], update_columns: Sequence[str] = ()) -> dict:
+    """
+    Insert or update a batch of products with one multi-row
+    INSERT ... ON DUPLICATE KEY UPDATE (ON CONFLICT ... DO UPDATE on SQLite).
+
+    Each product dict holds Product columns, all with the same keys and at
+    least code; when a code repeats, the last dict wins. On a duplicate key
+    only update_columns are overwritten (none: existing products are left
+    as they are). Does not commit.
+
+    Returns {"inserted", "updated", "unchanged"}: the existing keys come from
+    the master-data index, the split between updated and unchanged rows from
+    the statement's affected-row count.
+    """
+    rows_by_code = {str(p["code"]): p for p in products}
+    rows = list(rows_by_code.values())
+    if not rows:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    existing = MASTER_DATA.products(session, rows_by_code, key="code")
+    inserted = len(rows) - len(existing)
+
+    if session.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(Product).values(rows)
+        stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_columns} or {"code": Product.code})
+        affected = session.execute(stmt).rowcount
+        # Affected rows per row: 1 inserted, 2 updated, 0 unchanged (1 with CLIENT_FOUND_ROWS,
+        # which SQLAlchemy sets by default)
+        client_flag = getattr(session.connection().connection.dbapi_connection, "client_flag", 0)
+        updated = affected - len(rows) if client_flag & CLIENT_FOUND_ROWS else (affected - inserted) // 2
+    else:
+        stmt = sqlite_insert(Product).values(rows)
+        if update_columns:
+            # Only rows whose values change are written, so rowcount matches MySQL's notion of updated
+            columns = Product.__table__.c
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["code"],
+                set_={c: stmt.excluded[c] for c in update_columns},
+                where=or_(*(columns[c].is_distinct_from(stmt.excluded[c]) for c in update_columns)),
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing()
+        updated = session.execute(stmt).rowcount - inserted
+
+    if existing and update_columns:
+        # The id watermark does not see updates; refresh the index once they are committed
+        changed = [
+            ProductRow(entry.id, code, rows_by_code[code].get("item_code"),
+                       rows_by_code[code]["cost"] if "cost" in update_columns else entry.cost,
+                       rows_by_code[code]["price"] if "price" in update_columns else entry.price,
+                       entry.tax_rate)
+            for code, entry in existing.items()
+        ]
+        commits = session.info.get("group_commit")
+        if commits is not None:
+            # Dropped with the batch's savepoint if it is rolled back
+            commits.on_commit(lambda: MASTER_DATA.update_products(changed))
+        else:
+            event.listen(session, "after_commit", lambda _: MASTER_DATA.update_products(changed), once=True)
+
+    return {"inserted": inserted, "updated": updated, "unchanged": len(existing) - updated}
@@ -1,131 +1,124 @@
+from typing import Dict, Optional
+
 import pandas as pd
 from sqlalchemy.orm import Session
 from model import Product, Purchase, PurchaseItem, Inventory, Transfer, Supplier
 from schemas import PurchaseCreateSchema, PurchaseItemCreateSchema
 from datetime import datetime
-from sqlalchemy import text
+from sqlalchemy import DateTime, Integer, Numeric, String, column, table, text
+from master_data import MASTER_DATA
+from services.bulk_writer import WriteStats, frame_to_rows, insert_returning_ids, write_frame
+from services.sequence_service import PURCHASE_REFERENCES, next_item_codes
 
 
-import random
-generated_codes = set()
-
-def generate_unique_item_code():
-    while True:
-        code = str(random.randint(100000, 999999))  # 6-digit code
-        if code not in generated_codes:
-            generated_codes.add(code)
-            return code
+def generate_unique_item_code(db: Session):
+    # Reserved in blocks from the shared sequence, unique across workers and restarts
+    return next_item_codes(db, 1)[0]
 
 
 from sqlalchemy import text
 from datetime import datetime
 
-def create_rawabi_purchase(db: Session, batch_df: pd.DataFrame) -> dict:
-    # 1. Pre-calculate totals using Pandas (Vectorized = Very Fast)
-    # These columns were calculated in the previous step
-    grand_total_purchase = batch_df['item_total_cost_price'].sum()
-    grand_total_sale = batch_df['item_total_sale_price'].sum()
-    grand_total = batch_df['item_total_after_vat'].sum()
-    total_vat = batch_df['item_total_vat'].sum()
-    grand_transfer_total = batch_df['total_sale'].fillna(0).sum()
-
-    # 2. Fetch all products for this batch in ONE query
-    unique_codes = batch_df['item_code'].dropna().unique().tolist()
-    product_map = {p.code: p.id for p in db.query(Product.id, Product.code).filter(Product.code.in_(unique_codes)).all()}
-
-    # 3. Create the Main Purchase Record
-    # Note: supplier_id is taken from the first row of the batch
-    supplier_id = batch_df.iloc[0]['supplier_id']
-    supplier_name = batch_df.iloc[0]['supplier_name']
-    
-    ref_no = f"PR-{int(datetime.now().timestamp())}"
-    
-    new_purchase = Purchase(
-        reference_no=ref_no,
-        date=datetime.now(),
-        supplier_id=supplier_id,
-        supplier=supplier_name,
-        warehouse_id=32,
-        total=grand_total_purchase,
-        total_net_purchase=grand_total_purchase,
-        total_sale=grand_total_sale,
-        total_tax=total_vat,
-        grand_total=grand_total,
-        status='received',
-        created_by=9,
-        note ="import from excel",
-        invoice_number=ref_no,
+# sma_purchase_orders mirrors the header of every imported purchase; it has no model
+PURCHASE_ORDERS = table(
+    "sma_purchase_orders",
+    column("id", Integer), column("reference_no", String), column("date", DateTime),
+    column("supplier_id", Integer), column("supplier", String), column("warehouse_id", Integer),
+    column("total", Numeric), column("total_net_purchase", Numeric), column("total_sale", Numeric),
+    column("total_tax", Numeric), column("grand_total", Numeric), column("status", String),
+    column("created_by", Integer), column("purchase_id", Integer),
+)
+
+def create_rawabi_purchases(db: Session, df: pd.DataFrame, write_stats: Optional[WriteStats] = None) -> Dict[int, int]:
+    """
+    Create one purchase per supplier_id for a whole prepared file.
+
+    The sma_purchases headers of all supplier groups are inserted with one
+    multi-row INSERT, then their sma_purchase_orders rows with another, and
+    the ids of both come from the statement's first insert id, or are read
+    back by reference_no when the server interleaves auto-increment ids (see
+    services.bulk_writer.insert_returning_ids), instead of a flush and a
+    SELECT LAST_INSERT_ID() per group. The items of every group are then
+    written in one pass. Does not commit.
+
+    Returns supplier_id -> sma_purchases.id, in supplier order.
+    """
+    df = df[df["supplier_id"].notna()]
+    if df.empty:
+        return {}
+
+    # 1. Totals per supplier (vectorized)
+    totals = df.groupby("supplier_id").agg(
+        supplier_name=("supplier_name", "first"),
+        total=("item_total_cost_price", "sum"),
+        total_sale=("item_total_sale_price", "sum"),
+        grand_total=("item_total_after_vat", "sum"),
+        total_tax=("item_total_vat", "sum"),
     )
-    db.add(new_purchase)
-    db.flush() # Get new_purchase.id
 
-    # 4. Handle Dual Insertion (sma_purchase_orders)
-    sma_po_sql = text("""
-        INSERT INTO sma_purchase_orders (reference_no, date, supplier_id, supplier, warehouse_id, 
-        total, total_net_purchase, total_sale, total_tax, grand_total, status, created_by, purchase_id)
-        VALUES (:ref, :dt, :sid, :sname, :wid, :tot, :tot_net, :tot_sale, :tax, :g_tot, :stat, :uid, :pid)
-    """)
-    db.execute(sma_po_sql, {
-        'ref': ref_no, 'dt': new_purchase.date, 'sid': supplier_id, 'sname': supplier_name,
-        'wid': 32, 'tot': grand_total_purchase, 'tot_net': grand_total_purchase,
-        'tot_sale': grand_total_sale, 'tax': total_vat, 'g_tot': grand_total,
-        'stat': 'pending', 'uid': 9, 'pid': new_purchase.id
+    # 2. Resolve all products of the file from the master-data index
+    unique_codes = df['item_code'].dropna().unique().tolist()
+    product_map = MASTER_DATA.product_ids(db, unique_codes, key="code")
+
+    # Numbers are reserved (in their own short transaction on MySQL) before this one writes anything
+    ref_nos = [f"PR-{n}" for n in PURCHASE_REFERENCES.take(db, len(totals))]
+    item_codes = next_item_codes(db, len(df))
+
+    # 3. Purchase headers, one row per supplier, each with its own reference number
+    now = datetime.now()
+    headers = pd.DataFrame({
+        "reference_no": ref_nos,
+        "date": now,
+        "supplier_id": totals.index,
+        "supplier": totals["supplier_name"].to_numpy(),
+        "warehouse_id": 32,
+        "total": totals["total"].to_numpy(),
+        "total_net_purchase": totals["total"].to_numpy(),
+        "total_sale": totals["total_sale"].to_numpy(),
+        "total_tax": totals["total_tax"].to_numpy(),
+        "grand_total": totals["grand_total"].to_numpy(),
+        "status": "received",
+        "created_by": 9,
+        "note": "import from excel",
+        "invoice_number": ref_nos,
     })
-    db.flush()
-    
-    # Get the inserted sma_purchase_orders id
-    sma_po_id = db.execute(text("SELECT LAST_INSERT_ID()")).scalar()
+    purchase_ids = insert_returning_ids(db, Purchase.__table__, frame_to_rows(headers), key="reference_no")
+
+    # 4. Dual insertion: the matching sma_purchase_orders rows
+    orders = headers[[c.name for c in PURCHASE_ORDERS.c if c.name in headers]].assign(
+        status="pending", purchase_id=purchase_ids)
+    order_ids = insert_returning_ids(db, PURCHASE_ORDERS, frame_to_rows(orders), key="reference_no")
+
+    # 5. Items of all groups, linked to sma_purchase_orders.id instead of sma_purchases.id
+    # (expiry dates are normalized once per file by the pipeline)
+    order_by_supplier = pd.Series(order_ids, index=totals.index)
+    items = pd.DataFrame({
+        "purchase_id": df["supplier_id"].map(order_by_supplier).astype("Int64"),
+        "product_id": df["item_code"].astype(str).map(product_map).astype("Int64"),
+        "product_code": df["item_code"],
+        "product_name": df["item_name"],
+        "net_unit_cost": df["item_cost_price"],
+        "quantity": df["item_quantity"],
+        "item_tax": df["item_total_vat"],
+        "expiry": df["item_expiry_date"],
+        "subtotal": df["item_total_cost_price"],
+        "unit_cost": df["item_cost_price"],
+        "real_unit_cost": df["item_purchase_price"],
+        "sale_price": df["item_sale_price"],
+        "batchno": df["item_batch_number"],
+        "avz_item_code": item_codes,
+    })
+    write_frame(db, PurchaseItem.__table__, items, write_stats)
 
-    # 5. Prepare Purchase Items for Bulk Insert
-    purchase_items = []
-    for _, row in batch_df.iterrows():
-        # Handle Expiry Date with validation
-        expiry = None
-        if pd.notnull(row['item_expiry_date']):
-            try:
-                # Use format='mixed' to handle out-of-bounds dates gracefully
-                expiry_date = pd.to_datetime(row['item_expiry_date'], format='mixed', errors='coerce')
-                
-                if pd.isna(expiry_date):
-                    # Try parsing as string manually for out-of-bounds dates
-                    from dateutil import parser
-                    expiry_date = parser.parse(str(row['item_expiry_date']))
-                    if expiry_date.year > 2262:
-                        expiry = expiry_date.replace(year=2262).date()
-                    else:
-                        expiry = expiry_date.date()
-                else:
-                    expiry = expiry_date.date()
-            except (ValueError, Exception):
-                # Invalid date format, skip
-                expiry = None
-
-        # Build item mapping
-        purchase_items.append({
-            "purchase_id": sma_po_id,  # Use sma_purchase_orders.id instead of sma_purchases.id
-            "product_id": product_map.get(str(row['item_code'])), # Look up from our map
-            "product_code": row["item_code"],
-            "product_name": row["item_name"],
-            "net_unit_cost": row["item_cost_price"],
-            "quantity": row["item_quantity"],
-            "actual_quantity": row["item_quantity"],
-            "item_tax": row["item_total_vat"],
-            "expiry": expiry,
-            "subtotal": row["item_total_cost_price"],
-            "unit_cost": row["item_cost_price"],
-            "real_unit_cost": row["item_purchase_price"],
-            "sale_price": row["item_sale_price"],
-            "batchno": row["item_batch_number"],
-            "avz_item_code": generate_unique_item_code(), # Assume this is a helper
-            "total_sale": row["total_sale"]
-        })
+    return dict(zip(totals.index.tolist(), purchase_ids))
 
-    # 6. Bulk Insert Items (Much faster than individual db.add)
-    if purchase_items:
-        # Use bulk_insert_mappings if you have a PurchaseItem model
-        db.bulk_insert_mappings(PurchaseItem, purchase_items)
-    
-    return {"purchase_id": new_purchase.id}
+
+def create_rawabi_purchase(db: Session, batch_df: pd.DataFrame) -> dict:
+    """
+    Purchase for a single supplier group (see create_rawabi_purchases).
+    """
+    purchase_ids = create_rawabi_purchases(db, batch_df)
+    return {"purchase_id": next(iter(purchase_ids.values()), None)}
 
 
 
@@ -226,7 +219,7 @@ def create_rawabi_purchase_old(db: Session, batch_df) -> Purchase:
         "totalbeforevat": item_before_vat,
         "main_net": item_data["item_total_after_vat"],
         "warehouse_shelf": '', #item_data['item_location_number'],
-        "avz_item_code": generate_unique_item_code(),
+        "avz_item_code": generate_unique_item_code(db),
         "second_discount_value": "",
         "transfer_subtotal": item_data["item_total_sale_price"],
         "transfer_total_tax": item_data["item_total_vat"],
@@ -3,9 +3,85 @@ from sqlalchemy.orm import Session
 from model import Product, Purchase, PurchaseItem, Inventory, Transfer
 from schemas import PurchaseCreateSchema, PurchaseItemCreateSchema
 from datetime import datetime
+from typing import Dict, Optional
+from services.bulk_writer import WriteStats, write_frame
+from master_data import MASTER_DATA
+from services.sequence_service import next_reference
 
+FROM_WAREHOUSE_ID = 32  # Example warehouse ID
+FROM_WAREHOUSE_NAME = "Retaj Warehouse"  # Example warehouse name
+FROM_WAREHOUSE_CODE = "2000"
 
-def create_purchase(db: Session, batch_df) -> Purchase:
+TO_WAREHOUSE_ID = 42
+TO_WAREHOUSE_NAME = "صيدلية سما الدواء الثانية"  # Example pharmacy name
+TO_WAREHOUSE_CODE = "2009"
+
+
+def create_purchase_headers(db: Session, total, total_net_purchase, total_sale, total_vat, grand_total,
+                            transfer_tax, transfer_grand_total, ref_no: Optional[int] = None):
+    """
+    Add the purchase and its transfer header rows and flush to get their ids.
+    ref_no is reserved here unless the caller reserved it already.
+    """
+    ref_no = ref_no or next_reference(db)
+    new_purchase = Purchase(
+        reference_no=str(ref_no),
+        date=datetime.now(),
+        supplier_id=686,
+        supplier='Internal Supplier',
+        warehouse_id=FROM_WAREHOUSE_ID,
+        note="import from excel",
+        total=total,
+        old_total_net_purchase=0.0,
+        total_net_purchase=total_net_purchase,
+        total_sale=total_sale,
+        product_discount=0.0,
+        order_discount_id='',
+        order_discount=0.0,
+        total_discount=0.0,
+        product_tax=0.0,
+        order_tax_id=0,
+        order_tax=0.0,
+        total_tax=total_vat,
+        shipping=0.0,
+        grand_total=grand_total,
+        paid=0.0,
+        status='received',
+        created_by=9,
+        invoice_number=f'PR-{ref_no}',
+        sequence_code=f'INV-{ref_no}',
+    )
+    db.add(new_purchase)
+    db.flush()  # so we get new_purchase.id
+
+    new_transfer = Transfer(
+        transfer_no=new_purchase.reference_no,
+        date=datetime.now(),
+        from_warehouse_id=FROM_WAREHOUSE_ID,
+        from_warehouse_name=FROM_WAREHOUSE_NAME,
+        from_warehouse_code=FROM_WAREHOUSE_CODE,
+        to_warehouse_id=TO_WAREHOUSE_ID,
+        to_warehouse_name=TO_WAREHOUSE_NAME,
+        to_warehouse_code=TO_WAREHOUSE_CODE,
+        note="import from excel",
+        attachment='',
+        total=new_purchase.total_sale,
+        total_cost=new_purchase.total,
+        total_tax=transfer_tax,
+        grand_total=transfer_grand_total,
+        type='purchase',
+        status='completed',
+        sequence_code=f'TR-{ref_no}',
+        created_by=9,
+        invoice_number=f'TR-INV-{ref_no}'
+    )
+    # disable for purchase only
+    db.add(new_transfer)
+    db.flush()  # so we get new_transfer.id
+    return new_purchase, new_transfer
+
+
+def create_purchase(db: Session, batch_df, product_ids: Optional[Dict[str, int]] = None) -> Purchase:
     
     grand_total_purchase = 0.0
     grand_total_net_purchase = 0.0
@@ -18,11 +94,6 @@ def create_purchase(db: Session, batch_df) -> Purchase:
     grand_transfer_total = 0.0
 
     purchase_items = []
-   
-
-    from_warehouse_id = 32  # Example warehouse ID
-    from_warehouse_name = "Retaj Warehouse"  # Example warehouse name
-    from_warehouse_code = "2000"
 
     # # FOR PURCHASE ONLY, DISABLE FOLLOWING QUEIRES
     # ADD TRANSFER
@@ -30,10 +101,6 @@ def create_purchase(db: Session, batch_df) -> Purchase:
     # ADD TRANSFER INVENTORY ITEMS
     ##
 
-    to_warehouse_id = 42
-    to_warehouse_name = "صيدلية سما الدواء الثانية"  # Example pharmacy name
-    to_warehouse_code = "2009"
-    
     # Insert purchase items
     for _, item_data in batch_df.iterrows(): 
 
@@ -47,16 +114,8 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         total_tansfer_sale_vat += float(item_data['total_sale_vat'])
         grand_transfer_total += float(item_data['total_sale'])
 
-        expiry_date = None
-        if pd.notnull(item_data['item_expiry_date']):
-            try:
-                expiry_date = datetime.strptime(str(item_data['item_expiry_date']), "%Y-%m-%d").date()
-            except ValueError:
-                try:
-                    expiry_date = pd.to_datetime(item_data['item_expiry_date']).date()
-                except Exception:
-                    print(f"Invalid expiry date format for item_code {item_data['item_code']}: {item_data['item_expiry_date']}")
-                    continue
+        # Normalized once per file by the pipeline's DateNormalizer
+        expiry_date = item_data['item_expiry_date'] if pd.notnull(item_data['item_expiry_date']) else None
         item_before_vat = item_data['item_total_cost_price']
 
         purchase_items.append({
@@ -96,71 +155,20 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         "item_total_sale_price": item_data["item_total_sale_price"],
         })
 
-    new_purchase = Purchase(
-        reference_no='123456',
-        date=datetime.now(),
-        supplier_id=686,
-        supplier='Internal Supplier',
-        warehouse_id=from_warehouse_id,
-        note="import from excel",
-        total=grand_total_purchase,
-        old_total_net_purchase=0.0,
-        total_net_purchase=grand_total_net_purchase,
-        total_sale=grand_total_sale,
-        product_discount=0.0,
-        order_discount_id='',
-        order_discount=0.0,
-        total_discount=0.0,
-        product_tax=0.0,
-        order_tax_id=0,
-        order_tax=0.0,
-        total_tax=total_vat,
-        shipping=0.0,
-        grand_total=grand_total,
-        paid=0.0,
-        status='received',
-        created_by=9,
-        invoice_number='PR-123456',
-        sequence_code='INV-123456',
-    )
-    db.add(new_purchase)
-    db.flush()  # so we get new_purchase.id
-   
-
-
-    new_transfer = Transfer(
-        transfer_no=new_purchase.reference_no,
-        date=datetime.now(),
-        from_warehouse_id=from_warehouse_id,
-        from_warehouse_name=from_warehouse_name,
-        from_warehouse_code=from_warehouse_code,
-        to_warehouse_id=to_warehouse_id,
-        to_warehouse_name=to_warehouse_name,   
-        to_warehouse_code=to_warehouse_code,
-        note="import from excel",
-        attachment='',
-        total=new_purchase.total_sale, 
-        total_cost=new_purchase.total,
-        total_tax=total_tansfer_sale_vat,
-        grand_total=grand_transfer_total,
-        type='purchase',
-        status='completed',
-        sequence_code='TR-123456',
-        created_by=9,
-        invoice_number='TR-INV-123456'
+    new_purchase, new_transfer = create_purchase_headers(
+        db, grand_total_purchase, grand_total_net_purchase, grand_total_sale, total_vat, grand_total,
+        total_tansfer_sale_vat, grand_transfer_total
     )
-    # disable for purchase only
-    db.add(new_transfer)
-    db.flush() 
-     # so we get new_transfer.id
-    # After creating a transfer
 
     
+    if product_ids is None:
+        # Without a task-scoped map, resolve the batch through the master-data index
+        product_ids = MASTER_DATA.product_ids(db, [item['product_code'] for item in purchase_items])
+
     for item_data in purchase_items:
 
-        # Fetch product_id from database
-        product = db.query(Product).filter_by(item_code=item_data['product_code']).first()
-        product_id = product.id if product else None
+        # Resolved once per task by get_existing_product_codes / insert_missing_products
+        product_id = product_ids.get(str(item_data['product_code']))
        
         item = PurchaseItem(
             purchase_id=new_purchase.id,
@@ -300,8 +308,117 @@ def create_purchase(db: Session, batch_df) -> Purchase:
         
 
 
+    purchase_id = new_purchase.id  # read before commit expires the object
     db.commit()
     return {
-    "purchase_id": new_purchase.id,
+    "purchase_id": purchase_id,
     "transfer_id": 0
    }
+
+
+def create_purchase_bulk(db: Session, batch_df: pd.DataFrame, product_ids: Optional[Dict[str, int]] = None,
+                         write_stats: Optional[WriteStats] = None, ref_no: Optional[int] = None) -> dict:
+    """
+    Set-based version of create_purchase for the same prepared batch.
+
+    Totals are column sums, product ids come from the task-scoped product_ids
+    map (or the master-data index without it), and the purchase items,
+    transfer items and the three inventory movements per row are built as
+    column arrays and written with write_frame (LOAD DATA LOCAL INFILE when
+    enabled, multi-row INSERTs otherwise), without creating ORM objects.
+    Write times per mode are added to write_stats. ref_no is the purchase
+    reference, when reserved by the caller. Does not commit.
+    """
+    grand_total_purchase = float(batch_df['item_total_cost_price'].sum())
+    new_purchase, new_transfer = create_purchase_headers(
+        db,
+        grand_total_purchase,
+        grand_total_purchase,
+        float(batch_df['item_total_sale_price'].sum()),
+        float(batch_df['item_total_vat'].sum()),
+        float(batch_df['item_total_after_vat'].sum()),
+        float(batch_df['total_sale_vat'].sum()),
+        float(batch_df['total_sale'].sum()),
+        ref_no,
+    )
+
+    codes = batch_df['item_code'].astype(str)
+    if product_ids is None:
+        product_ids = MASTER_DATA.product_ids(db, codes.unique().tolist())
+    item_product_ids = codes.map(product_ids).astype('Int64')
+    expiry = batch_df['item_expiry_date'].where(batch_df['item_expiry_date'].notna(), None)
+    quantity = batch_df['item_quantity']
+    today = datetime.now().date()
+
+    common = pd.DataFrame({
+        'product_id': item_product_ids,
+        'product_code': batch_df['item_code'],
+        'product_name': batch_df['item_name'],
+        'net_unit_cost': batch_df['item_cost_price'],
+        'quantity': quantity,
+        'discount': '',
+        'item_discount': 0.0,
+        'expiry': expiry,
+        'unit_cost': batch_df['item_cost_price'],
+        'real_unit_cost': batch_df['item_purchase_price'],
+        'sale_price': batch_df['item_sale_price'],
+        'date': today,
+        'unit_quantity': quantity,
+        'quantity_balance': quantity,
+        'option_id': None,
+        'quantity_received': quantity,
+        'batchno': batch_df['item_batch_number'],
+        'serial_number': '',
+        'bonus': 0,
+        'discount1': 0.0,
+        'discount2': 0.0,
+        'warehouse_shelf': '',
+        'avz_item_code': batch_df['item_ascon_code'],
+        'second_discount_value': 0.0,
+    })
+    purchase_items = common.assign(
+        purchase_id=new_purchase.id,
+        transfer_id=None,
+        warehouse_id=new_purchase.warehouse_id,
+        item_tax=batch_df['item_total_vat'],
+        subtotal=batch_df['item_total_cost_price'],
+        status='received',
+        totalbeforevat=batch_df['item_total_cost_price'],
+        main_net=batch_df['item_total_after_vat'],
+    )
+    transfer_items = common.assign(
+        purchase_id=None,
+        transfer_id=new_transfer.id,
+        warehouse_id=new_transfer.to_warehouse_id,
+        item_tax=batch_df['total_sale_vat'],
+        subtotal=batch_df['total_sale'],
+        status='completed',
+        totalbeforevat=batch_df['item_total_sale_price'],
+        main_net=batch_df['total_sale'],
+    )
+
+    movement = pd.DataFrame({
+        'product_id': item_product_ids,
+        'batch_number': batch_df['item_batch_number'],
+        'net_unit_cost': batch_df['item_cost_price'],
+        'expiry_date': expiry,
+        'net_unit_sale': batch_df['item_sale_price'],
+        'real_unit_cost': batch_df['item_purchase_price'],
+        'real_unit_sale': batch_df['item_sale_price'],
+        'avz_item_code': batch_df['item_ascon_code'],
+        'bonus': 0,
+        'customer_id': 0,
+    })
+    movements = pd.concat([
+        movement.assign(movement_date=new_purchase.date, type='purchase', quantity=quantity,
+                        location_id=new_purchase.warehouse_id, reference_id=new_purchase.id),
+        movement.assign(movement_date=new_transfer.date, type='transfer_in', quantity=quantity,
+                        location_id=new_transfer.to_warehouse_id, reference_id=new_transfer.id),
+        movement.assign(movement_date=new_transfer.date, type='transfer_out', quantity=-1 * quantity,
+                        location_id=new_transfer.from_warehouse_id, reference_id=new_transfer.id),
+    ], ignore_index=True)
+
+    write_frame(db, PurchaseItem.__table__, pd.concat([purchase_items, transfer_items], ignore_index=True), write_stats)
+    write_frame(db, Inventory.__table__, movements, write_stats)
+
+    return {"purchase_id": new_purchase.id, "transfer_id": new_transfer.id}
@@ -0,0 +1,138 @@
+"""
+Collision-free numbers for imported rows: avz_item_code and purchase
+reference numbers.
+
+Each sequence is a row of sma_import_sequences in the caller's database (the
+bind of the session passed in). On MySQL a process reserves a block of
+values with one statement in its own short transaction (so the row lock is
+not held for the duration of an import) and then hands the values out from
+memory. Values of a block that was never used are skipped, never reissued,
+so sequences can have gaps but no duplicates across workers, processes or
+restarts.
+
+SQLite allows one writer at a time, so a second connection would wait
+behind the import's own open transaction. There exactly the values needed
+are reserved on the caller's connection, inside its transaction: a rollback
+returns them together with the rows that used them.
+"""
+import os
+import threading
+from itertools import islice
+from typing import Dict, Iterator, List, Set
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from model import ImportSequence
+
+# Both start above the 6-digit random codes and the '123456' placeholder
+# references issued before, so they never meet an existing value.
+ITEM_CODE_START = int(os.getenv("ITEM_CODE_START", 1000000))
+ITEM_CODE_BLOCK = int(os.getenv("ITEM_CODE_BLOCK", 1000))
+REFERENCE_START = int(os.getenv("PURCHASE_REFERENCE_START", 1000000))
+REFERENCE_BLOCK = int(os.getenv("PURCHASE_REFERENCE_BLOCK", 50))
+
+_tables_ready: Set[Engine] = set()
+
+
+def _ensure_table(engine: Engine) -> None:
+    if engine not in _tables_ready:
+        ImportSequence.__table__.create(engine, checkfirst=True)
+        _tables_ready.add(engine)
+
+
+def reserves_in_own_transaction(engine: Engine) -> bool:
+    return engine.dialect.name == "mysql"
+
+
+def reserve_block(db: Session, name: str, count: int, start: int) -> int:
+    """
+    Reserve count consecutive values of the named sequence (created at
+    start on first use) in db's database and return the first one.
+
+    On MySQL this is one INSERT ... ON DUPLICATE KEY UPDATE on its own
+    connection, whose new next_value comes back through LAST_INSERT_ID(expr)
+    in the OK packet, so no SELECT is needed. Elsewhere it runs on db's
+    connection, in its transaction.
+    """
+    engine = db.get_bind()
+    table = ImportSequence.__table__
+    if reserves_in_own_transaction(engine):
+        _ensure_table(engine)
+        with engine.begin() as conn:
+            result = conn.execute(text(
+                "INSERT INTO sma_import_sequences (name, next_value) "
+                "VALUES (:name, LAST_INSERT_ID(:start + :count)) "
+                "ON DUPLICATE KEY UPDATE next_value = LAST_INSERT_ID(next_value + :count)"
+            ), {"name": name, "start": start, "count": count})
+            end = result.lastrowid or conn.execute(text("SELECT LAST_INSERT_ID()")).scalar()
+    else:
+        conn = db.connection()
+        table.create(conn, checkfirst=True)
+        stmt = sqlite_insert(table).values(name=name, next_value=start + count)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=["name"], set_={"next_value": table.c.next_value + count}))
+        end = conn.execute(select(table.c.next_value).where(table.c.name == name)).scalar()
+    return int(end) - count
+
+
+class BlockAllocator:
+    """
+    Hands out the values of one sequence from blocks reserved with
+    reserve_block(), one current block per database. Taking values is
+    lock-free (the GIL makes each next() on the block's range iterator
+    atomic); only reserving a new block takes the lock.
+    """
+
+    def __init__(self, name: str, start: int, block_size: int):
+        self.name = name
+        self.start = start
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._values: Dict[Engine, Iterator[int]] = {}
+
+    def take(self, db: Session, count: int = 1) -> List[int]:
+        """
+        Return count unused values of db's database, in increasing order for
+        a single caller. Requests larger than a block reserve exactly what
+        is missing.
+        """
+        engine = db.get_bind()
+        if not reserves_in_own_transaction(engine):
+            first = reserve_block(db, self.name, count, self.start)
+            return list(range(first, first + count))
+        values = list(islice(self._values.get(engine, ()), count))
+        while len(values) < count:
+            with self._lock:
+                values.extend(islice(self._values.get(engine, ()), count - len(values)))
+                missing = count - len(values)
+                if missing:
+                    size = max(missing, self.block_size)
+                    first = reserve_block(db, self.name, size, self.start)
+                    self._values[engine] = iter(range(first, first + size))
+        return values
+
+    def next(self, db: Session) -> int:
+        return self.take(db, 1)[0]
+
+    def reset(self) -> None:
+        """
+        Drop the current blocks (after a fork, so parent and child never
+        hand out the same values).
+        """
+        self._values = {}
+
+
+ITEM_CODES = BlockAllocator("avz_item_code", ITEM_CODE_START, ITEM_CODE_BLOCK)
+PURCHASE_REFERENCES = BlockAllocator("purchase_reference", REFERENCE_START, REFERENCE_BLOCK)
+os.register_at_fork(after_in_child=lambda: (ITEM_CODES.reset(), PURCHASE_REFERENCES.reset()))
+
+
+def next_item_codes(db: Session, count: int) -> List[str]:
+    return [str(value) for value in ITEM_CODES.take(db, count)]
+
+
+def next_reference(db: Session) -> int:
+    return PURCHASE_REFERENCES.next(db)
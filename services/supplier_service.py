@@ -1,17 +1,18 @@
 from sqlalchemy.orm import Session
 from model import Supplier
+from master_data import MASTER_DATA
 
 def get_existing_suppliers(session: Session, suppliers: list[str]) -> set[str]:
     """
     Get a set of product codes that already exist in the database.
     """
-    existing = session.query(Supplier.name).filter(Supplier.name.in_(suppliers)).all()
-    return {name for (name,) in existing}
+    return set(MASTER_DATA.suppliers(session, suppliers))
 
 def insert_missing_suppliers(session: Session, suppliers: list[dict]) -> None:
     """
     Insert missing products into the database.
     Each product dict should contain: name, code
+    Does not commit; the caller's commit policy decides when.
     """
     if not suppliers:
         return
@@ -22,4 +23,3 @@ def insert_missing_suppliers(session: Session, suppliers: list[dict]) -> None:
                                company='Jarir'
                                ) for p in suppliers]
     session.bulk_save_objects(new_suppliers)
-    session.commit()
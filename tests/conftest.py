@@ -0,0 +1,32 @@
+"""
+Shared fixtures. The modules under test run against SQLite files here; the
+MySQL-only branches are reached by patching the dialect check where noted.
+"""
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    A SQLite file database whose transactions take the write lock up front
+    (BEGIN IMMEDIATE), so concurrent writers wait for each other instead of
+    failing to upgrade a read lock.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'import.db'}", connect_args={"timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def _no_implicit_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin_immediate(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    yield engine
+    engine.dispose()
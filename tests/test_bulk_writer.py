@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, select
+from sqlalchemy.orm import Session
+
+from services import bulk_writer
+from services.bulk_writer import insert_returning_ids
+
+metadata = MetaData()
+orders = Table("orders", metadata,
+               Column("id", Integer, primary_key=True, autoincrement=True),
+               Column("reference_no", String(20)),
+               Column("supplier", String(20)))
+
+
+@pytest.fixture
+def db(engine):
+    metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def rows_by_id(db):
+    return dict(db.execute(select(orders.c.id, orders.c.reference_no)).all())
+
+
+def test_ids_are_returned_in_row_order(db):
+    db.execute(orders.insert(), [{"reference_no": "old", "supplier": "x"}])
+    rows = [{"reference_no": f"PR-{n}", "supplier": s} for n, s in enumerate("cab")]
+    ids = insert_returning_ids(db, orders, rows)
+    assert ids == sorted(ids) and len(set(ids)) == 3
+    stored = rows_by_id(db)
+    assert [stored[i] for i in ids] == ["PR-0", "PR-1", "PR-2"]
+
+
+def test_no_rows_inserts_nothing(db):
+    assert insert_returning_ids(db, orders, []) == []
+    assert rows_by_id(db) == {}
+
+
+@pytest.fixture
+def interleaved(db, monkeypatch):
+    """
+    MySQL in innodb_autoinc_lock_mode 2, where a multi-row INSERT's ids may
+    interleave with other inserts. SQLite stands in for the server: only the
+    dialect check and the cached server variables are patched.
+    """
+    monkeypatch.setattr(db.get_bind().dialect, "name", "mysql")
+    monkeypatch.setattr(bulk_writer, "_auto_increment_step", 1)
+    monkeypatch.setattr(bulk_writer, "_autoinc_lock_mode", bulk_writer.INTERLEAVED_LOCK_MODE)
+    return db
+
+
+def test_interleaved_without_key_inserts_row_by_row(interleaved, monkeypatch):
+    db = interleaved
+    executed = []
+    original = db.execute
+    monkeypatch.setattr(db, "execute", lambda stmt, *a, **k: executed.append(stmt) or original(stmt, *a, **k))
+    rows = [{"reference_no": f"PR-{n}", "supplier": "s"} for n in range(4)]
+    ids = insert_returning_ids(db, orders, rows)
+    assert len(executed) == 4
+    stored = rows_by_id(db)
+    assert [stored[i] for i in ids] == ["PR-0", "PR-1", "PR-2", "PR-3"]
+
+
+def test_interleaved_reads_ids_back_by_key(interleaved):
+    db = interleaved
+    # An older row with the same key must not be picked up
+    db.execute(orders.insert(), [{"reference_no": "PR-1", "supplier": "old"}])
+    ids = insert_returning_ids(db, orders, [{"reference_no": "PR-1", "supplier": "new"}], key="reference_no")
+    assert db.execute(select(orders.c.supplier).where(orders.c.id == ids[0])).scalar() == "new"
+
+
+def test_interleaved_rejects_a_key_that_does_not_identify_the_rows(interleaved):
+    rows = [{"reference_no": "PR-1", "supplier": "a"}, {"reference_no": "PR-1", "supplier": "b"}]
+    with pytest.raises(RuntimeError):
+        insert_returning_ids(interleaved, orders, rows, key="reference_no")
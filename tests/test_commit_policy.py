@@ -0,0 +1,133 @@
+import pandas as pd
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+import commit_policy
+import delta_snapshot
+from commit_policy import GroupCommit, parse_policy
+from delta_snapshot import DeltaSnapshot
+from master_data import MasterDataIndex
+from model import Base, Category, Product, Supplier
+
+
+@pytest.fixture
+def index(engine, monkeypatch):
+    """
+    GroupCommit sessions on the test database, with a master-data index of
+    their own.
+    """
+    Base.metadata.create_all(engine, tables=[t.__table__ for t in (Product, Supplier, Category)])
+    index = MasterDataIndex()
+    monkeypatch.setattr(commit_policy, "SessionLocal", sessionmaker(bind=engine))
+    monkeypatch.setattr(commit_policy, "MASTER_DATA", index)
+    with sessionmaker(bind=engine)() as session:
+        index.load(session)
+    return index
+
+
+def add_product(session, code):
+    product = Product(name=code, name_ar=code, code=code, item_code=code, cost=1, price=2)
+    session.add(product)
+    session.flush()
+    return product.id
+
+
+def product_codes(engine):
+    with sessionmaker(bind=engine)() as session:
+        return sorted(session.scalars(select(Product.code)))
+
+
+def test_parse_policy():
+    assert parse_policy("batch") == 1
+    assert parse_policy("file") is None
+    assert parse_policy(" 5 ") == 5
+    assert parse_policy("0") == 1
+
+
+def test_rolled_back_batch_leaves_no_rows_ids_or_index_entries(engine, index):
+    product_ids = {}
+    commits = GroupCommit("file")
+    commits.track(product_ids)
+    for code in commits.batches(["A", "B", "C"]):
+        session = commits.begin_batch()
+        try:
+            product_ids[code] = add_product(session, code)
+            # The batch's own row is visible to lookups made in its transaction
+            assert index.product_ids(session, [code], key="code") == {code: product_ids[code]}
+            if code == "B":
+                raise ValueError("bad batch")
+            commits.end_batch()
+        except ValueError:
+            commits.rollback_batch()
+        # Nothing is published to the shared index before the commit
+        assert index.products_by_code == {}
+
+    assert product_codes(engine) == ["A", "C"]
+    assert sorted(product_ids) == ["A", "C"]
+    assert sorted(index.products_by_code) == ["A", "C"]
+    assert commits.summary() == "commit policy file: 2 batches in 1 commits, 1 rolled back"
+
+
+def test_full_rollback_drops_all_pending_batches(engine, index):
+    product_ids = {}
+    commits = GroupCommit("file")
+    commits.track(product_ids)
+    session = commits.begin_batch()
+    product_ids["A"] = add_product(session, "A")
+    index.product_ids(session, ["A"], key="code")
+    commits.end_batch()
+
+    commits.begin_batch()
+    commits._rollback_all()
+    commits.close()
+
+    assert product_codes(engine) == []
+    assert product_ids == {}
+    assert index.products_by_code == {}
+
+
+def test_commits_every_n_batches_and_runs_callbacks_after_commit(engine, index):
+    committed = []
+    commits = GroupCommit("2")
+    for code in commits.batches(["A", "B", "C", "D", "E"]):
+        session = commits.begin_batch()
+        add_product(session, code)
+        commits.on_commit(lambda code=code: committed.append((code, product_codes(engine))))
+        if code == "D":
+            commits.rollback_batch()
+            continue
+        commits.end_batch()
+        if code == "B":
+            assert [c for c, _ in committed] == ["A", "B"]
+
+    # A+B, then C+E, as the rolled back D does not count towards the policy
+    assert commits.commits == 2
+    # Callbacks only run once their rows are visible to other sessions, and
+    # the rolled back batch's callback never runs
+    assert [c for c, _ in committed] == ["A", "B", "C", "E"]
+    assert all(code in visible for code, visible in committed)
+
+
+def test_delta_rows_are_marked_only_once_committed(engine, index, tmp_path, monkeypatch):
+    monkeypatch.setattr(delta_snapshot, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    df = pd.DataFrame({"item_code": ["A", "B"], "item_batch_number": ["1", "1"], "price": [1.0, 2.0]})
+
+    delta = DeltaSnapshot("test", ["price"])
+    commits = GroupCommit("batch")
+    for code in commits.batches(["A", "B"]):
+        batch_df = delta.filter(df[df["item_code"] == code])
+        session = commits.begin_batch()
+        add_product(session, code)
+        commits.on_commit(lambda batch_df=batch_df: delta.mark(batch_df))
+        if code == "B":
+            commits.rollback_batch()
+        else:
+            commits.end_batch()
+    delta.save()
+
+    # The next import skips the committed row and retries the rolled back one
+    again = DeltaSnapshot("test", ["price"])
+    assert again.filter(df)["item_code"].tolist() == ["B"]
+    with sessionmaker(bind=engine)() as session:
+        assert session.scalar(select(func.count()).select_from(Product)) == 1
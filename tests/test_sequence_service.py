@@ -0,0 +1,110 @@
+import multiprocessing
+import threading
+
+import pytest
+from sqlalchemy.orm import Session
+
+from services import sequence_service
+from services.sequence_service import BlockAllocator
+
+
+def take_in_threads(allocator, engine, threads=8, calls=20, count=5):
+    taken, errors = [], []
+
+    def work():
+        try:
+            for _ in range(calls):
+                with Session(engine) as db:
+                    taken.extend(allocator.take(db, count))
+                    db.commit()
+        except Exception as e:  # surfaced by the assertion below
+            errors.append(e)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors, errors
+    return taken
+
+
+def test_sqlite_values_are_unique_across_threads(engine):
+    allocator = BlockAllocator("test_sequence", 1000, 10)
+    taken = take_in_threads(allocator, engine)
+    assert len(taken) == 8 * 20 * 5
+    assert len(set(taken)) == len(taken)
+    assert min(taken) == 1000
+
+
+def test_sqlite_rollback_returns_the_values(engine):
+    allocator = BlockAllocator("test_sequence", 1000, 10)
+    with Session(engine) as db:
+        first = allocator.take(db, 3)
+        db.rollback()
+        assert allocator.take(db, 3) == first
+        db.commit()
+        assert allocator.take(db, 2) == [1003, 1004]
+
+
+@pytest.fixture
+def shared_blocks(monkeypatch):
+    """
+    The MySQL path (blocks handed out from memory) with reserve_block backed
+    by a counter shared between processes instead of the database.
+    """
+    counter = multiprocessing.Value("q", 1000)
+    calls = multiprocessing.Value("q", 0)
+
+    def reserve_block(db, name, count, start):
+        with counter.get_lock():
+            first = counter.value
+            counter.value += count
+            calls.value += 1
+        return first
+
+    monkeypatch.setattr(sequence_service, "reserves_in_own_transaction", lambda engine: True)
+    monkeypatch.setattr(sequence_service, "reserve_block", reserve_block)
+    return calls
+
+
+def test_blocks_are_unique_across_threads(engine, shared_blocks):
+    allocator = BlockAllocator("test_sequence", 1000, 50)
+    taken = take_in_threads(allocator, engine, count=3)
+    assert len(set(taken)) == len(taken) == 8 * 20 * 3
+    # Values come from whole blocks, not one reservation per call
+    assert shared_blocks.value <= len(taken) // 50 + 8
+
+
+def test_large_request_reserves_what_is_missing(engine, shared_blocks):
+    allocator = BlockAllocator("test_sequence", 1000, 10)
+    with Session(engine) as db:
+        assert allocator.take(db, 4) == [1000, 1001, 1002, 1003]
+        # The rest of the block, then exactly the 19 values still missing
+        assert allocator.take(db, 25) == list(range(1004, 1029))
+        assert shared_blocks.value == 2
+        # The next block starts after them
+        assert allocator.next(db) == 1029
+
+
+def _take_in_child(engine, queue):
+    with Session(engine) as db:
+        queue.put(sequence_service.next_item_codes(db, 3))
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_forked_child_never_reuses_the_parents_block(engine, shared_blocks):
+    allocator = sequence_service.ITEM_CODES
+    allocator.reset()
+    with Session(engine) as db:
+        parent = allocator.take(db, 1)
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        child = context.Process(target=_take_in_child, args=(engine, queue))
+        child.start()
+        child_values = [int(v) for v in queue.get(timeout=30)]
+        child.join(30)
+        parent += allocator.take(db, 3)
+    allocator.reset()
+    assert child.exitcode == 0
+    assert not set(parent) & set(child_values)
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import tempfile
+from typing import Iterator, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from layouts import Layout
+from utils import iter_excel_batches
+
+CACHE_DIR = os.path.join("temp", "parse_cache")
+CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(file_path: str) -> str:
+    """
+    Compute the SHA-256 of a file without loading it into memory.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(layout: Layout, content_hash: str) -> str:
+    """
+    Cache entries are keyed by vendor layout (including its definition) and
+    file content, so the same workbook parsed with a different column mapping
+    never collides.
+    """
+    return os.path.join(CACHE_DIR, f"{layout.cache_key}_{content_hash}.parquet")
+
+
+def is_cached(layout: Layout, content_hash: Optional[str]) -> bool:
+    return bool(content_hash) and os.path.exists(cache_path(layout, content_hash))
+
+
+def arrow_compatible(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The batch with its object columns mixing numbers and text (batch numbers,
+    codes) converted to text, since Parquet needs one type per column.
+    """
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True).startswith("mixed"):
+            df[col] = df[col].map(lambda v: v if pd.isna(v) else str(v))
+    return df
+
+
+def _to_arrow(df: pd.DataFrame, schema: Optional[pa.Schema] = None) -> pa.Table:
+    """
+    Convert a parsed batch to Arrow (see arrow_compatible).
+    """
+    return pa.Table.from_pandas(arrow_compatible(df), schema=schema, preserve_index=False)
+
+
+def evict_cache(max_bytes: int = CACHE_MAX_BYTES) -> None:
+    """
+    Remove least recently used entries until the cache fits in max_bytes.
+    Hits touch the file, so mtime order is LRU order.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.endswith(".parquet") and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def iter_cached_batches(file_path: str, layout: Layout, batch_size: int,
+                        content_hash: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    Same contract as utils.iter_excel_batches, but backed by a Parquet cache.
+
+    On a hit the parsed, column-mapped batches are read back from Parquet.
+    On a miss the Excel file is streamed as usual and every batch is also
+    appended to a new cache entry, which only becomes visible once the whole
+    file has been read. Caching problems never interrupt the import.
+    """
+    if not content_hash:
+        yield from iter_excel_batches(file_path, batch_size, layout)
+        return
+
+    path = cache_path(layout, content_hash)
+    if os.path.exists(path):
+        os.utime(path)
+        start = 0
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            df = record_batch.to_pandas()
+            df.index = pd.RangeIndex(start, start + len(df))
+            start += len(df)
+            yield df
+        return
+
+    # A temp file of its own per import, so concurrent misses on the same
+    # content (threads of one worker included) never share one
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=os.path.basename(path) + ".", suffix=".tmp")
+        os.close(fd)
+        writer = None
+    except OSError:
+        tmp_path, writer = None, False
+    try:
+        for df in iter_excel_batches(file_path, batch_size, layout):
+            if writer is not False:
+                try:
+                    table = _to_arrow(df, writer.schema if writer else None)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp_path, table.schema)
+                    writer.write_table(table)
+                except (pa.ArrowException, ValueError, TypeError, OSError):
+                    if writer:
+                        writer.close()
+                    writer = False
+            yield df
+
+        if writer:
+            writer.close()
+            try:
+                os.replace(tmp_path, path)
+                evict_cache()
+            except OSError:
+                pass
+    finally:
+        if writer:
+            writer.close()
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -1,21 +1,331 @@
 import pandas as pd
-from typing import List
-from openpyxl import Workbook
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.datetime import from_excel
+import datetime
+import itertools
 import os
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
 from sqlalchemy import func
 from model import Purchase, Transfer , PurchaseItem
 from sqlalchemy.orm import Session
 from openpyxl.utils import get_column_letter
+from layouts import Layout
 
 
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # optional, fastest reader when installed
+    CalamineWorkbook = None
+
 
 def read_excel_file(file_path: str, **kwargs) -> pd.DataFrame:
     """
-    Read the Excel file into a DataFrame.
+    Read the Excel file into a DataFrame, with the calamine engine when it
+    is installed unless an engine is given.
     """
+    if CalamineWorkbook is not None and not file_path.lower().endswith(".csv"):
+        kwargs.setdefault("engine", "calamine")
     return pd.read_excel(file_path, **kwargs)
 
+
+# --- Sheet row readers ---
+#
+# Each reader streams the first sheet of a file as tuples of cell values,
+# with the same conventions as openpyxl in read-only mode: whole numbers as
+# int, dates as datetime, empty cells as None, gaps between rows filled with
+# empty rows. max_col limits the cells materialized per row.
+
+SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+# calamine materializes the whole sheet, so it is only picked for .xls files
+# (which xlrd loads whole as well) and xlsx files small enough that this does
+# not matter; the rest is streamed with the SAX reader to keep memory flat.
+# See benchmarks/bench_readers.py.
+CALAMINE_MAX_BYTES = int(float(os.getenv("CALAMINE_MAX_MB", 2)) * 1024 * 1024)
+
+
+def _plain_value(value):
+    """
+    Bring a value from calamine or xlrd in line with openpyxl: whole floats
+    become int and plain dates become datetime.
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    if value == "":
+        return None
+    return value
+
+
+def iter_openpyxl_rows(file_path: str, max_col: Optional[int] = None) -> Iterator[tuple]:
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(max_col=max_col, values_only=True)
+    finally:
+        wb.close()
+
+
+def _first_sheet_path(archive: zipfile.ZipFile) -> str:
+    workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+    rel_id = workbook.find(f"{SHEET_NS}sheets/{SHEET_NS}sheet").get(f"{REL_NS}id")
+    rels = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{PKG_REL_NS}Relationship"):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target")
+            return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+    raise ValueError("First worksheet not found in workbook")
+
+
+def _shared_strings(archive: zipfile.ZipFile) -> List[str]:
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    strings = []
+    with archive.open("xl/sharedStrings.xml") as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == f"{SHEET_NS}si":
+                strings.append("".join(t.text or "" for t in elem.iter(f"{SHEET_NS}t")))
+                elem.clear()
+    return strings
+
+
+def _date_styles(archive: zipfile.ZipFile) -> set:
+    """
+    Indexes of the cell styles whose number format displays a date.
+    """
+    if "xl/styles.xml" not in archive.namelist():
+        return set()
+    styles = ET.fromstring(archive.read("xl/styles.xml"))
+    formats = dict(BUILTIN_FORMATS)
+    for fmt in styles.iter(f"{SHEET_NS}numFmt"):
+        formats[int(fmt.get("numFmtId"))] = fmt.get("formatCode")
+    xfs = styles.find(f"{SHEET_NS}cellXfs")
+    if xfs is None:
+        return set()
+    return {
+        i for i, xf in enumerate(xfs.iter(f"{SHEET_NS}xf"))
+        if is_date_format(formats.get(int(xf.get("numFmtId", 0)), "General"))
+    }
+
+
+def iter_sax_rows(file_path: str, max_col: Optional[int] = None) -> Iterator[tuple]:
+    """
+    Stream the sheet XML through expat callbacks, skipping openpyxl's per-cell
+    object model and ElementTree's per-element objects. Only cached formula
+    results are read, like data_only=True.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        strings = _shared_strings(archive)
+        date_styles = _date_styles(archive)
+        columns = {}  # column letters -> zero-based index
+        ready = []
+        width, last_row = max_col, 0
+        cells, col, kind, style, text = {}, 0, "n", 0, None
+
+        def start(tag, attrs):
+            nonlocal width, last_row, cells, col, kind, style, text
+            tag = tag[tag.find(":") + 1:]
+            if tag == "c":
+                ref = attrs.get("r")
+                if ref:
+                    letters = ref.rstrip("0123456789")
+                    col = columns.get(letters)
+                    if col is None:
+                        col = columns[letters] = column_index_from_string(letters) - 1
+                else:
+                    col = len(cells)
+                kind = attrs.get("t", "n")
+                style = int(attrs.get("s", 0))
+            elif tag == "v" or tag == "t":
+                if max_col is None or col < max_col:
+                    text = []
+            elif tag == "row":
+                cells = {}
+                row_number = int(attrs.get("r", last_row + 1))
+                for _ in range(last_row + 1, row_number):
+                    ready.append((None,) * (width or 0))
+                last_row = row_number
+            elif tag == "dimension" and max_col is None:
+                letters = attrs.get("ref", "").split(":")[-1].rstrip("0123456789")
+                width = column_index_from_string(letters) if letters.isalpha() else None
+
+        def characters(data):
+            if text is not None:
+                text.append(data)
+
+        def end(tag):
+            nonlocal text
+            tag = tag[tag.find(":") + 1:]
+            if tag == "v" or tag == "t":
+                if text is None:
+                    return
+                value = "".join(text)
+                text = None
+                if kind == "s":
+                    cells[col] = strings[int(value)]
+                elif kind == "inlineStr":
+                    cells[col] = cells.get(col, "") + value
+                elif kind == "b":
+                    cells[col] = value == "1"
+                elif kind == "str" or kind == "e":
+                    cells[col] = value
+                elif value:
+                    number = float(value) if "." in value or "E" in value or "e" in value else int(value)
+                    cells[col] = from_excel(number) if style in date_styles else number
+            elif tag == "row":
+                size = max(width or 0, max(cells) + 1 if cells else 0)
+                ready.append(tuple(cells.get(i) for i in range(size)))
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        with archive.open(_first_sheet_path(archive)) as f:
+            while chunk := f.read(256 * 1024):
+                parser.Parse(chunk, False)
+                yield from ready
+                ready.clear()
+            parser.Parse(b"", True)
+            yield from ready
+
+
+def iter_calamine_rows(file_path: str, max_col: Optional[int] = None) -> Iterator[tuple]:
+    sheet = CalamineWorkbook.from_path(file_path).get_sheet_by_index(0)
+    for row in sheet.iter_rows():
+        yield tuple(_plain_value(v) for v in row[:max_col])
+
+
+def iter_xlrd_rows(file_path: str, max_col: Optional[int] = None) -> Iterator[tuple]:
+    import xlrd
+
+    book = xlrd.open_workbook(file_path, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for r in range(sheet.nrows):
+            row = []
+            for cell in sheet.row_slice(r, 0, max_col):
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate_as_datetime(cell.value, book.datemode))
+                elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                    row.append(None)
+                else:
+                    row.append(_plain_value(cell.value))
+            yield tuple(row)
+    finally:
+        book.release_resources()
+
+
+def iter_csv_rows(file_path: str, max_col: Optional[int] = None) -> Iterator[tuple]:
+    usecols = range(max_col) if max_col is not None else None
+    df = pd.read_csv(file_path, header=None, usecols=lambda c: usecols is None or c in usecols)
+    for row in df.itertuples(index=False, name=None):
+        yield tuple(None if pd.isna(v) else v for v in row)
+
+
+ROW_READERS: Dict[str, Callable[..., Iterator[tuple]]] = {
+    "openpyxl": iter_openpyxl_rows,
+    "sax": iter_sax_rows,
+    "xlrd": iter_xlrd_rows,
+    "csv": iter_csv_rows,
+}
+if CalamineWorkbook is not None:
+    ROW_READERS["calamine"] = iter_calamine_rows
+
+
+def select_reader(file_path: str, streaming: bool = False) -> str:
+    """
+    Pick the fastest available reader for a file. EXCEL_READER forces one.
+    With streaming, xlsx files always get a reader that does not load the
+    whole sheet (for reading only the first rows).
+    """
+    forced = os.getenv("EXCEL_READER")
+    if forced in ROW_READERS:
+        return forced
+    name = file_path.lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if "calamine" in ROW_READERS and (name.endswith(".xls") or (
+            not streaming and os.path.getsize(file_path) <= CALAMINE_MAX_BYTES)):
+        return "calamine"
+    if name.endswith(".xls"):
+        return "xlrd"
+    return "sax"
+
+
+def iter_sheet_rows(file_path: str, max_col: Optional[int] = None, reader: Optional[str] = None) -> Iterator[tuple]:
+    """
+    Stream the first sheet of a file as tuples with the given or the
+    automatically selected reader.
+    """
+    return ROW_READERS[reader or select_reader(file_path)](file_path, max_col)
+
+class ArchiveTooLarge(ValueError):
+    """
+    A zip archive over MAX_ARCHIVE_MEMBERS entries or MAX_ARCHIVE_BYTES of
+    uncompressed workbooks.
+    """
+
+
+def archive_workbooks(archive: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    """
+    The workbook entries of an archive, checked against the archive limits
+    from the sizes its directory declares (zipfile never reads more than
+    that) before anything is extracted. Raises ArchiveTooLarge.
+    """
+    entries = archive.infolist()
+    if len(entries) > MAX_ARCHIVE_MEMBERS:
+        raise ArchiveTooLarge(f"Archive has {len(entries)} entries, the limit is {MAX_ARCHIVE_MEMBERS}")
+    workbooks = []
+    for info in entries:
+        name = os.path.basename(info.filename)
+        if info.is_dir() or name.startswith((".", "~$")) or not name.lower().endswith(WORKBOOK_EXTENSIONS):
+            continue
+        workbooks.append(info)
+    size = sum(info.file_size for info in workbooks)
+    if size > MAX_ARCHIVE_BYTES:
+        raise ArchiveTooLarge(f"Archive workbooks uncompress to {size // (1024 * 1024)} MB, "
+                              f"the limit is {MAX_ARCHIVE_BYTES // (1024 * 1024)} MB")
+    return workbooks
+
+
+def check_archive(zip_path: str) -> int:
+    """
+    Check an uploaded archive against the limits without extracting it.
+    Returns the number of workbooks.
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        return len(archive_workbooks(archive))
+
+
+def extract_workbooks(zip_path: str, dest_dir: str) -> List[str]:
+    """
+    Extract the workbooks of a zip archive into dest_dir and return their
+    paths in archive order. Folder structure is flattened and other entries
+    (macOS metadata, lock files, non-spreadsheets) are ignored. Archives over
+    the limits raise ArchiveTooLarge before anything is written.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    paths = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for info in archive_workbooks(archive):
+            name = os.path.basename(info.filename)
+            # Prefix with the entry number so equal names from different folders do not clash
+            path = os.path.join(dest_dir, f"{len(paths) + 1:03d}_{name}")
+            with archive.open(info) as src, open(path, "wb") as dst:
+                while chunk := src.read(1024 * 1024):
+                    dst.write(chunk)
+            paths.append(path)
+    return paths
+
 def split_dataframe_in_batches(df: pd.DataFrame, batch_size: int) -> List[pd.DataFrame]:
     """
     Split DataFrame into list of DataFrames with batch_size rows each.
@@ -23,6 +333,85 @@ def split_dataframe_in_batches(df: pd.DataFrame, batch_size: int) -> List[pd.Dat
     return [df[i:i + batch_size] for i in range(0, len(df), batch_size)]
 
 
+WORKBOOK_EXTENSIONS = (".xlsx", ".xlsm", ".xls", ".csv")
+# Limits of a zip upload, checked against its directory before extraction
+MAX_ARCHIVE_BYTES = int(os.getenv("MAX_ARCHIVE_MB", 1024)) * 1024 * 1024
+MAX_ARCHIVE_MEMBERS = int(os.getenv("MAX_ARCHIVE_MEMBERS", 500))
+
+
+def _rows_to_frame(rows: list, names: List[str], positions: List[int], start: int,
+                   layout: Optional[Layout]) -> pd.DataFrame:
+    """
+    Build a typed DataFrame from raw sheet rows, keeping only the cells at
+    the given positions.
+    """
+    data = [tuple(row[p] if p < len(row) else None for p in positions) for row in rows]
+    df = pd.DataFrame.from_records(data, columns=names)
+    df.index = pd.RangeIndex(start, start + len(df))
+    if layout is None:
+        return df.infer_objects()
+    return layout.apply_dtypes(df)
+
+
+def read_sample_rows(file_path: str, sample_rows: int, header_row: int = 0) -> Tuple[Optional[tuple], List[tuple]]:
+    """
+    Read only the header row and the first sample_rows data rows of the first
+    sheet, without loading the rest of the file. Returns (None, []) for an
+    empty sheet.
+    """
+    reader = iter_sheet_rows(file_path, reader=select_reader(file_path, streaming=True))
+    try:
+        rows = list(itertools.islice(reader, header_row + 1 + sample_rows))
+    finally:
+        reader.close()
+
+    if len(rows) <= header_row:
+        return None, []
+    return rows[header_row], rows[header_row + 1:]
+
+
+def iter_excel_batches(file_path: str, batch_size: int, layout: Optional[Layout] = None) -> Iterator[pd.DataFrame]:
+    """
+    Stream the first sheet of an Excel file as DataFrame chunks of at most
+    batch_size rows, so only one batch is held in memory at a time.
+
+    With a layout, only its declared columns are read and each is parsed into
+    its declared dtype. Without one, the header row values become the column
+    names. Rows come from the reader select_reader picks for the file type
+    and size (see ROW_READERS).
+    """
+    header_row = layout.header_row if layout else 0
+    # Purely positional layouts let the reader stop at the last needed column
+    max_col = None
+    if layout and all(c.position is not None for c in layout.columns):
+        max_col = max(c.position for c in layout.columns) + 1
+    rows = iter_sheet_rows(file_path, max_col)
+
+    try:
+        for _ in range(header_row):
+            next(rows, None)
+        header = next(rows, None)
+        if header is None:
+            return
+        if layout is None:
+            names, positions = list(header), list(range(len(header)))
+        else:
+            names, positions = layout.resolve(header)
+
+        chunk = []
+        start = 0
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == batch_size:
+                yield _rows_to_frame(chunk, names, positions, start, layout)
+                start += len(chunk)
+                chunk = []
+        if chunk:
+            yield _rows_to_frame(chunk, names, positions, start, layout)
+    finally:
+        rows.close()
+
+
 
 def generate_excel_report(task_id, session, purchase_ids: List[int], transfer_ids: List[int]):
     wb = Workbook()